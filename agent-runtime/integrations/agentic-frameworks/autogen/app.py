@@ -10,18 +10,48 @@ Microsoft AutoGen Agent 示例项目
 - 完整集成 PPIO Agent Runtime
 """
 
+import ast
+import asyncio
+import atexit
+import contextvars
+import functools
+import hashlib
+import inspect
+import json
 import logging
+import math
+import operator
 import os
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 
 # 加载环境变量
 from dotenv import load_dotenv
 load_dotenv()
 
 # 导入 PPIO Agent Runtime
-from ppio_sandbox.agent_runtime import AgentRuntimeApp, RequestContext
+from ppio_sandbox.agent_runtime import AgentRuntimeApp, PingResponse, RequestContext
+from pydantic import ConfigDict
+from starlette.responses import JSONResponse, StreamingResponse
 
 app = AgentRuntimeApp()
 
+
+class HealthStatus(PingResponse):
+    """
+    保留额外字段的健康检查响应
+    
+    @app.ping 返回普通 dict 时，Runtime 会用它重新构建 PingResponse，
+    status/message/timestamp 之外的字段会被丢弃。
+    """
+    
+    model_config = ConfigDict(extra="allow")
+
 # 设置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -29,27 +59,635 @@ logging.basicConfig(
 )
 logger = logging.getLogger("autogen_agent")
 
-# 初始化全局对话历史 - 在沙箱生命周期内持久化
-# 同一个沙箱实例的所有请求共享此历史
-conversation_history = []
-
-# 检查 AutoGen 是否可用
-try:
-    from autogen_agentchat.agents import AssistantAgent
-    from autogen_agentchat.ui import Console
-    from autogen_agentchat.messages import TextMessage
-    from autogen_ext.models.openai import OpenAIChatCompletionClient
-    from autogen_core.models import ModelFamily, ModelInfo
-    from autogen_core import CancellationToken
-    AUTOGEN_AVAILABLE = True
-    logger.info("AutoGen 导入成功")
-except ImportError as e:
-    AUTOGEN_AVAILABLE = False
-    logger.error(f"AutoGen 导入失败：{e}", exc_info=True)
-    logger.warning("AutoGen 未安装或导入失败，将使用模拟模式")
+
+class SQLiteStateStore:
+    """
+    持久化到 SQLite（WAL 模式）的对话状态
+
+    每条消息单独追加为一行，每轮只写入新增的内容，而不是整个对话。
+    append() 只把记录放入队列，后台线程每隔 flush_interval 秒在一个事务中
+    提交队列，并发的多轮对话共用一次 fsync，请求处理不会等待磁盘。
+    重启后会话第一次被访问时，用 load() 读回（包括尚在队列中的记录）；
+    提交一批记录期间 load() 会等待，因此应在工作线程中调用。
+
+    指定 retention（秒）时，写入线程在没有待提交记录时删除超过该时长未写入的
+    会话，数据库不会永久保留所有对话。清理之前，load() 也把这样的会话视为已删除。
+    """
+
+    SWEEP_BATCH = 200
+
+    def __init__(self, path, flush_interval=0.05, retention=None, sweep_interval=60):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        self.appended = 0
+        self.commits = 0
+        self.bytes_written = 0
+        self.loads = 0
+        self.restored_sessions = 0
+        self.load_ms_max = 0.0
+        self.swept_sessions = 0
+        self._pending = []  # (session_id, JSON 文本，None 表示删除该会话)
+        self._pending_lock = threading.Lock()
+        # 提交一批记录期间持有，load() 不会同时在数据库和队列中看到同一条记录
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            "id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id)")
+        new_sessions_table = not self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sessions'"
+        ).fetchone()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, updated REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+        if new_sessions_table:
+            # 旧版本写入的数据库还没有 sessions 表：从现在开始计时
+            self._db.execute(
+                "INSERT OR IGNORE INTO sessions SELECT DISTINCT session_id, ? FROM turns", (time.time(),)
+            )
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="state-store", daemon=True)
+        self._writer.start()
+
+    def append(self, session_id, record):
+        """把一条可 JSON 序列化的记录放入 session_id 的写入队列"""
+        data = json.dumps(record, ensure_ascii=False)
+        with self._pending_lock:
+            self._pending.append((session_id, data))
+            self.appended += 1
+
+    def delete(self, session_id):
+        """把删除 session_id 全部记录的操作放入写入队列"""
+        with self._pending_lock:
+            self._pending.append((session_id, None))
+
+    def load(self, session_id, limit=None):
+        """按从旧到新的顺序返回会话的记录（指定 limit 时只返回最新的 limit 条）"""
+        start = time.perf_counter()
+        with self._db_lock:
+            if self._expire(session_id):
+                rows = []
+            elif limit is None:
+                rows = self._db.execute(
+                    "SELECT data FROM turns WHERE session_id = ? ORDER BY id", (session_id,)
+                ).fetchall()
+            else:
+                rows = self._db.execute(
+                    "SELECT data FROM (SELECT id, data FROM turns WHERE session_id = ? "
+                    "ORDER BY id DESC LIMIT ?) ORDER BY id",
+                    (session_id, limit),
+                ).fetchall()
+            with self._pending_lock:
+                pending = [data for queued_id, data in self._pending if queued_id == session_id]
+        records = [row[0] for row in rows]
+        for data in pending:
+            if data is None:
+                records = []
+            else:
+                records.append(data)
+        if limit is not None:
+            records = records[-limit:]
+        records = [json.loads(data) for data in records]
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._pending_lock:
+            self.loads += 1
+            self.restored_sessions += bool(records)
+            self.load_ms_max = max(self.load_ms_max, elapsed_ms)
+        return records
+
+    def _expire(self, session_id):
+        """
+        session_id 超过 retention 秒未写入时，把删除它的操作排在它的待提交记录之前，
+        并返回 True。调用时须持有 _db_lock。
+        """
+        if self.retention is None:
+            return False
+        expired = self._db.execute(
+            "SELECT 1 FROM sessions WHERE session_id = ? AND updated < ?",
+            (session_id, time.time() - self.retention),
+        ).fetchone()
+        if expired:
+            with self._pending_lock:
+                self._pending.insert(0, (session_id, None))
+        return expired is not None
+
+    def flush(self):
+        """提交目前队列中的全部记录"""
+        with self._db_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            written = set()
+            self._db.execute("BEGIN")
+            try:
+                for session_id, data in batch:
+                    if data is None:
+                        written.discard(session_id)
+                        self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                        self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                    else:
+                        written.add(session_id)
+                        self._db.execute(
+                            "INSERT INTO turns (session_id, data) VALUES (?, ?)", (session_id, data)
+                        )
+                now = time.time()
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO sessions (session_id, updated) VALUES (?, ?)",
+                    [(session_id, now) for session_id in written],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                with self._pending_lock:
+                    self._pending[:0] = batch
+                raise
+            with self._pending_lock:
+                self.commits += 1
+                self.bytes_written += sum(len(data) for _, data in batch if data is not None)
+
+    def sweep(self):
+        """删除最多 SWEEP_BATCH 个超过 retention 秒未写入的会话，返回删除的数量"""
+        if self.retention is None:
+            return 0
+        cutoff = time.time() - self.retention
+        with self._db_lock:
+            expired = [
+                row[0] for row in self._db.execute(
+                    "SELECT session_id FROM sessions WHERE updated < ? LIMIT ?", (cutoff, self.SWEEP_BATCH)
+                ).fetchall()
+            ]
+            with self._pending_lock:
+                # 队列中的记录提交后，这些会话会重新变为最近写入
+                queued = {session_id for session_id, _ in self._pending}
+            expired = [session_id for session_id in expired if session_id not in queued]
+            if not expired:
+                return 0
+            self._db.execute("BEGIN")
+            try:
+                for session_id in expired:
+                    self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                    self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        with self._pending_lock:
+            self.swept_sessions += len(expired)
+        return len(expired)
+
+    def _run(self):
+        last_sweep = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                with self._pending_lock:
+                    idle = not self._pending
+                # 只在队列为空时清理，不会延迟提交；删满一批说明可能还有过期会话，
+                # 下一次空闲时继续清理
+                if (self.retention is not None and idle
+                        and time.monotonic() - last_sweep >= self.sweep_interval):
+                    if self.sweep() < self.SWEEP_BATCH:
+                        last_sweep = time.monotonic()
+            except Exception as e:
+                logger.warning(f"写入对话状态失败，稍后重试：{e}")
+
+    def close(self):
+        """停止写入线程并提交剩余的记录"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._writer.join()
+        self.flush()
+        self._db.close()
+
+    def stats(self):
+        with self._pending_lock:
+            return {
+                "backend": "sqlite",
+                "appended": self.appended,
+                "pending": len(self._pending),
+                "commits": self.commits,
+                "bytes_written": self.bytes_written,
+                "loads": self.loads,
+                "restored_sessions": self.restored_sessions,
+                "load_ms_max": round(self.load_ms_max, 2),
+                "swept_sessions": self.swept_sessions,
+            }
+
+
+def _create_state_store():
+    """
+    按 STATE_BACKEND 创建对话状态后端
+
+    "memory"（默认）只在进程内存中保存对话；"sqlite" 同时写入 STATE_PATH，
+    沙箱被回收后可以接着之前的对话继续。其他后端只需实现与 SQLiteStateStore
+    相同的 append/delete/load/flush/close/stats 方法。
+    """
+    backend = os.getenv("STATE_BACKEND", "memory").lower()
+    if backend == "memory":
+        return None
+    if backend == "sqlite":
+        store = SQLiteStateStore(
+            os.getenv("STATE_PATH", "conversations.db"),
+            flush_interval=float(os.getenv("STATE_FLUSH_INTERVAL", "0.05")),
+            retention=int(os.getenv("SESSION_IDLE_TIMEOUT", "3600")),
+        )
+        atexit.register(store.close)
+        logger.info(f"对话状态持久化到 {store.path}")
+        return store
+    raise ValueError(f"未知的 STATE_BACKEND：{backend!r}（可选 'memory' 或 'sqlite'）")
+
+
+state_store = _create_state_store()
+
+
+class ConversationHistory:
+    """
+    单个会话的对话历史
+
+    同时缓存已转换的 AutoGen TextMessage，每轮只转换新增的消息，
+    避免长对话每次请求都重新构建全部消息对象。
+    指定 store 时，每条新消息也以 session_id 写入 store。
+    """
+
+    def __init__(self, store=None, session_id=None):
+        self.messages = []
+        self.chars = 0
+        self.store = store
+        self.session_id = session_id
+        self._autogen_messages = []
+
+    def append(self, role, content, persist=True):
+        message = {"role": role, "content": content}
+        self.messages.append(message)
+        self.chars += len(content)
+        if persist and self.store is not None:
+            self.store.append(self.session_id, message)
+
+    def to_autogen_messages(self):
+        """返回 AutoGen 消息列表（只读，调用方不要修改）"""
+        for msg in self.messages[len(self._autogen_messages):]:
+            self._autogen_messages.append(TextMessage(content=msg["content"], source=msg["role"]))
+        return self._autogen_messages
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class SessionStore:
+    """
+    按会话 ID 隔离的对话历史
+
+    会话按 LRU 顺序保存，以下情况会淘汰最久未使用的会话：
+    - 空闲时间超过 idle_timeout 秒
+    - 会话数超过 max_sessions
+    - 所有会话的历史总字符数超过 max_total_chars
+
+    当前正在访问的会话不会被淘汰。指定 state_store 时，被淘汰的会话
+    （或重启前的会话）再次访问时从 state_store 读回。
+    """
+
+    def __init__(self, max_sessions=100, idle_timeout=3600, max_total_chars=4_000_000, state_store=None):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_total_chars = max_total_chars
+        self.state_store = state_store
+        self.evicted_count = 0
+        self._sessions = OrderedDict()  # session_id -> (history, last_active)
+
+    def get(self, session_id, create=True, history=None):
+        """
+        获取会话历史。会话不在内存中时使用 history，或新建一个；
+        create=False 时不创建，返回 None
+        """
+        now = time.monotonic()
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            history = entry[0]
+        elif not create:
+            return None
+        elif history is None:
+            history = self._new_history(session_id)
+        self._sessions[session_id] = (history, now)
+        self._evict(now)
+        return history
+
+    async def aget(self, session_id):
+        """
+        在事件循环中获取会话历史
+
+        会话不在内存中时，在工作线程中新建（可能要从 state_store 读回），
+        事件循环不会等待数据库。期间并发的请求已创建该会话时，返回已有的历史。
+        """
+        history = self.get(session_id, create=False)
+        if history is None:
+            created = await asyncio.to_thread(self._new_history, session_id)
+            history = self.get(session_id, history=created)
+        return history
+
+    def _new_history(self, session_id):
+        history = ConversationHistory(store=self.state_store, session_id=session_id)
+        if self.state_store is not None:
+            # 本进程第一次访问该会话（例如重启之后），读回之前的对话
+            for message in self.state_store.load(session_id):
+                history.append(message["role"], message["content"], persist=False)
+        return history
+
+    def _evict(self, now):
+        # 从最旧的会话开始，最后一个是当前会话
+        while len(self._sessions) > 1:
+            session_id, (_, last_active) = next(iter(self._sessions.items()))
+            if (now - last_active <= self.idle_timeout
+                    and len(self._sessions) <= self.max_sessions
+                    and self._total_chars() <= self.max_total_chars):
+                break
+            del self._sessions[session_id]
+            self.evicted_count += 1
+            logger.info(f"淘汰会话历史：{session_id}")
+
+    def _total_chars(self):
+        return sum(history.chars for history, _ in self._sessions.values())
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "chars": self._total_chars(),
+            "evicted_sessions": self.evicted_count,
+            "max_sessions": self.max_sessions,
+        }
+
+
+# 按会话隔离的对话历史 - 在沙箱生命周期内持久化
+# 多个会话复用同一个沙箱时，各自的对话互不干扰
+sessions = SessionStore(
+    max_sessions=int(os.getenv("SESSION_MAX_COUNT", "100")),
+    idle_timeout=int(os.getenv("SESSION_IDLE_TIMEOUT", "3600")),
+    max_total_chars=int(os.getenv("SESSION_MAX_TOTAL_CHARS", "4000000")),
+    state_store=state_store,
+)
+DEFAULT_SESSION_ID = "default"
+
+
+def _request_session_id(request, context):
+    """
+    请求所属的会话：请求体中的 "session_id"，其次是 Runtime 的 sandbox_id，都没有时使用默认会话
+
+    PPIO 客户端 SDK 只发送调用方传入的请求体，不会附带 sandbox_id；
+    需要在同一沙箱中区分多个对话的客户端应在请求体中传入 "session_id"。
+    """
+    session_id = request.get("session_id") or getattr(context, "session_id", None)
+    return str(session_id) if session_id else DEFAULT_SESSION_ID
+
+# AutoGen 及其依赖（openai 等）导入耗时约 2 秒，放到首次使用时再导入，
+# 冷启动的沙箱可以更快响应 /ping。以 `python app.py` 启动时会在后台线程中
+# 执行 warm_up()，通常在第一个请求到达前就已完成。
+AUTOGEN_AVAILABLE = None  # 首次加载前未知
+AssistantAgent = TextMessage = ModelClientStreamingChunkEvent = None
+OpenAIChatCompletionClient = ModelFamily = ModelInfo = CancellationToken = None
+AsyncOpenAI = DefaultAsyncHttpxClient = None
+RetryingChatCompletionClient = None
+_framework_lock = threading.Lock()
+startup_stats = {"framework_load_s": None, "warm_up_s": None, "steps": {}, "errors": []}
+
+
+def _load_framework():
+    """导入 AutoGen（只执行一次，线程安全），返回是否可用"""
+    global AUTOGEN_AVAILABLE, AssistantAgent, TextMessage, ModelClientStreamingChunkEvent
+    global OpenAIChatCompletionClient, ModelFamily, ModelInfo, CancellationToken
+    global AsyncOpenAI, DefaultAsyncHttpxClient, RetryingChatCompletionClient
+    if AUTOGEN_AVAILABLE is not None:
+        return AUTOGEN_AVAILABLE
+    with _framework_lock:
+        if AUTOGEN_AVAILABLE is not None:
+            return AUTOGEN_AVAILABLE
+        start = time.monotonic()
+        try:
+            from autogen_agentchat.agents import AssistantAgent
+            from autogen_agentchat.messages import TextMessage, ModelClientStreamingChunkEvent
+            from autogen_ext.models.openai import OpenAIChatCompletionClient
+            from autogen_core.models import ModelFamily, ModelInfo
+            from autogen_core import CancellationToken
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+            class RetryingChatCompletionClient(OpenAIChatCompletionClient):
+                """按 llm_policy 重试（非流式调用还可对冲）的模型客户端；开启 LLM_CACHE 时非流式调用先查缓存"""
+
+                async def create(self, messages, *, tools=(), **kwargs):
+                    create = super().create
+                    key = None
+                    if llm_cache is not None:
+                        key = ResponseCache.make_key(
+                            LLM_MODEL,
+                            [message.model_dump(mode="json") for message in messages],
+                            [getattr(tool, "name", None) or tool["name"] for tool in tools],
+                        )
+                        cached = llm_cache.get(key)
+                        if cached is not None:
+                            return cached.model_copy(update={"cached": True})
+                    result = await llm_policy.call(lambda: create(messages, tools=tools, **kwargs))
+                    if key is not None:
+                        llm_cache.put(key, result, size=len(result.model_dump_json()))
+                    return result
+
+                async def create_stream(self, *args, **kwargs):
+                    create_stream = super().create_stream
+                    async for item in llm_policy.stream(lambda: create_stream(*args, **kwargs)):
+                        yield item
+
+            AUTOGEN_AVAILABLE = True
+            logger.info("AutoGen 导入成功")
+        except ImportError as e:
+            AUTOGEN_AVAILABLE = False
+            logger.error(f"AutoGen 导入失败：{e}", exc_info=True)
+            logger.warning("AutoGen 未安装或导入失败，将使用模拟模式")
+        startup_stats["framework_load_s"] = round(time.monotonic() - start, 3)
+        logger.info(f"框架加载耗时 {startup_stats['framework_load_s']} 秒")
+    return AUTOGEN_AVAILABLE
+
+
+async def _ensure_framework():
+    """在线程中加载 AutoGen，避免首次导入阻塞事件循环"""
+    if AUTOGEN_AVAILABLE is None:
+        await asyncio.to_thread(_load_framework)
+    return AUTOGEN_AVAILABLE
+
+
+# 预热时请求一次 GET /models（不消耗 token），提前建立到 LLM 服务的连接，
+# 第一个请求无需再等待 TCP/TLS 握手
+WARM_UP_LLM = os.getenv("WARM_UP_LLM", "true").lower() in ("1", "true", "yes")
+WARM_UP_LLM_TIMEOUT = 10
+_warm_up_lock = threading.Lock()
+_warm_up_task = None
+
+
+def _warm_up_failed(name, e):
+    startup_stats["errors"].append(f"{name}: {e}")
+    logger.warning(f"预热步骤 {name} 失败：{e}", exc_info=True)
+
+
+def _warm_up_step(name, func):
+    """执行一个同步预热步骤，记录耗时或错误"""
+    start = time.monotonic()
+    try:
+        func()
+    except Exception as e:
+        _warm_up_failed(name, e)
+        return
+    startup_stats["steps"][name] = round(time.monotonic() - start, 3)
+
+
+async def _warm_up_step_async(name, func):
+    """执行一个异步预热步骤，记录耗时或错误"""
+    start = time.monotonic()
+    try:
+        await func()
+    except Exception as e:
+        _warm_up_failed(name, e)
+        return
+    startup_stats["steps"][name] = round(time.monotonic() - start, 3)
+
+
+def warm_up():
+    """在第一个请求之前加载框架（只执行一次）"""
+    with _warm_up_lock:
+        if "framework" not in startup_stats["steps"]:
+            _warm_up_step("framework", _load_framework)
+
+
+class ResponseCache:
+    """
+    按值的估算大小限制容量的内存 LRU 缓存
+
+    条目在写入 `ttl` 秒后过期（单个条目可以指定自己的 ttl）。所有值的大小之和
+    超过 `max_bytes` 时，淘汰最久未使用的条目。None 不会被缓存。
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """由可 JSON 序列化的各部分生成稳定的键（dict 的键会排序）"""
+        data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        """返回缓存的值，未命中时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None, ttl=None):
+        """写入 `value`；`size` 默认为其 repr() 的长度"""
+        size = len(repr(value)) if size is None else size
+        ttl = self.ttl if ttl is None else ttl
+        if value is None or ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def normalize_args(args):
+    """规范化工具参数用于缓存键：字符串合并空白并忽略大小写"""
+    if isinstance(args, str):
+        return " ".join(args.split()).casefold()
+    if isinstance(args, dict):
+        return {name: normalize_args(value) for name, value in args.items()}
+    if isinstance(args, (list, tuple)):
+        return [normalize_args(value) for value in args]
+    return args
+
+
+# 两级缓存。工具结果按 cached_tool 为每个工具指定的 TTL（秒）缓存。LLM 响应缓存
+# 需要显式开启（LLM_CACHE=true）：相同模型、对话和工具直接返回之前的回答，只适合
+# FAQ 这类确定性的流量。只用于非流式调用，缓存的回答没有可以流式输出的 token。
+TOOL_CACHE = os.getenv("TOOL_CACHE", "true").lower() in ("1", "true", "yes")
+tool_cache = ResponseCache(max_bytes=int(os.getenv("TOOL_CACHE_MAX_BYTES", str(16 * 1024 * 1024))))
+LLM_CACHE = os.getenv("LLM_CACHE", "false").lower() in ("1", "true", "yes")
+llm_cache = ResponseCache(
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=int(os.getenv("LLM_CACHE_TTL", "3600")),
+) if LLM_CACHE else None
+
+
+def cached_tool(ttl):
+    """
+    按规范化后的参数缓存异步工具的结果
+    
+    functools.wraps 保留了签名和文档字符串，AutoGen 生成的工具 schema 不变。
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not TOOL_CACHE:
+                return await func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = ResponseCache.make_key(func.__name__, normalize_args(bound.arguments))
+            result = tool_cache.get(key)
+            if result is None:
+                result = await func(*args, **kwargs)
+                tool_cache.put(key, result, ttl=ttl)
+            return result
+        
+        return wrapper
+    return decorator
 
 
 # 定义工具函数
+@cached_tool(ttl=600)
 async def get_weather(city: str) -> str:
     """
     获取指定城市的天气
@@ -69,6 +707,7 @@ async def get_weather(city: str) -> str:
     return weather_data.get(city, f"{city}：晴天，温度 23°C")
 
 
+@cached_tool(ttl=3600)
 async def search_information(query: str) -> str:
     """
     搜索信息
@@ -82,6 +721,73 @@ async def search_information(query: str) -> str:
     return f"关于 '{query}' 的搜索结果：这是一个示例搜索结果。实际使用时可以接入真实搜索 API。"
 
 
+# 安全的算术表达式求值：只允许数字和算术运算符，不执行任意代码
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+MAX_EXPRESSION_LENGTH = 200
+MAX_EXPONENT = 1000
+# 整数结果最多的二进制位数（约 1233 位十进制数），嵌套的乘方和乘法也受此限制
+MAX_RESULT_BITS = 4096
+
+
+def _check_result_size(op, left, right):
+    """在计算之前估算整数乘方/乘法结果的位数，超过 MAX_RESULT_BITS 时拒绝"""
+    if type(left) is not int or type(right) is not int:
+        return
+    if isinstance(op, ast.Pow) and right > 0:
+        bits = left.bit_length() * right
+    elif isinstance(op, ast.Mult):
+        bits = left.bit_length() + right.bit_length()
+    else:
+        return
+    if bits > MAX_RESULT_BITS:
+        raise ValueError(f"结果过大（超过 {MAX_RESULT_BITS} 个二进制位）")
+
+
+def _eval_node(node):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        left = _eval_node(node.left)
+        right = _eval_node(node.right)
+        if isinstance(node.op, ast.Pow) and abs(right) > MAX_EXPONENT:
+            raise ValueError(f"指数过大（最大 {MAX_EXPONENT}）")
+        _check_result_size(node.op, left, right)
+        return _BINARY_OPERATORS[type(node.op)](left, right)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](_eval_node(node.operand))
+    raise ValueError(f"不支持的表达式：{type(node).__name__}")
+
+
+@functools.lru_cache(maxsize=1024)
+def evaluate_expression(expression: str):
+    """
+    计算算术表达式（结果按表达式缓存；整数结果不超过 MAX_RESULT_BITS 位，缓存占用有上限）
+    
+    Args:
+        expression: 只包含数字、+ - * / // % ** 和括号的表达式
+        
+    Returns:
+        计算结果
+    """
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"表达式过长（最大 {MAX_EXPRESSION_LENGTH} 个字符）")
+    tree = ast.parse(expression.strip(), mode="eval")
+    return _eval_node(tree.body)
+
+
+@cached_tool(ttl=86400)
 async def calculate(expression: str) -> str:
     """
     计算数学表达式
@@ -93,12 +799,241 @@ async def calculate(expression: str) -> str:
         计算结果
     """
     try:
-        result = eval(expression, {"__builtins__": {}}, {})
+        result = evaluate_expression(expression)
         return f"计算结果：{expression} = {result}"
     except Exception as e:
         return f"计算错误：{str(e)}"
 
 
+class LLMCallPolicy:
+    """
+    上游 LLM 调用的重试、截止时间和可选的对冲请求
+
+    出错时如果值得重试（HTTP 408/409/429/5xx 或连接错误），按带完全抖动的指数退避
+    重试，并遵循服务端返回的 Retry-After。每次调用的截止时间为 `call_timeout` 秒，
+    且不晚于请求自身的截止时间（见 set_deadline），超过截止时间不再重试。
+
+    开启 `hedge` 后，非流式调用在超过近期调用耗时的 p95 后仍未返回时，会再发出一个
+    相同的请求，先返回的结果胜出，另一个请求被取消。以慢调用多消耗的 token
+    换取更短的长尾延迟。
+    """
+
+    RETRY_STATUSES = {408, 409, 429}
+    # 保留最近的调用耗时，用于计算对冲延迟
+    LATENCY_SAMPLES = 200
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=8.0, call_timeout=60.0, hedge=False):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.call_timeout = call_timeout
+        self.hedge = hedge
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedges_won": 0, "deadline_exceeded": 0, "failures": 0}
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        # 按请求区分：每个请求在各自的 task 和 context 中处理
+        self._request_deadline = contextvars.ContextVar("llm_request_deadline", default=None)
+
+    def set_deadline(self, deadline):
+        """为当前请求的 LLM 调用设置截止时间（time.monotonic() 时间）"""
+        self._request_deadline.set(deadline)
+
+    def hedge_after(self):
+        """近期调用耗时的 p95；样本不足时返回 None"""
+        if len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _deadline(self):
+        deadline = time.monotonic() + self.call_timeout
+        request_deadline = self._request_deadline.get()
+        return deadline if request_deadline is None else min(deadline, request_deadline)
+
+    async def call(self, func, hedge=True):
+        """
+        按本策略等待 `func()` 的结果，每次调用 `func` 都会发出一个新请求
+
+        流式调用传入 hedge=False。
+        """
+        hedge = hedge and self.hedge
+        deadline = self._deadline()
+        self.stats["calls"] += 1
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = await self._attempt(func, hedge, deadline)
+            except asyncio.TimeoutError:
+                self.stats["deadline_exceeded"] += 1
+                raise
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None or time.monotonic() + delay >= deadline:
+                    self.stats["failures"] += 1
+                    raise
+                attempt += 1
+                self.stats["retries"] += 1
+                logger.warning(f"LLM 调用失败（{type(e).__name__}: {e}），{delay:.2f} 秒后第 {attempt} 次重试")
+                await asyncio.sleep(delay)
+                continue
+            if hedge:
+                self._latencies.append(time.monotonic() - start)
+            return result
+
+    async def stream(self, make_stream):
+        """
+        按本策略迭代 `make_stream()` 返回的流，每次调用都会发出一个新的流式请求
+
+        只在收到第一个片段之前重试；片段一旦转发给调用方，之后的错误原样抛出。
+        截止时间约束每一个片段：上游中途停止输出时，在截止时间到达后抛出
+        asyncio.TimeoutError（计入 deadline_exceeded），而不是一直等到 HTTP 读超时。
+        """
+        deadline = self._deadline()
+        self.stats["calls"] += 1
+        attempt = 0
+        while True:
+            stream = make_stream()
+            try:
+                first = await asyncio.wait_for(stream.__anext__(), deadline - time.monotonic())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                await stream.aclose()
+                self.stats["deadline_exceeded"] += 1
+                raise
+            except Exception as e:
+                await stream.aclose()
+                delay = self._retry_delay(e, attempt)
+                if delay is None or time.monotonic() + delay >= deadline:
+                    self.stats["failures"] += 1
+                    raise
+                attempt += 1
+                self.stats["retries"] += 1
+                logger.warning(f"LLM 流式调用失败（{type(e).__name__}: {e}），{delay:.2f} 秒后第 {attempt} 次重试")
+                await asyncio.sleep(delay)
+                continue
+            break
+        try:
+            yield first
+            while True:
+                try:
+                    item = await asyncio.wait_for(stream.__anext__(), deadline - time.monotonic())
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    self.stats["deadline_exceeded"] += 1
+                    raise asyncio.TimeoutError("LLM 流式响应超过截止时间") from None
+                yield item
+        finally:
+            await stream.aclose()
+
+    async def _attempt(self, func, hedge, deadline):
+        hedge_after = self.hedge_after() if hedge else None
+        if hedge_after is None or time.monotonic() + hedge_after >= deadline:
+            return await asyncio.wait_for(func(), deadline - time.monotonic())
+
+        tasks = [asyncio.ensure_future(func())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                self.stats["hedges"] += 1
+                tasks.append(asyncio.ensure_future(func()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=deadline - time.monotonic(), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+                error = None
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.stats["hedges_won"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _retry_delay(self, error, attempt):
+        """下一次重试前的退避时间；不重试时返回 None"""
+        if attempt >= self.max_retries:
+            return None
+        status = getattr(error, "status_code", None)
+        if status is None:
+            # openai.APIConnectionError 及其子类 APITimeoutError
+            if not any(cls.__name__ == "APIConnectionError" for cls in type(error).__mro__):
+                return None
+        elif status not in self.RETRY_STATUSES and status < 500:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        try:
+            delay = max(delay, min(float(headers.get("retry-after", 0)), self.max_delay))
+        except ValueError:
+            pass  # HTTP 日期格式，使用计算出的退避时间
+        return delay
+
+    def snapshot(self):
+        hedge_after = self.hedge_after()
+        return dict(self.stats, hedge_after_ms=round(hedge_after * 1000, 1) if hedge_after is not None else None)
+
+
+llm_policy = LLMCallPolicy(
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    call_timeout=float(os.getenv("LLM_CALL_TIMEOUT", "60")),
+    hedge=os.getenv("LLM_HEDGE", "false").lower() in ("1", "true", "yes"),
+)
+# 单个请求的默认时间预算；请求可以通过 "timeout" 字段（秒）自行指定
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "300"))
+
+
+LLM_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.ppinfra.com/v3/openai")
+LLM_API_KEY = os.getenv("OPENAI_API_KEY")
+LLM_MODEL = os.getenv("MODEL_NAME", "deepseek/deepseek-v3.1-terminus")
+
+# 每种流式模式共享一个模型客户端，所有模型客户端共享同一个 HTTP 连接池
+_model_clients = {}
+_http_client = None
+
+
+def _get_http_client():
+    """获取共享的 HTTP 客户端（首次调用时创建）"""
+    global _http_client
+    if _http_client is None:
+        _http_client = DefaultAsyncHttpxClient()
+    return _http_client
+
+
+def _get_model_client(streaming=False):
+    """获取指定流式模式的共享模型客户端（首次调用时创建）"""
+    if streaming not in _model_clients:
+        _model_clients[streaming] = RetryingChatCompletionClient(
+            base_url=LLM_BASE_URL,
+            model=LLM_MODEL,
+            api_key=LLM_API_KEY,
+            http_client=_get_http_client(),
+            # 重试由 llm_policy 负责，客户端自身不再重试
+            max_retries=0,
+            model_info=ModelInfo(
+                vision=False,
+                function_calling=True,
+                json_output=True,
+                family=ModelFamily.UNKNOWN,
+                structured_output=True,
+            ),
+            # 启用 token 级别的流式输出
+            stream_options={"include_usage": True} if streaming else None,
+        )
+    return _model_clients[streaming]
+
+
+TOOLS = [get_weather, search_information, calculate]
+
+
 def _create_agent(streaming=False):
     """
     创建 AutoGen Agent（复用配置）
@@ -106,25 +1041,10 @@ def _create_agent(streaming=False):
     Args:
         streaming: 是否启用流式输出（token 级别）
     """
-    model_client = OpenAIChatCompletionClient(
-        base_url=os.getenv("OPENAI_BASE_URL", "https://api.ppinfra.com/v3/openai"),
-        model=os.getenv("MODEL_NAME", "deepseek/deepseek-v3.1-terminus"),
-        api_key=os.getenv("OPENAI_API_KEY"),
-        model_info=ModelInfo(
-            vision=False,
-            function_calling=True,
-            json_output=True,
-            family=ModelFamily.UNKNOWN,
-            structured_output=True,
-        ),
-        # 启用 token 级别的流式输出
-        stream_options={"include_usage": True} if streaming else None,
-    )
-    
     agent = AssistantAgent(
         name="assistant",
-        model_client=model_client,
-        tools=[get_weather, search_information, calculate],
+        model_client=_get_model_client(streaming),
+        tools=TOOLS,
         system_message="""你是一个有用的 AI 助手，可以：
         1. 查询天气信息
         2. 搜索相关信息
@@ -132,84 +1052,297 @@ def _create_agent(streaming=False):
         
         请根据用户的请求选择合适的工具。""",
         reflect_on_tool_use=True,
+        # 流式模式下逐 token 产出 ModelClientStreamingChunkEvent
+        model_client_stream=streaming,
     )
     
     return agent
 
 
-async def _handle_streaming():
+class AgentPool:
+    """
+    预先构建的 Agent 池（每种流式模式一个）
+    
+    请求通过 checkout() 借出 Agent，用完后重置其内部状态再放回池中，
+    避免每个请求都重新构建模型客户端和工具 schema。池中 Agent 数量
+    达到 size 后，新请求会等待其他请求归还 Agent。
+    
+    创建 Agent 失败时，名额以 None 占位留在池中，借到占位的请求重新创建，
+    因此失败不会让等待中的请求一直阻塞，也不会让池永久变小。
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._idle = {}  # streaming -> asyncio.Queue
+        self._created = {}  # streaming -> 已创建的 Agent 数量
+
+    @asynccontextmanager
+    async def checkout(self, streaming=False):
+        """借出一个 Agent，退出上下文时重置并归还"""
+        idle = self._idle.setdefault(streaming, asyncio.Queue())
+        start = time.monotonic()
+        if idle.empty() and self._created.get(streaming, 0) < self.size:
+            self._created[streaming] = self._created.get(streaming, 0) + 1
+            agent = None
+        else:
+            agent = await idle.get()
+        if agent is None:
+            try:
+                agent = _create_agent(streaming)
+            except BaseException:
+                # 把名额还给池，下一个请求会再试
+                idle.put_nowait(None)
+                raise
+        
+        wait = time.monotonic() - start
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        
+        try:
+            yield agent
+        finally:
+            reset = False
+            try:
+                await agent.on_reset(CancellationToken())
+                reset = True
+            except Exception as e:
+                logger.warning(f"Agent 重置失败，已丢弃：{e}")
+            finally:
+                # 重置失败（或请求被取消）的 Agent 不再复用，换成新建的 Agent
+                # 放回池中；新建也失败时放回占位。无论哪种情况都会放回一项，
+                # 正在 idle.get() 中等待的请求总会被唤醒
+                if not reset:
+                    try:
+                        agent = _create_agent(streaming)
+                    except Exception as e:
+                        logger.error(f"重新创建 Agent 失败，借到该名额的请求会再试：{e}")
+                        agent = None
+                idle.put_nowait(agent)
+
+    def prefill(self, streaming=False, count=1):
+        """预先创建 Agent 放入池中（总数不超过 size），需在事件循环线程中调用"""
+        idle = self._idle.setdefault(streaming, asyncio.Queue())
+        for _ in range(count):
+            if self._created.get(streaming, 0) >= self.size:
+                break
+            self._created[streaming] = self._created.get(streaming, 0) + 1
+            idle.put_nowait(_create_agent(streaming))
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "created": {("streaming" if k else "non_streaming"): v for k, v in self._created.items()},
+            "idle": {("streaming" if k else "non_streaming"): q.qsize() for k, q in self._idle.items()},
+            "checkouts": self.checkouts,
+            "avg_wait_ms": round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+        }
+
+
+agent_pool = AgentPool(size=int(os.getenv("AGENT_POOL_SIZE", "4")))
+
+
+class StreamAccumulator:
+    """
+    以 O(n) 开销累积一次流式响应的所有片段
+    
+    片段先放入列表，每 BLOCK_PARTS 个拼接成一块，长回复只需每块复制一次，
+    而不是每个片段都生成新字符串，内存占用也接近文本本身大小。
+    max_chars 限制保留的字符数（用于写入历史），发送给客户端的流不受影响。
+    """
+    
+    BLOCK_PARTS = 256
+    
+    def __init__(self, max_chars=None):
+        self.max_chars = max_chars
+        self.chars = 0
+        self.truncated = False
+        self._blocks = []  # 每 BLOCK_PARTS 个片段拼接成的块
+        self._pending = []
+    
+    def append(self, text):
+        if not text:
+            return
+        if self.max_chars is not None:
+            room = self.max_chars - self.chars
+            if len(text) > room:
+                self.truncated = True
+                text = text[:max(room, 0)]
+                if not text:
+                    return
+        self._pending.append(text)
+        self.chars += len(text)
+        if len(self._pending) >= self.BLOCK_PARTS:
+            self._blocks.append("".join(self._pending))
+            self._pending.clear()
+    
+    def text(self):
+        """返回累积的完整文本（只拼接一次，之后复用）"""
+        if self._pending:
+            self._blocks.append("".join(self._pending))
+            self._pending.clear()
+        if len(self._blocks) > 1:
+            self._blocks = ["".join(self._blocks)]
+        return self._blocks[0] if self._blocks else ""
+    
+    def __len__(self):
+        return self.chars
+
+
+def _new_accumulator():
+    max_chars = int(os.getenv("STREAM_MAX_CHARS", "0"))
+    return StreamAccumulator(max_chars=max_chars or None)
+
+
+# 客户端在完成前断开的运行次数
+run_stats = {"cancelled_runs": 0}
+
+
+# 队列中表示 on_messages_stream() 结束的标记
+_STREAM_END = object()
+
+
+async def _pump_agent_stream(agent, messages, cancellation_token, items):
+    """把 on_messages_stream() 的消息放入 items，结束后放入 _STREAM_END（出错时放入异常）"""
+    try:
+        async for message in agent.on_messages_stream(messages, cancellation_token):
+            await items.put(message)
+    except Exception as e:
+        await items.put(e)
+    else:
+        await items.put(_STREAM_END)
+
+
+async def _handle_streaming(conversation_history, deadline=None):
     """
     处理流式请求 - 生成器函数
     
-    实时流式返回 LLM 响应，并累积完整响应保存到对话历史
+    实时流式返回 LLM 响应，并累积完整响应保存到对话历史。
+    Agent 在单独的任务中运行：客户端断开时 Starlette 通过 anyio 取消作用域
+    停止本生成器，这无法传递到 Agent 内部等待的模型调用，因此取消该任务并
+    等它结束（关闭上游 LLM 流）后，再取消 CancellationToken 并归还 Agent。
     """
-    if not AUTOGEN_AVAILABLE:
+    llm_policy.set_deadline(deadline)
+    if not await _ensure_framework():
         yield {"chunk": "（模拟响应）AutoGen 未安装", "type": "content"}
         yield {"chunk": "", "type": "end"}
         return
     
+    # 创建 CancellationToken，客户端断开时用于取消正在进行的模型调用
+    cancellation_token = CancellationToken()
+    
     try:
-        agent = _create_agent(streaming=True)
-        accumulated_content = ""
+        accumulated = _new_accumulator()
         
-        # 将对话历史转换为 AutoGen 消息格式
-        messages = []
-        for msg in conversation_history:
-            messages.append(TextMessage(content=msg["content"], source=msg["role"]))
-        
-        # 创建 CancellationToken
-        cancellation_token = CancellationToken()
+        # 获取 AutoGen 消息格式的对话历史（只转换新增消息）
+        messages = conversation_history.to_autogen_messages()
         
-        # 运行 Agent 流式输出
-        async for message in agent.on_messages_stream(messages, cancellation_token):
-            # 提取消息内容
-            content = None
-            
-            # 处理 Response 类型（包含 chat_message）
-            if hasattr(message, 'chat_message') and hasattr(message.chat_message, 'content'):
-                content = message.chat_message.content
-            # 处理直接包含 content 的事件（如 ThoughtEvent）
-            elif hasattr(message, 'content'):
-                content = message.content
-            
-            # 输出有效内容
-            if content and isinstance(content, str) and content.strip():
-                accumulated_content += content
-                yield {"chunk": content, "type": "content"}
+        # 当前模型调用是否已流式输出 token，用于跳过随后重复的完整消息
+        streamed_turn = False
         
+        # 从池中借出 Agent 运行流式输出，结束后自动重置并归还
+        async with agent_pool.checkout(streaming=True) as agent:
+            items = asyncio.Queue(maxsize=64)
+            runner = asyncio.create_task(_pump_agent_stream(agent, messages, cancellation_token, items))
+            try:
+                while True:
+                    message = await items.get()
+                    if message is _STREAM_END:
+                        break
+                    if isinstance(message, Exception):
+                        raise message
+                    # token 增量：收到即输出
+                    if isinstance(message, ModelClientStreamingChunkEvent):
+                        if message.content:
+                            streamed_turn = True
+                            accumulated.append(message.content)
+                            yield {"chunk": message.content, "type": "content"}
+                        continue
+                
+                    # 提取消息内容
+                    content = None
+                
+                    # 处理 Response 类型（包含 chat_message）
+                    if hasattr(message, 'chat_message') and hasattr(message.chat_message, 'content'):
+                        # 最终消息与已流式输出的 token 相同，不再重复输出
+                        if not streamed_turn:
+                            content = message.chat_message.content
+                    # 处理直接包含 content 的事件（如 ThoughtEvent）
+                    elif hasattr(message, 'content'):
+                        content = message.content
+                
+                    # 其他事件表示一次模型调用已结束
+                    streamed_turn = False
+                
+                    # 输出有效内容
+                    if content and isinstance(content, str) and content.strip():
+                        accumulated.append(content)
+                        yield {"chunk": content, "type": "content"}
+            finally:
+                # 正常结束时不起作用；客户端断开或出错时，在归还 Agent 之前
+                # 停止模型调用和工具执行
+                if not runner.done():
+                    # 先只取消任务：取消沿等待链只传到读取上游流的任务一次。同时取消
+                    # CancellationToken 会让该任务在关闭 HTTP 连接时再被取消一次，
+                    # 连接因此关不掉
+                    runner.cancel()
+                    # 等任务真正结束后再归还 Agent。客户端断开时本任务正被取消作用域
+                    # 取消，每次等待都会被再次打断，因此忽略这些取消直到任务结束，
+                    # 之后再重新抛出
+                    interrupted = False
+                    while not runner.done():
+                        try:
+                            await asyncio.wait([runner])
+                        except asyncio.CancelledError:
+                            interrupted = True
+                    cancellation_token.cancel()
+                    if interrupted:
+                        raise asyncio.CancelledError()
+
         # 保存到对话历史
-        if accumulated_content:
-            conversation_history.append({"role": "assistant", "content": accumulated_content})
+        if accumulated:
+            conversation_history.append("assistant", accumulated.text())
+            if accumulated.truncated:
+                logger.warning(f"回复超过 STREAM_MAX_CHARS，历史中只保留前 {len(accumulated)} 个字符")
         
         yield {"chunk": "", "type": "end"}
+    
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端断开连接：Runtime 会取消（或关闭）本生成器，上面的 finally
+        # 已取消 Agent 运行；未完成的回复不写入对话历史
+        run_stats["cancelled_runs"] += 1
+        logger.info("客户端已断开，已取消 Agent 运行")
+        raise
         
     except Exception as e:
         logger.error(f"流式处理错误: {str(e)}", exc_info=True)
         yield {"error": str(e), "type": "error"}
 
 
-async def _handle_non_streaming():
+async def _handle_non_streaming(conversation_history, deadline=None):
     """
     处理非流式请求 - 返回完整响应字典
     
     调用 Agent，提取响应，保存到对话历史
     """
-    if not AUTOGEN_AVAILABLE:
+    llm_policy.set_deadline(deadline)
+    if not await _ensure_framework():
         return {"result": "（模拟响应）AutoGen 未安装，请安装后使用完整功能。"}
     
     try:
-        agent = _create_agent()
-        
-        # 将对话历史转换为 AutoGen 消息格式
-        messages = []
-        for msg in conversation_history:
-            messages.append(TextMessage(content=msg["content"], source=msg["role"]))
+        # 获取 AutoGen 消息格式的对话历史（只转换新增消息）
+        messages = conversation_history.to_autogen_messages()
         
         # 创建 CancellationToken
         cancellation_token = CancellationToken()
 
-        # 运行 Agent
-        response_message = await agent.on_messages(messages, cancellation_token)
+        # 从池中借出 Agent 运行，结束后自动重置并归还
+        async with agent_pool.checkout() as agent:
+            response_message = await agent.on_messages(messages, cancellation_token)
         
         # 提取响应内容
         if response_message and hasattr(response_message, 'chat_message'):
@@ -219,7 +1352,7 @@ async def _handle_non_streaming():
             response = str(response_message) if response_message else "未生成响应"
         
         # 保存到对话历史
-        conversation_history.append({"role": "assistant", "content": response})
+        conversation_history.append("assistant", response)
         
         return {"result": response}
         
@@ -231,6 +1364,144 @@ async def _handle_non_streaming():
         }
 
 
+class AdmissionController:
+    """
+    限制沙箱内同时执行的 Agent 运行数
+
+    最多 `max_concurrent` 个运行同时执行；其余请求进入最多 `max_queue` 个位置的
+    先进先出队列，最长等待 `queue_timeout` 秒。队列已满或等待超时的请求会被拒绝，
+    客户端可以稍后重试或换一个沙箱。`max_concurrent=0` 表示不限制。
+    """
+
+    # 保留最近的排队耗时，用于 /ping 中的分位数
+    WAIT_SAMPLES = 1000
+
+    def __init__(self, max_concurrent=32, max_queue=64, queue_timeout=30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._avg_run_s = None  # 运行耗时的滑动平均
+        self._waits = deque(maxlen=self.WAIT_SAMPLES)
+        self._semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent > 0 else None
+
+    @property
+    def saturated(self):
+        """运行名额已用满、新请求需要排队时为 True"""
+        return self._semaphore is not None and (self.queued > 0 or self.in_flight >= self.max_concurrent)
+
+    async def acquire(self):
+        """等待运行名额，返回释放回调；被拒绝时返回 None"""
+        start = time.monotonic()
+        if self._semaphore is not None:
+            if not self._semaphore.locked():
+                await self._semaphore.acquire()
+            elif self.queued >= self.max_queue:
+                self.rejected += 1
+                return None
+            else:
+                self.queued += 1
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    return None
+                finally:
+                    self.queued -= 1
+        admitted_at = time.monotonic()
+        self._waits.append(admitted_at - start)
+        self.in_flight += 1
+        self.admitted += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.in_flight -= 1
+            duration = time.monotonic() - admitted_at
+            self._avg_run_s = duration if self._avg_run_s is None else 0.8 * self._avg_run_s + 0.2 * duration
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+        return release
+
+    def retry_after(self):
+        """被拒绝的客户端建议等待的秒数：约为排空队列所需的时间"""
+        if not self._avg_run_s or self._semaphore is None:
+            return 1
+        return max(1, math.ceil(self._avg_run_s * (self.queued + 1) / self.max_concurrent))
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def wait_ms(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p / 100))] * 1000, 1) if waits else 0.0
+
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms": {"p50": wait_ms(50), "p95": wait_ms(95), "max": wait_ms(100)},
+        }
+
+
+admission = AdmissionController(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_RUNS", "32")),
+    max_queue=int(os.getenv("MAX_QUEUED_RUNS", "64")),
+    queue_timeout=float(os.getenv("QUEUE_TIMEOUT", "30")),
+)
+
+
+async def _release_after(body_iterator, release):
+    """透传流式响应体，流结束时释放运行名额"""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        release()
+
+
+@app.middleware
+async def admission_control(request, call_next):
+    """
+    /invocations 请求的准入控制
+
+    被拒绝的请求返回 HTTP 429 和 Retry-After 头。流式响应在流结束时才释放名额，
+    而不是入口函数返回时。
+    """
+    release = await admission.acquire()
+    if release is None:
+        retry_after = admission.retry_after()
+        logger.warning(f"拒绝请求：{admission.in_flight} 个运行中，{admission.queued} 个排队")
+        return JSONResponse(
+            {"error": "当前请求过多，请稍后重试", "status": "error", "retry_after": retry_after},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)},
+        )
+    try:
+        response = await call_next(request)
+    except BaseException:
+        release()
+        raise
+    if isinstance(response, StreamingResponse):
+        # 客户端在流开始前断开时，由 finalizer 释放名额
+        weakref.finalize(response, release)
+        response.body_iterator = _release_after(response.body_iterator, release)
+    else:
+        release()
+    return response
+
+
 # 定义 PPIO Agent Runtime 入口点（支持异步）
 @app.entrypoint
 async def agent_invocation(request: dict, context: RequestContext):
@@ -241,6 +1512,7 @@ async def agent_invocation(request: dict, context: RequestContext):
         request: 请求数据，包含以下字段：
             - prompt: 用户输入的查询
             - streaming: 是否使用流式输出（可选，默认 False）
+            - session_id: 会话 ID（可选，不同会话的对话历史互相隔离）
         context: 请求上下文
             
     Returns:
@@ -250,15 +1522,20 @@ async def agent_invocation(request: dict, context: RequestContext):
         # 获取请求参数
         prompt = request.get("prompt", "你好！")
         streaming = request.get("streaming", False)
+        deadline = time.monotonic() + float(request.get("timeout") or REQUEST_TIMEOUT)
         
-        # 添加新用户消息到全局历史
-        conversation_history.append({"role": "user", "content": prompt})
+        # 获取当前会话的历史
+        session_id = _request_session_id(request, context)
+        conversation_history = await sessions.aget(session_id)
+        
+        # 添加新用户消息到会话历史
+        conversation_history.append("user", prompt)
         
         # 根据 streaming 参数选择处理函数
         if streaming:
-            return _handle_streaming()
+            return _handle_streaming(conversation_history, deadline)
         else:
-            return await _handle_non_streaming()
+            return await _handle_non_streaming(conversation_history, deadline)
     
     except Exception as e:
         logger.error(f"Agent 错误: {str(e)}", exc_info=True)
@@ -268,14 +1545,88 @@ async def agent_invocation(request: dict, context: RequestContext):
         }
 
 
+# 预热时用于演练工具的参数（工具均为本地函数，执行无副作用）
+WARM_UP_TOOL_ARGS = {
+    "get_weather": {"city": "北京"},
+    "search_information": {"query": "warm-up"},
+    "calculate": {"expression": "1 + 1"},
+}
+
+
+async def _exercise_tools():
+    """用示例参数执行一遍每个工具（绕过结果缓存，缓存统计只反映真实请求）"""
+    for tool in TOOLS:
+        await inspect.unwrap(tool)(**WARM_UP_TOOL_ARGS[tool.__name__])
+
+
+async def _prefill_agents():
+    """为每种流式模式预先创建一个 Agent（同时创建模型客户端和工具 schema）"""
+    agent_pool.prefill(streaming=False)
+    agent_pool.prefill(streaming=True)
+
+
+async def _prime_llm_connection():
+    """在共享连接池中建立到 LLM 服务的连接，不生成 token"""
+    client = AsyncOpenAI(base_url=LLM_BASE_URL, api_key=LLM_API_KEY, http_client=_get_http_client())
+    await client.with_options(timeout=WARM_UP_LLM_TIMEOUT).models.list()
+
+
+async def _warm_up_async():
+    """
+    完整的预热流程，在服务的事件循环上运行
+    
+    Agent 池和异步 HTTP 连接池都绑定在事件循环上，因此这些步骤必须在
+    这里完成，而不是在后台线程中。某个步骤失败只会记录下来，第一个
+    请求会按需重试；无论成功与否，预热结束后都报告就绪。
+    """
+    start = time.monotonic()
+    await asyncio.to_thread(warm_up)
+    await _warm_up_step_async("tools", _exercise_tools)
+    if AUTOGEN_AVAILABLE:
+        await _warm_up_step_async("agents", _prefill_agents)
+        if WARM_UP_LLM:
+            await _warm_up_step_async("llm_connection", _prime_llm_connection)
+    startup_stats["warm_up_s"] = round(time.monotonic() - start, 3)
+    logger.info(f"预热完成，耗时 {startup_stats['warm_up_s']} 秒，失败步骤 {len(startup_stats['errors'])} 个")
+
+
+def start_warm_up():
+    """在当前事件循环上启动预热任务（只启动一次）"""
+    global _warm_up_task
+    if _warm_up_task is None:
+        _warm_up_task = asyncio.get_running_loop().create_task(_warm_up_async())
+
+
+def is_ready():
+    """预热已完成，可以接收流量"""
+    return startup_stats["warm_up_s"] is not None
+
+
 @app.ping
-def health_check() -> dict:
+async def health_check() -> HealthStatus:
     """健康检查端点"""
-    return {
-        "status": "healthy",
-        "service": "AutoGen Agent",
-        "features": ["weather", "search", "calculate", "streaming", "multi-turn"]
-    }
+    # 第一次健康检查时启动预热；预热完成前返回 HealthyBusy，
+    # 编排系统只会把流量路由到已预热的沙箱
+    start_warm_up()
+    ready = is_ready()
+    saturated = admission.saturated
+    return HealthStatus(
+        # 运行名额用满时同样返回 HealthyBusy，编排系统据此扩容
+        status="healthy" if ready and not saturated else "healthybusy",
+        message="预热中" if not ready else "已满载" if saturated else None,
+        service="AutoGen Agent",
+        alive=True,
+        ready=ready,
+        features=["weather", "search", "calculate", "streaming", "multi-turn"],
+        sessions=sessions.stats(),
+        state=state_store.stats() if state_store is not None else {"backend": "memory"},
+        agent_pool=agent_pool.stats(),
+        runs=dict(run_stats),
+        admission=admission.stats(),
+        llm=llm_policy.snapshot(),
+        cache={"tools": tool_cache.stats(), "llm": llm_cache.stats() if llm_cache is not None else None},
+        startup=dict(startup_stats),
+    )
 
 
 if __name__ == "__main__":
@@ -286,5 +1637,7 @@ if __name__ == "__main__":
     print("💬 支持功能：流式输出、多轮对话")
     print("🔗 监听端口：8080")
     print("="*80 + "\n")
+    # 服务启动的同时在后台加载框架，其余预热步骤在第一次健康检查时于事件循环上完成
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
     app.run(port=8080)
 
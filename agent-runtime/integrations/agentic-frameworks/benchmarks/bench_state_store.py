@@ -0,0 +1,253 @@
+"""
+Conversation state store benchmark
+
+Writes a synthetic workload (many sessions, several turns each, two
+messages per turn) to the SQLiteStateStore from a sample and measures:
+
+- write amplification: bytes the process wrote to files (database, WAL
+  and checkpoints) per byte of message data
+- commits, i.e. fsyncs, and write throughput
+- restore: opening the store again and loading each session the way a
+  restarted sandbox does on first access
+
+Three write strategies are compared:
+
+- batched     the store as the samples use it, a background thread commits
+              every --flush-interval seconds
+- per-turn    flush() after every turn, one fsync per turn
+- snapshot    the whole conversation rewritten on every turn (one row per
+              session, batched like the store), the naive way to persist it
+
+The class is loaded straight from the sample's source, so the benchmark
+needs no sample dependencies. Byte counts come from /proc/self/io (Linux);
+elsewhere only file sizes are reported.
+
+Usage:
+    python bench_state_store.py --sessions 10000 --turns 10
+    python bench_state_store.py --sessions 1000 --strategies per-turn --sample autogen
+"""
+
+import argparse
+import ast
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+SOURCES = {
+    "langgraph": "app.py",
+    "autogen": "app.py",
+    "google-adk": "agent.py",
+}
+STRATEGIES = ("batched", "per-turn", "snapshot")
+WORDS = "the of and model agent stream token response context tool call result session turn".split()
+
+
+def load_store_class(sample):
+    """Exec only the SQLiteStateStore class from the sample's source"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", sample, SOURCES[sample])
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    node = next(n for n in tree.body if isinstance(n, ast.ClassDef) and n.name == "SQLiteStateStore")
+    namespace = {
+        "json": json, "sqlite3": sqlite3, "threading": threading, "time": time,
+        "logger": logging.getLogger("bench_state_store"),
+    }
+    exec(compile(ast.Module(body=[node], type_ignores=[]), path, "exec"), namespace)
+    return namespace["SQLiteStateStore"]
+
+
+def message(rng, chars):
+    words = []
+    length = 0
+    while length < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def turns(sessions, turns_per_session, chars, seed=0):
+    """(session_id, user message, assistant message) per turn, interleaving sessions like live traffic"""
+    rng = random.Random(seed)
+    return [
+        (
+            f"session-{session}",
+            {"role": "user", "content": message(rng, chars // 4)},
+            {"role": "assistant", "content": message(rng, chars)},
+        )
+        for _ in range(turns_per_session)
+        for session in range(sessions)
+    ]
+
+
+def io_written():
+    """Bytes this process has passed to write() so far, or None off Linux"""
+    try:
+        with open("/proc/self/io") as f:
+            return int(dict(line.split(": ") for line in f.read().splitlines())["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def db_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+def write_store(store_class, path, workload, strategy, flush_interval):
+    store = store_class(path, flush_interval=flush_interval)
+    logical = 0
+    for session_id, user, assistant in workload:
+        store.append(session_id, user)
+        store.append(session_id, assistant)
+        logical += len(json.dumps(user, ensure_ascii=False)) + len(json.dumps(assistant, ensure_ascii=False))
+        if strategy == "per-turn":
+            store.flush()
+    store.close()
+    return logical, store.commits
+
+
+class SnapshotStore:
+    """Baseline: one row per session, rewritten with the whole conversation on every turn"""
+
+    def __init__(self, path, flush_interval):
+        self.flush_interval = flush_interval
+        self.commits = 0
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS snapshots (session_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._conversations = {}
+        self._dirty = {}
+        self._last_flush = time.monotonic()
+
+    def append(self, session_id, record):
+        conversation = self._conversations.setdefault(session_id, [])
+        conversation.append(record)
+        self._dirty[session_id] = json.dumps(conversation, ensure_ascii=False)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._dirty:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO snapshots VALUES (?, ?)", self._dirty.items())
+            self._db.execute("COMMIT")
+            self.commits += 1
+            self._dirty = {}
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def restore_store(store_class, path, sessions, limit):
+    start = time.perf_counter()
+    store = store_class(path)
+    opened = time.perf_counter() - start
+    order = list(range(sessions))
+    random.Random(1).shuffle(order)
+    timings = []
+    for session in order:
+        start = time.perf_counter()
+        records = store.load(f"session-{session}", limit=limit)
+        timings.append(time.perf_counter() - start)
+        assert records, f"session-{session} was not restored"
+    store.close()
+    return opened, timings
+
+
+def restore_snapshots(path, sessions, limit):
+    start = time.perf_counter()
+    db = sqlite3.connect(path)
+    opened = time.perf_counter() - start
+    order = list(range(sessions))
+    random.Random(1).shuffle(order)
+    timings = []
+    for session in order:
+        start = time.perf_counter()
+        row = db.execute("SELECT data FROM snapshots WHERE session_id = ?", (f"session-{session}",)).fetchone()
+        records = json.loads(row[0])[-limit:] if limit else json.loads(row[0])
+        timings.append(time.perf_counter() - start)
+        assert records
+    db.close()
+    return opened, timings
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(strategy, store_class, args, directory, workload):
+    path = os.path.join(directory, f"{strategy}.db")
+    written_before = io_written()
+    start = time.perf_counter()
+    if strategy == "snapshot":
+        store = SnapshotStore(path, args.flush_interval)
+        logical = 0
+        for session_id, user, assistant in workload:
+            store.append(session_id, user)
+            store.append(session_id, assistant)
+            logical += len(json.dumps(user, ensure_ascii=False)) + len(json.dumps(assistant, ensure_ascii=False))
+        store.close()
+        commits = store.commits
+    else:
+        logical, commits = write_store(store_class, path, workload, strategy, args.flush_interval)
+    write_s = time.perf_counter() - start
+    written = io_written() - written_before if written_before is not None else None
+
+    if strategy == "snapshot":
+        opened, timings = restore_snapshots(path, args.sessions, args.limit)
+    else:
+        opened, timings = restore_store(store_class, path, args.sessions, args.limit)
+
+    total_turns = args.sessions * args.turns
+    amplification = f"{written / logical:5.2f}x" if written is not None else "  n/a"
+    print(f"{strategy:<9} write {write_s:7.2f} s ({total_turns / write_s:8.0f} turns/s)  "
+          f"commits {commits:7d}  written/data {amplification}  file {db_size(path) / 2**20:7.1f} MiB")
+    print(f"{'':<9} restore: open {opened * 1000:6.2f} ms, per session p50 {percentile(timings, 0.5) * 1000:.3f} ms  "
+          f"p95 {percentile(timings, 0.95) * 1000:.3f} ms  max {max(timings) * 1000:.3f} ms  "
+          f"all {args.sessions} sessions {sum(timings):.2f} s (mean {statistics.mean(timings) * 1000:.3f} ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conversation state store benchmark")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--turns", type=int, default=10, help="turns per session (two messages each)")
+    parser.add_argument("--message-chars", type=int, default=400, help="assistant message size; user messages are 1/4")
+    parser.add_argument("--flush-interval", type=float, default=0.05)
+    parser.add_argument("--limit", type=int, default=50, help="messages loaded per session on restore, 0 = all")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help="comma-separated, from: " + ", ".join(STRATEGIES))
+    parser.add_argument("--sample", choices=sorted(SOURCES), default="langgraph")
+    parser.add_argument("--dir", help="directory for the database files (default: a temporary directory)")
+    args = parser.parse_args()
+    args.limit = args.limit or None
+
+    store_class = load_store_class(args.sample)
+    directory = args.dir or tempfile.mkdtemp(prefix="bench_state_store_")
+    os.makedirs(directory, exist_ok=True)
+
+    print("\n" + "=" * 80)
+    print(f"🚀 State store: {args.sessions} sessions x {args.turns} turns, "
+          f"~{args.message_chars} char replies, SQLiteStateStore from {args.sample}")
+    print(f"   files in {directory}")
+    print("=" * 80)
+    workload = turns(args.sessions, args.turns, args.message_chars)
+    try:
+        for strategy in args.strategies.split(","):
+            run(strategy.strip(), store_class, args, directory, workload)
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Streaming accumulation benchmark
+
+Compares ways of collecting a long streamed response, one chunk per token:
+
+- str += (local)   old _handle_streaming in langgraph/autogen; CPython can
+                   often resize the string in place here
+- str += (dict)    same concatenation on a dict item (e.g. tool-call
+                   arguments); no in-place resize, so quadratic
+- list + join      every chunk kept until the end
+- accumulator      StreamAccumulator from the sample's app.py
+
+Chunks are created as new strings while streaming, like real model deltas.
+The class is loaded straight from app.py, so the benchmark needs no sample
+dependencies.
+
+Usage:
+    python bench_stream_accumulator.py --tokens 50000
+    python bench_stream_accumulator.py --tokens 50000 --cjk --sample autogen
+"""
+
+import argparse
+import ast
+import os
+import random
+import time
+import tracemalloc
+
+SAMPLES = ("langgraph", "autogen", "openai-agents-sdk")
+ASCII_WORDS = "the of and model agent stream token response context tool call result".split()
+CJK_WORDS = "模型 代理 流式 输出 工具 调用 结果 上下文 响应 会话 天气 计算".split()
+
+
+def load_accumulator(sample):
+    """Exec only the StreamAccumulator class from <sample>/app.py"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", sample, "app.py")
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    node = next(n for n in tree.body if isinstance(n, ast.ClassDef) and n.name == "StreamAccumulator")
+    namespace = {}
+    exec(compile(ast.Module(body=[node], type_ignores=[]), path, "exec"), namespace)
+    return namespace["StreamAccumulator"]
+
+
+def chunks(words, tokens, seed=0):
+    rng = random.Random(seed)
+    for _ in range(tokens):
+        yield rng.choice(words) + " "  # a fresh string per delta
+
+
+def concat_local(stream):
+    text = ""
+    for chunk in stream:
+        text += chunk
+    return text
+
+
+def concat_dict(stream):
+    call = {"arguments": ""}
+    for chunk in stream:
+        call["arguments"] += chunk
+    return call["arguments"]
+
+
+def list_join(stream):
+    parts = []
+    for chunk in stream:
+        parts.append(chunk)
+    return "".join(parts)
+
+
+def make_accumulate(accumulator_class):
+    def accumulate(stream):
+        accumulated = accumulator_class()
+        for chunk in stream:
+            accumulated.append(chunk)
+        return accumulated.text()
+    return accumulate
+
+
+def measure(func, words, tokens, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        result = func(chunks(words, tokens))
+        best = min(best, time.process_time() - start)
+    
+    tracemalloc.start()
+    func(chunks(words, tokens))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming accumulation benchmark")
+    parser.add_argument("--tokens", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--cjk", action="store_true", help="use non-ASCII (Chinese) tokens")
+    parser.add_argument("--sample", choices=SAMPLES, default="langgraph")
+    args = parser.parse_args()
+    
+    words = CJK_WORDS if args.cjk else ASCII_WORDS
+    cases = [
+        ("str += (local)", concat_local),
+        ("str += (dict)", concat_dict),
+        ("list + join", list_join),
+        ("accumulator", make_accumulate(load_accumulator(args.sample))),
+    ]
+    
+    print("\n" + "=" * 80)
+    print(f"🚀 Streaming accumulation: {args.tokens} tokens, {'CJK' if args.cjk else 'ASCII'}, "
+          f"StreamAccumulator from {args.sample}")
+    print("=" * 80)
+    for name, func in cases:
+        cpu, peak, chars = measure(func, words, args.tokens, args.repeat)
+        print(f"{name:<16} cpu {cpu * 1000:9.2f} ms   peak {peak / 1024:9.1f} KiB   ({chars} chars)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Stalled stream deadline check
+
+For each sample, starts `python app.py` with `REQUEST_TIMEOUT=--deadline`
+against a stub LLM whose streamed replies stop after `--stall-after` tokens
+and stay silent for far longer than the deadline. A streaming request must
+then end with an error event once the deadline passes, not when the HTTP
+read timeout does: the check passes when it gets the first chunks, an error
+event within `--deadline` + `--grace` seconds, and `/ping` counts exactly
+one new `llm.deadline_exceeded`.
+
+Run it with an interpreter that has the samples' requirements (and httpx)
+installed. Exits with status 1 if any sample fails.
+
+Usage:
+    python check_deadline.py                        # autogen, openai-agents-sdk
+    python check_deadline.py autogen --deadline 3
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+import httpx
+
+import stub_llm
+from load_test import APP_URL, SampleProcess, sample_env
+
+# Samples that read streamed model replies through their LLM call policy
+SAMPLES = ("autogen", "openai-agents-sdk")
+
+
+def deadline_hits(client):
+    return client.get(f"{APP_URL}/ping").json()["llm"]["deadline_exceeded"]
+
+
+def stream_until_end(client):
+    """
+    Read a streaming request to the end; returns (content events, error event
+    or None). Gives up, without an error event, when the client times out.
+    """
+    body = {"prompt": "Tell me a long story.", "streaming": True, "session_id": "deadline-check"}
+    received, error = 0, None
+    try:
+        with client.stream("POST", f"{APP_URL}/invocations", json=body) as response:
+            for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                try:
+                    event = json.loads(line[5:])
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(event, dict):
+                    continue
+                if event.get("type") == "content":
+                    received += 1
+                elif event.get("type") == "error":
+                    error = event.get("error")
+    except httpx.ReadTimeout:
+        pass
+    return received, error
+
+
+def check_sample(sample, args, stub, log_dir):
+    env = sample_env(sample, stub.url)
+    env.update(WARM_UP_LLM="false", REQUEST_TIMEOUT=str(args.deadline))
+    process = SampleProcess(sample, args.python, env, log_dir)
+    try:
+        process.wait_ready(args.ready_timeout)
+        with httpx.Client(timeout=args.deadline + args.grace) as client:
+            before = deadline_hits(client)
+            start = time.monotonic()
+            received, error = stream_until_end(client)
+            elapsed = time.monotonic() - start
+            hits = deadline_hits(client) - before
+        ok = received > 0 and error is not None and hits == 1 and elapsed <= args.deadline + args.grace
+        print(f"{sample:<18} {'ok' if ok else 'FAILED':<7} chunks {received}  deadline_exceeded {hits}  "
+              f"ended after {elapsed:.2f} s  error {error!r}")
+        if not ok:
+            print(f"--- {sample} log ({process.log_path}) ---\n{process.log_tail()}", file=sys.stderr)
+        return ok
+    finally:
+        process.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that a stream stalling midway fails at the request deadline")
+    parser.add_argument("samples", nargs="*", help=f"samples to check (default: {', '.join(SAMPLES)})")
+    parser.add_argument("--deadline", type=float, default=2, help="REQUEST_TIMEOUT given to the sample")
+    parser.add_argument("--grace", type=float, default=1, help="seconds allowed past the deadline")
+    parser.add_argument("--stall-after", type=int, default=3, help="tokens the stub sends before stalling")
+    parser.add_argument("--stall", type=float, default=30, help="seconds the stub stalls for")
+    parser.add_argument("--stub-port", type=int, default=18999)
+    parser.add_argument("--ready-timeout", type=float, default=120)
+    parser.add_argument("--python", default=sys.executable, help="interpreter with the samples' dependencies")
+    args = parser.parse_args()
+    for sample in args.samples:
+        if sample not in SAMPLES:
+            parser.error(f"unknown sample {sample!r} (choose from {', '.join(SAMPLES)})")
+
+    try:
+        httpx.get(f"{APP_URL}/ping", timeout=1)
+        parser.error(f"something is already listening on {APP_URL}; stop it first")
+    except httpx.HTTPError:
+        pass
+
+    stub = stub_llm.StubLLMServer(
+        "127.0.0.1", args.stub_port, ttft=0.1, token_latency=0.05, tokens=24,
+        stall_after=args.stall_after, stall=args.stall,
+    ).start()
+    print(f"Stub LLM on {stub.url}: streams stall for {args.stall:.0f} s after {args.stall_after} tokens, "
+          f"deadline {args.deadline:.0f} s\n")
+    failed = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="deadline-check-") as log_dir:
+            for sample in args.samples or SAMPLES:
+                if not check_sample(sample, args, stub, log_dir):
+                    failed.append(sample)
+    finally:
+        stub.stop()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
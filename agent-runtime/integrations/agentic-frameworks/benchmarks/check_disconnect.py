@@ -0,0 +1,121 @@
+"""
+Client disconnect check
+
+For each sample, starts `python app.py` against a slow stub LLM stream
+(`--tokens` words, `--token-latency` seconds apart), opens a streaming
+request, reads `--chunks` content events and drops the connection. The
+sample must then close its upstream stream: the check passes when the stub
+counts exactly one disconnected request and has nothing in flight within
+`--within` seconds, well before the stream would have finished by itself.
+
+Run it with an interpreter that has the samples' requirements (and httpx)
+installed. Exits with status 1 if any sample fails.
+
+Usage:
+    python check_disconnect.py                      # langgraph, autogen, openai-agents-sdk
+    python check_disconnect.py langgraph --within 2
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+
+import httpx
+
+import stub_llm
+from load_test import APP_URL, SampleProcess, sample_env
+
+# google-adk streams from Gemini through google-genai, not from the stub's
+# OpenAI endpoint, so it is not covered by default
+SAMPLES = ("langgraph", "autogen", "openai-agents-sdk")
+
+
+async def stream_and_drop(chunks):
+    """Read `chunks` content events from a streaming request, then disconnect"""
+    body = {"prompt": "Tell me a long story.", "streaming": True, "session_id": "disconnect-check"}
+    received = 0
+    async with httpx.AsyncClient(timeout=30) as client:
+        async with client.stream("POST", f"{APP_URL}/invocations", json=body) as response:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                try:
+                    event = json.loads(line[5:])
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(event, dict) and event.get("type") == "content":
+                    received += 1
+                    if received >= chunks:
+                        break
+    return received
+
+
+def check_sample(sample, args, stub, log_dir):
+    env = sample_env(sample, stub.url)
+    env.update(WARM_UP_LLM="false")
+    process = SampleProcess(sample, args.python, env, log_dir)
+    try:
+        process.wait_ready(args.ready_timeout)
+        before = stub.stats()
+        received = asyncio.run(stream_and_drop(args.chunks))
+        dropped_at = time.monotonic()
+        while True:
+            stats = stub.stats()
+            disconnected = stats["disconnected"] - before["disconnected"]
+            elapsed = time.monotonic() - dropped_at
+            if stats["in_flight"] == 0 or elapsed >= args.within:
+                break
+            time.sleep(0.1)
+        ok = received == args.chunks and disconnected == 1 and stats["in_flight"] == 0
+        print(f"{sample:<18} {'ok' if ok else 'FAILED':<7} chunks {received}  disconnected {disconnected}  "
+              f"in_flight {stats['in_flight']}  upstream closed after {elapsed:.2f} s")
+        if not ok:
+            print(f"--- {sample} log ({process.log_path}) ---\n{process.log_tail()}", file=sys.stderr)
+        return ok
+    finally:
+        process.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that a client disconnect closes the upstream LLM stream")
+    parser.add_argument("samples", nargs="*", help=f"samples to check (default: {', '.join(SAMPLES)})")
+    parser.add_argument("--chunks", type=int, default=3, help="content events to read before disconnecting")
+    parser.add_argument("--within", type=float, default=3, help="seconds allowed for the upstream to close")
+    parser.add_argument("--tokens", type=int, default=24, help="words in the stub's reply")
+    parser.add_argument("--token-latency", type=float, default=0.5, help="seconds between the stub's tokens")
+    parser.add_argument("--stub-port", type=int, default=18999)
+    parser.add_argument("--ready-timeout", type=float, default=120)
+    parser.add_argument("--python", default=sys.executable, help="interpreter with the samples' dependencies")
+    args = parser.parse_args()
+    for sample in args.samples:
+        if sample not in SAMPLES:
+            parser.error(f"unknown sample {sample!r} (choose from {', '.join(SAMPLES)})")
+
+    try:
+        httpx.get(f"{APP_URL}/ping", timeout=1)
+        parser.error(f"something is already listening on {APP_URL}; stop it first")
+    except httpx.HTTPError:
+        pass
+
+    stub = stub_llm.StubLLMServer(
+        "127.0.0.1", args.stub_port, ttft=0.1, token_latency=args.token_latency, tokens=args.tokens,
+    ).start()
+    print(f"Stub LLM on {stub.url}: {args.tokens} tokens, {args.token_latency}s apart "
+          f"(~{args.tokens * args.token_latency:.0f} s per stream)\n")
+    failed = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="disconnect-check-") as log_dir:
+            for sample in args.samples or SAMPLES:
+                if not check_sample(sample, args, stub, log_dir):
+                    failed.append(sample)
+    finally:
+        stub.stop()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Session isolation check
+
+For each sample, starts `python app.py` against the stub LLM and sends
+requests the way the PPIO client SDK does: only the body the caller passes,
+with no `sandbox_id`. Two conversations name a `session_id` in the body,
+a third names none. Checks:
+
+- isolation: `/ping` reports three separate histories, one per named
+  session plus the shared default one
+- overlap: two concurrent requests that name no session run at the same
+  time instead of queueing behind each other
+- ordering (langgraph): two concurrent requests for the same session run
+  one after the other
+
+Run it with an interpreter that has the samples' requirements (and httpx)
+installed. Exits with status 1 if any sample fails.
+
+Usage:
+    python check_sessions.py                        # langgraph, autogen
+    python check_sessions.py langgraph
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+import stub_llm
+from load_test import APP_URL, SampleProcess, sample_env
+
+# Samples that keep per-session conversation history, and the /ping field
+# reporting it
+SAMPLES = {"langgraph": "history", "autogen": "sessions"}
+# Samples that run the turns of one session in order
+ORDERED = {"langgraph"}
+
+
+def invoke(client, prompt, session_id=None):
+    body = {"prompt": prompt, "streaming": False}
+    if session_id is not None:
+        body["session_id"] = session_id
+    response = client.post(f"{APP_URL}/invocations", json=body)
+    response.raise_for_status()
+
+
+def check_isolation(sample, client):
+    """Two named sessions and requests without one give three histories"""
+    for session_id in ("alice", "bob", "alice", None, None):
+        invoke(client, "Hello, remember my name.", session_id)
+    sessions = client.get(f"{APP_URL}/ping").json()[SAMPLES[sample]]["sessions"]
+    return sessions == 3, f"sessions {sessions} (expected 3)"
+
+
+def timed_pair(client, session_id):
+    """Seconds taken by two concurrent requests for `session_id`"""
+    start = time.monotonic()
+    with ThreadPoolExecutor(2) as pool:
+        for future in [pool.submit(invoke, client, "Tell me a story.", session_id) for _ in range(2)]:
+            future.result()
+    return time.monotonic() - start
+
+
+def check_concurrency(client, session_id, ordered):
+    """Two concurrent requests take about one request's time, or two if `ordered`"""
+    invoke(client, "Tell me a story.", session_id)
+    start = time.monotonic()
+    invoke(client, "Tell me a story.", session_id)
+    single = time.monotonic() - start
+    pair = timed_pair(client, session_id)
+    ratio = pair / single
+    passed = ratio >= 1.8 if ordered else ratio < 1.5
+    return passed, f"one request {single:.2f} s, two concurrent {pair:.2f} s ({ratio:.1f}x)"
+
+
+def check_sample(sample, args, stub, log_dir):
+    env = sample_env(sample, stub.url)
+    env.update(WARM_UP_LLM="false")
+    process = SampleProcess(sample, args.python, env, log_dir)
+    try:
+        process.wait_ready(args.ready_timeout)
+        results = []
+        with httpx.Client(timeout=60) as client:
+            results.append(("isolation", *check_isolation(sample, client)))
+            results.append(("overlap", *check_concurrency(client, None, ordered=False)))
+            if sample in ORDERED:
+                results.append(("ordering", *check_concurrency(client, "carol", ordered=True)))
+        ok = all(passed for _, passed, _ in results)
+        for name, passed, detail in results:
+            print(f"{sample:<10} {name:<10} {'ok' if passed else 'FAILED':<7} {detail}")
+        if not ok:
+            print(f"--- {sample} log ({process.log_path}) ---\n{process.log_tail()}", file=sys.stderr)
+        return ok
+    finally:
+        process.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that sessions named in the request body stay separate")
+    parser.add_argument("samples", nargs="*", help=f"samples to check (default: {', '.join(SAMPLES)})")
+    parser.add_argument("--stub-port", type=int, default=18999)
+    parser.add_argument("--ready-timeout", type=float, default=120)
+    parser.add_argument("--python", default=sys.executable, help="interpreter with the samples' dependencies")
+    args = parser.parse_args()
+    for sample in args.samples:
+        if sample not in SAMPLES:
+            parser.error(f"unknown sample {sample!r} (choose from {', '.join(SAMPLES)})")
+
+    try:
+        httpx.get(f"{APP_URL}/ping", timeout=1)
+        parser.error(f"something is already listening on {APP_URL}; stop it first")
+    except httpx.HTTPError:
+        pass
+
+    stub = stub_llm.StubLLMServer("127.0.0.1", args.stub_port, ttft=0.1, token_latency=0.03, tokens=20).start()
+    failed = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="session-check-") as log_dir:
+            for sample in args.samples or SAMPLES:
+                if not check_sample(sample, args, stub, log_dir):
+                    failed.append(sample)
+    finally:
+        stub.stop()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
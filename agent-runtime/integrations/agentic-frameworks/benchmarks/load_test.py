@@ -0,0 +1,373 @@
+"""
+Load test of the framework samples
+
+For each sample, starts `python app.py` locally against the stub LLM server
+(stub_llm.py), waits until /ping reports ready, then drives /invocations with
+`--concurrency` clients in non-streaming and streaming mode. Each client uses
+its own session. Reports per mode:
+
+- rps             completed requests per second
+- latency         p50/p95/p99 of the full request time
+- ttfc            time to first chunk (first SSE event; for non-streaming
+                  requests the full response)
+- chunk_gap       p50/p95/p99/max gap between consecutive SSE events
+
+Results can be written as JSON and compared against an earlier run; the
+comparison exits with status 1 if a metric regressed by more than
+`--threshold` percent.
+
+Run it with an interpreter that has the samples' requirements (and httpx)
+installed. The samples listen on port 8080, so they are run one at a time.
+
+Usage:
+    python load_test.py                                  # all samples
+    python load_test.py langgraph autogen --concurrency 16 --requests 400
+    python load_test.py --modes streaming --json results.json
+    python load_test.py --json new.json --compare results.json
+    python load_test.py autogen --script stub_scripts/calculate.json --profile fast
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import stub_llm
+
+SAMPLES = ("langgraph", "autogen", "openai-agents-sdk", "google-adk")
+MODES = ("non-streaming", "streaming")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_URL = "http://127.0.0.1:8080"
+PROMPT = "What is the capital of France?"
+
+# Metrics compared by --compare; True if higher is better
+COMPARED_METRICS = {
+    ("rps",): True,
+    ("latency_ms", "p50"): False,
+    ("latency_ms", "p95"): False,
+    ("ttfc_ms", "p50"): False,
+    ("ttfc_ms", "p95"): False,
+}
+
+
+def sample_env(sample, stub_url):
+    """Environment that points a sample at the stub server"""
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    if sample == "google-adk":
+        env.update(GOOGLE_GEMINI_BASE_URL=stub_url, GOOGLE_API_KEY="stub-key")
+    elif sample == "openai-agents-sdk":
+        env.update(OPENAI_API_BASE=f"{stub_url}/v1", PPIO_API_KEY="stub-key")
+    else:
+        env.update(OPENAI_BASE_URL=f"{stub_url}/v1", OPENAI_API_KEY="stub-key", PPIO_API_KEY="stub-key")
+    return env
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """Linear-interpolated percentiles in milliseconds, plus max"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    result = {}
+    for p in points:
+        rank = (len(ordered) - 1) * p / 100
+        low = int(rank)
+        high = min(low + 1, len(ordered) - 1)
+        result[f"p{p}"] = round((ordered[low] + (ordered[high] - ordered[low]) * (rank - low)) * 1000, 2)
+    result["max"] = round(ordered[-1] * 1000, 2)
+    return result
+
+
+class SampleProcess:
+    """A sample's app.py running in a subprocess, logging to a temp file"""
+
+    def __init__(self, sample, python, env, log_dir):
+        self.sample = sample
+        self.log_path = os.path.join(log_dir, f"{sample}.log")
+        self._log = open(self.log_path, "w")
+        self.proc = subprocess.Popen(
+            [python, "app.py"], cwd=os.path.join(ROOT, sample), env=env,
+            stdout=self._log, stderr=subprocess.STDOUT,
+        )
+
+    def wait_ready(self, timeout):
+        """Poll /ping until the sample reports ready"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"exited with status {self.proc.returncode}")
+            try:
+                ping = httpx.get(f"{APP_URL}/ping", timeout=2).json()
+                if ping.get("ready", ping.get("status") == "Healthy"):
+                    return ping
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.25)
+        raise RuntimeError(f"not ready after {timeout}s")
+
+    def log_tail(self, lines=20):
+        with open(self.log_path, errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self._log.close()
+
+
+def _failed(payload):
+    """Whether an /invocations JSON body or SSE event reports an error"""
+    if not isinstance(payload, dict):
+        return False
+    if payload.get("error") or payload.get("type") == "error":
+        return True
+    result = payload.get("result")
+    return isinstance(result, dict) and bool(result.get("error"))
+
+
+async def invoke(client, session_id, streaming):
+    """
+    Send one request and time it. Like the PPIO client SDK, only the body is
+    sent; the session is named by its "session_id" field, or not at all when
+    `session_id` is None.
+
+    Returns (latency_s, ttfc_s, chunk_gaps_s, ok).
+    """
+    body = {"prompt": PROMPT, "streaming": streaming}
+    if session_id is not None:
+        body["session_id"] = session_id
+    start = time.perf_counter()
+    if not streaming:
+        response = await client.post(f"{APP_URL}/invocations", json=body)
+        latency = time.perf_counter() - start
+        ok = response.status_code == 200 and not _failed(response.json())
+        return latency, latency, [], ok
+
+    ttfc = None
+    gaps = []
+    last = None
+    ok = True
+    async with client.stream("POST", f"{APP_URL}/invocations", json=body) as response:
+        ok = response.status_code == 200
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            now = time.perf_counter()
+            if ttfc is None:
+                ttfc = now - start
+            else:
+                gaps.append(now - last)
+            last = now
+            try:
+                ok = ok and not _failed(json.loads(line[5:]))
+            except json.JSONDecodeError:
+                pass
+    latency = time.perf_counter() - start
+    return latency, ttfc if ttfc is not None else latency, gaps, ok and ttfc is not None
+
+
+async def run_mode(sample, streaming, concurrency, requests, warmup, sessions=True):
+    """Drive one sample in one mode; returns the summary dict"""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+        # Warm-up requests are not counted (first graph/agent use, connection setup)
+        await asyncio.gather(*(
+            invoke(client, f"bench-{sample}-warmup-{i}" if sessions else None, streaming) for i in range(warmup)
+        ))
+
+        latencies, ttfcs, gaps = [], [], []
+        errors = 0
+        remaining = requests
+
+        async def worker(index):
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                session_id = f"bench-{sample}-{index}" if sessions else None
+                latency, ttfc, chunk_gaps, ok = await invoke(client, session_id, streaming)
+                if not ok:
+                    errors += 1
+                latencies.append(latency)
+                ttfcs.append(ttfc)
+                gaps.extend(chunk_gaps)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 2),
+        "latency_ms": percentiles(latencies),
+        "ttfc_ms": percentiles(ttfcs),
+        "chunk_gap_ms": percentiles(gaps) if streaming else None,
+    }
+
+
+def run_sample(sample, args, stub_url, log_dir):
+    env = sample_env(sample, stub_url)
+    env.update(dict(item.split("=", 1) for item in args.env))
+    process = SampleProcess(sample, args.python, env, log_dir)
+    try:
+        startup_start = time.monotonic()
+        process.wait_ready(args.ready_timeout)
+        results = {"ready_s": round(time.monotonic() - startup_start, 3)}
+        for mode in args.modes:
+            results[mode] = asyncio.run(run_mode(
+                sample, mode == "streaming", args.concurrency, args.requests, args.warmup,
+                sessions=not args.no_session,
+            ))
+            print_result(sample, mode, results[mode])
+        return results
+    except Exception:
+        print(f"--- {sample} log ({process.log_path}) ---\n{process.log_tail()}", file=sys.stderr)
+        raise
+    finally:
+        process.stop()
+
+
+def print_result(sample, mode, result):
+    def fmt(stats):
+        return "-" if not stats else f"{stats['p50']:.0f}/{stats['p95']:.0f}/{stats['p99']:.0f}"
+
+    print(
+        f"{sample:<18} {mode:<14} {result['rps']:>8.1f} {fmt(result['latency_ms']):>18} "
+        f"{fmt(result['ttfc_ms']):>18} {fmt(result['chunk_gap_ms']):>14} {result['errors']:>6}"
+    )
+
+
+def _metric(results, sample, mode, path):
+    value = results.get(sample, {}).get(mode)
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(current, baseline, threshold):
+    """Print changes against a baseline run; return the number of regressions"""
+    regressions = 0
+    print(f"\nComparison with baseline (threshold {threshold:g}%):")
+    for sample in current:
+        for mode in MODES:
+            for path, higher_is_better in COMPARED_METRICS.items():
+                new = _metric(current, sample, mode, path)
+                old = _metric(baseline, sample, mode, path)
+                if not new or not old:
+                    continue
+                change = (new - old) / old * 100
+                worse = -change if higher_is_better else change
+                flag = ""
+                if worse > threshold:
+                    flag = "  REGRESSION"
+                    regressions += 1
+                print(f"  {sample:<18} {mode:<14} {'.'.join(path):<16} {old:>10} -> {new:<10} ({change:+.1f}%){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the samples against a stub LLM")
+    parser.add_argument("samples", nargs="*", help=f"samples to test (default: all of {', '.join(SAMPLES)})")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), help="non-streaming and/or streaming")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per mode")
+    parser.add_argument("--warmup", type=int, default=4, help="unmeasured requests per mode")
+    parser.add_argument("--no-session", action="store_true",
+                        help="send no session_id, so every request uses the sample's default session")
+    parser.add_argument("--stub-port", type=int, default=18999)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the samples (repeatable)")
+    parser.add_argument("--ready-timeout", type=float, default=120)
+    parser.add_argument("--python", default=sys.executable, help="interpreter with the samples' dependencies")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline JSON file from an earlier run")
+    parser.add_argument("--threshold", type=float, default=10, help="regression threshold in percent")
+    stub_llm.add_arguments(parser.add_argument_group("stub LLM server"))
+    args = parser.parse_args()
+    for sample in args.samples:
+        if sample not in SAMPLES:
+            parser.error(f"unknown sample {sample!r} (choose from {', '.join(SAMPLES)})")
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode!r} (choose from {', '.join(MODES)})")
+    for item in args.env:
+        if "=" not in item:
+            parser.error(f"--env expects KEY=VALUE, got {item!r}")
+
+    try:
+        httpx.get(f"{APP_URL}/ping", timeout=1)
+        parser.error(f"something is already listening on {APP_URL}; stop it first")
+    except httpx.HTTPError:
+        pass
+
+    stub = stub_llm.server_from_args(args, port=args.stub_port).start()
+    print(f"Stub LLM on {stub.url}: profile={args.profile} ttft={stub.ttft}s "
+          f"token_latency={stub.token_latency}s script={args.script or '-'}")
+    print(f"{args.concurrency} clients, {args.requests} requests per mode "
+          f"(latency / ttfc / chunk gap as p50/p95/p99 ms)\n")
+    print(f"{'sample':<18} {'mode':<14} {'rps':>8} {'latency':>18} {'ttfc':>18} {'chunk gap':>14} {'errors':>6}")
+
+    results = {}
+    failed = []
+    with tempfile.TemporaryDirectory(prefix="load-test-") as log_dir:
+        for sample in args.samples or SAMPLES:
+            try:
+                results[sample] = run_sample(sample, args, stub.url, log_dir)
+            except Exception as e:
+                failed.append(sample)
+                print(f"{sample:<18} failed: {e}")
+    stub_stats = stub.stats()
+    stub.stop()
+
+    if args.json:
+        report = {
+            "config": {
+                "concurrency": args.concurrency,
+                "requests": args.requests,
+                "warmup": args.warmup,
+                "no_session": args.no_session,
+                "stub": {
+                    "profile": args.profile,
+                    "ttft_s": stub.ttft,
+                    "token_latency_s": stub.token_latency,
+                    "tokens": args.tokens,
+                    "script": args.script,
+                    "jitter": args.jitter,
+                    "seed": args.seed,
+                    "max_concurrency": args.max_concurrency,
+                    "fail_every": args.fail_every,
+                },
+                "env": args.env,
+            },
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "stub_stats": stub_stats,
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Import-time profile of the framework samples
+
+Runs `python -X importtime -c "import app"` inside each sample directory and
+reports the total time to import app.py and the top-level packages that
+dominate it. Each module's self time is charged to its top-level package, so
+nothing is counted twice.
+
+Run it with the interpreter of an environment that has the sample's
+requirements installed. Samples whose dependencies are missing are reported
+as failed.
+
+Usage:
+    python profile_imports.py                    # all samples
+    python profile_imports.py langgraph --top 15
+    python profile_imports.py --json results.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+SAMPLES = ("langgraph", "autogen", "openai-agents-sdk", "google-adk")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def profile(sample, python):
+    """Return (wall_s, {top_level_package: self_us}) for importing app.py"""
+    cwd = os.path.join(ROOT, sample)
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    code = "import time; t = time.perf_counter(); import app; print('WALL', time.perf_counter() - t)"
+    proc = subprocess.run(
+        [python, "-X", "importtime", "-c", code],
+        cwd=cwd, env=env, capture_output=True, text=True, timeout=600,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+    
+    wall = next(float(line.split()[1]) for line in proc.stdout.splitlines() if line.startswith("WALL "))
+    packages = defaultdict(int)
+    for line in proc.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us)
+    return wall, dict(packages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time profile of the samples")
+    parser.add_argument("samples", nargs="*", help=f"samples to profile (default: all of {', '.join(SAMPLES)})")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--python", default=sys.executable, help="interpreter with the sample's dependencies")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+    for sample in args.samples:
+        if sample not in SAMPLES:
+            parser.error(f"unknown sample {sample!r}, choose from {', '.join(SAMPLES)}")
+    
+    results = {}
+    for sample in args.samples or SAMPLES:
+        print("\n" + "=" * 80)
+        print(f"📦 {sample}")
+        print("=" * 80)
+        try:
+            wall, packages = profile(sample, args.python)
+        except Exception as e:
+            print(f"❌ failed: {e}")
+            results[sample] = {"error": str(e)}
+            continue
+        
+        top = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]
+        print(f"import app: {wall * 1000:.0f} ms")
+        for name, micros in top:
+            print(f"  {name:<32} {micros / 1000:8.1f} ms")
+        results[sample] = {"import_ms": round(wall * 1000, 1), "top": {name: round(us / 1000, 1) for name, us in top}}
+    
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+"""
+Deterministic stub LLM server for offline testing and benchmarks
+
+Speaks just enough of the OpenAI chat-completions API and the Gemini
+generateContent API for the framework samples to run without network access
+or API keys:
+
+- POST .../chat/completions                   (stream and non-stream, tool calls)
+- GET  .../models                             (used by the warm-up)
+- POST .../models/<model>:generateContent     (function calls)
+- POST .../models/<model>:streamGenerateContent?alt=sse
+- GET  .../models/<model>                     (used by the warm-up)
+- GET  /stub/stats                            (request counters)
+
+Replies follow a script: a list of turns, each either
+{"content": "text"} or {"tool_calls": [{"name": ..., "arguments": {...}}]}.
+The turn is picked by the round of the agent loop, i.e. the number of model
+replies since the last user message, so the same conversation always gets
+the same replies regardless of concurrency. Tool-call turns whose tools are
+not offered by the request are skipped. Without a script, every request gets
+a text reply of `tokens` words.
+
+Latency follows a profile: the first token after `ttft` seconds, each
+further token after `token_latency` seconds, optionally varied by +/-
+`jitter` (a fraction). The jitter is seeded from the request body and
+`seed`, so identical requests are delayed identically. `max_concurrency`
+queues requests beyond a given number in flight, like a saturated provider,
+`fail_every` answers every Nth request with `fail_status`, and `stall_after`
+pauses streamed replies for `stall` seconds after that many tokens, like a
+provider that stops sending midway.
+
+Point a sample at it with:
+    langgraph          OPENAI_BASE_URL=http://127.0.0.1:18999/v1
+    autogen            OPENAI_BASE_URL=http://127.0.0.1:18999/v1
+    openai-agents-sdk  OPENAI_API_BASE=http://127.0.0.1:18999/v1
+    google-adk         GOOGLE_GEMINI_BASE_URL=http://127.0.0.1:18999
+
+Usage:
+    python stub_llm.py --profile default
+    python stub_llm.py --profile fast --script stub_scripts/calculate.json
+    python stub_llm.py --ttft 0.5 --token-latency 0.03 --tokens 200 --jitter 0.2
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+GEMINI_PATH = re.compile(r"/models/([^/:]+)(?::(generateContent|streamGenerateContent))?$")
+WORDS = "the agent runtime answered this request from a local stub server".split()
+
+# Latency profiles: seconds to the first token and between tokens
+PROFILES = {
+    "instant": {"ttft": 0.0, "token_latency": 0.0},
+    "fast": {"ttft": 0.05, "token_latency": 0.005},
+    "default": {"ttft": 0.2, "token_latency": 0.02},
+    "slow": {"ttft": 1.0, "token_latency": 0.05},
+}
+
+
+def load_script(path):
+    """Read a script file: a list of turns, or {"turns": [...]}"""
+    with open(path, encoding="utf-8") as f:
+        script = json.load(f)
+    turns = script["turns"] if isinstance(script, dict) else script
+    for turn in turns:
+        if not isinstance(turn, dict) or ("content" in turn) == ("tool_calls" in turn):
+            raise ValueError(f"{path}: each turn needs exactly one of 'content' or 'tool_calls': {turn!r}")
+    return turns
+
+
+def split_tokens(text):
+    """Split text into stream deltas: words with their trailing space, CJK per character"""
+    return re.findall(r"\S+\s*|\s+", text) if text.isascii() else list(text)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Request handler; the profile and script live on the server (see StubLLMServer)"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    # Helpers
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_sse(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _send_event(self, data):
+        payload = f"data: {data}\n\n".encode()
+        self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _end_sse(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _delay(self, seconds):
+        if seconds > 0:
+            jitter = self.server.jitter
+            time.sleep(seconds * (1 + self.rng.uniform(-jitter, jitter)) if jitter else seconds)
+
+    def _stream(self, tokens, send):
+        """Call send(token) for each token, sleeping like a model would"""
+        self._delay(self.server.ttft)
+        for i, token in enumerate(tokens):
+            if i:
+                self._delay(self.server.token_latency)
+            send(token)
+            if i + 1 == self.server.stall_after:
+                time.sleep(self.server.stall)
+
+    def _generate(self, tokens):
+        """Sleep for the whole generation time (non-streaming replies)"""
+        self._delay(self.server.ttft)
+        for _ in range(len(tokens) - 1):
+            self._delay(self.server.token_latency)
+
+    # Routing
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        match = GEMINI_PATH.search(path)
+        if path == "/stub/stats":
+            self._send_json(self.server.stats())
+        elif path.endswith("/models"):
+            self._send_json({"object": "list", "data": [{"id": "stub-model", "object": "model", "owned_by": "stub"}]})
+        elif match and not match.group(2):
+            self._send_json({"name": f"models/{match.group(1)}", "displayName": "Stub model"})
+        else:
+            self._send_json({"error": {"message": f"not found: {path}"}}, status=404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+        request = json.loads(body or b"{}")
+        self.rng = random.Random(zlib.crc32(body) ^ self.server.seed)
+        match = GEMINI_PATH.search(path)
+        if not path.endswith("/chat/completions") and not (match and match.group(2)):
+            self._send_json({"error": {"message": f"not found: {path}"}}, status=404)
+            return
+
+        number = self.server.begin_request()
+        try:
+            if self.server.fail_every and number % self.server.fail_every == 0:
+                self.server.count("failed")
+                self._send_json({"error": {"message": "stub: injected failure", "code": self.server.fail_status}},
+                                status=self.server.fail_status)
+            elif path.endswith("/chat/completions"):
+                self._openai_chat(request)
+            else:
+                self._gemini(match.group(1), request, streaming=match.group(2) == "streamGenerateContent")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away mid-stream (e.g. a cancelled request)
+            self.server.count("disconnected")
+        finally:
+            self.server.end_request()
+
+    # Script
+
+    def _turn(self, round_index, offered_tools):
+        """Pick the scripted turn for this round of the agent loop"""
+        script = self.server.script
+        if not script:
+            return {"content": " ".join(WORDS[i % len(WORDS)] for i in range(self.server.tokens))}
+        # Past the end of the script the agent gets the last text turn, so it can't loop on tools
+        for turn in script[round_index:]:
+            if "content" in turn or all(call["name"] in offered_tools for call in turn["tool_calls"]):
+                return turn
+        return next((turn for turn in reversed(script) if "content" in turn), {"content": ""})
+
+    # OpenAI chat completions
+
+    def _openai_chat(self, request):
+        messages = request.get("messages", [])
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+        round_index = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant")
+        offered = {t.get("function", {}).get("name") for t in request.get("tools") or []}
+        turn = self._turn(round_index, offered)
+        model = request.get("model", "stub-model")
+
+        if "tool_calls" in turn:
+            self.server.count("tool_calls")
+            calls = [
+                {"id": f"call_{round_index}_{i}", "name": call["name"], "arguments": json.dumps(call.get("arguments", {}))}
+                for i, call in enumerate(turn["tool_calls"])
+            ]
+            tokens = [call["arguments"] for call in calls]
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {"id": c["id"], "type": "function", "function": {"name": c["name"], "arguments": c["arguments"]}}
+                    for c in calls
+                ],
+            }
+            finish_reason = "tool_calls"
+        else:
+            tokens = split_tokens(turn["content"]) or [""]
+            message = {"role": "assistant", "content": turn["content"]}
+            finish_reason = "stop"
+        usage = {"prompt_tokens": 10, "completion_tokens": len(tokens), "total_tokens": 10 + len(tokens)}
+
+        if not request.get("stream"):
+            self._generate(tokens)
+            self._send_json({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": 0,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+            return
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+
+        self._start_sse()
+        self._send_event(chunk({"role": "assistant", "content": ""}))
+        if finish_reason == "tool_calls":
+            def send_call(index_and_call):
+                index, call = index_and_call
+                self._send_event(chunk({"tool_calls": [{
+                    "index": index, "id": call["id"], "type": "function",
+                    "function": {"name": call["name"], "arguments": call["arguments"]},
+                }]}))
+            self._stream(list(enumerate(calls)), send_call)
+        else:
+            self._stream(tokens, lambda token: self._send_event(chunk({"content": token})))
+        self._send_event(chunk({}, finish_reason))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._send_event(json.dumps({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }))
+        self._send_event("[DONE]")
+        self._end_sse()
+
+    # Gemini generateContent
+
+    def _gemini(self, model, request, streaming):
+        contents = request.get("contents", [])
+        # Function responses are sent with role "user" too; only text starts a new turn
+        last_user = max(
+            (i for i, c in enumerate(contents)
+             if c.get("role") == "user" and any("text" in part for part in c.get("parts", []))),
+            default=-1,
+        )
+        round_index = sum(1 for c in contents[last_user + 1:] if c.get("role") == "model")
+        offered = {
+            declaration.get("name")
+            for tool in request.get("tools") or []
+            for declaration in tool.get("functionDeclarations") or tool.get("function_declarations") or []
+        }
+        turn = self._turn(round_index, offered)
+
+        if "tool_calls" in turn:
+            self.server.count("tool_calls")
+            parts = [{"functionCall": {"name": c["name"], "args": c.get("arguments", {})}} for c in turn["tool_calls"]]
+            tokens = [parts]
+        else:
+            tokens = [[{"text": token}] for token in split_tokens(turn["content"]) or [""]]
+        usage = {"promptTokenCount": 10, "candidatesTokenCount": len(tokens), "totalTokenCount": 10 + len(tokens)}
+
+        def response(parts, finish_reason=None):
+            candidate = {"content": {"role": "model", "parts": parts}, "index": 0}
+            if finish_reason:
+                candidate["finishReason"] = finish_reason
+            return {"candidates": [candidate], "usageMetadata": usage, "modelVersion": model}
+
+        if not streaming:
+            self._generate(tokens)
+            merged = [part for parts in tokens for part in parts]
+            if "content" in turn:
+                merged = [{"text": turn["content"]}]
+            self._send_json(response(merged, "STOP"))
+            return
+
+        self._start_sse()
+        sent = []
+
+        def send(parts):
+            sent.append(parts)
+            self._send_event(json.dumps(response(parts, "STOP" if len(sent) == len(tokens) else None)))
+
+        self._stream(tokens, send)
+        self._end_sse()
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """
+    Threaded stub server with a fixed latency profile and reply script.
+
+    Use start()/stop() to run it in a background thread, or serve_forever()
+    to run it in the foreground.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=18999, ttft=0.2, token_latency=0.02, tokens=50,
+                 script=None, jitter=0.0, seed=0, max_concurrency=0, fail_every=0, fail_status=503,
+                 stall_after=0, stall=0.0):
+        super().__init__((host, port), StubHandler)
+        self.ttft = ttft
+        self.token_latency = token_latency
+        self.tokens = max(tokens, 1)
+        self.script = script or []
+        self.jitter = jitter
+        self.seed = seed
+        self.fail_every = fail_every
+        self.fail_status = fail_status
+        self.stall_after = stall_after
+        self.stall = stall
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "in_flight": 0, "max_in_flight": 0,
+                          "tool_calls": 0, "failed": 0, "disconnected": 0}
+        self._thread = None
+
+    def begin_request(self):
+        """Count a request and wait for a slot; returns the request number (1-based)"""
+        with self._lock:
+            self._counters["requests"] += 1
+            number = self._counters["requests"]
+        if self._slots is not None:
+            self._slots.acquire()
+        with self._lock:
+            self._counters["in_flight"] += 1
+            self._counters["max_in_flight"] = max(self._counters["max_in_flight"], self._counters["in_flight"])
+        return number
+
+    def end_request(self):
+        with self._lock:
+            self._counters["in_flight"] -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def handle_error(self, request, client_address):
+        # Clients closing idle keep-alive connections are expected
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="stub-llm", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def add_arguments(parser):
+    """Stub options, shared with load_test.py"""
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="default",
+                        help="latency profile (default: default)")
+    parser.add_argument("--ttft", type=float, help="seconds before the first token (overrides the profile)")
+    parser.add_argument("--token-latency", type=float, help="seconds between tokens (overrides the profile)")
+    parser.add_argument("--tokens", type=int, default=50, help="words per unscripted reply")
+    parser.add_argument("--script", help="JSON file with scripted turns")
+    parser.add_argument("--jitter", type=float, default=0.0, help="vary each delay by +/- this fraction")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the jitter")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="requests served at once, 0 = no limit")
+    parser.add_argument("--fail-every", type=int, default=0, help="fail every Nth request, 0 = never")
+    parser.add_argument("--fail-status", type=int, default=503, help="HTTP status of injected failures")
+    parser.add_argument("--stall-after", type=int, default=0, help="pause streamed replies after N tokens, 0 = never")
+    parser.add_argument("--stall", type=float, default=0.0, help="seconds to pause for --stall-after")
+
+
+def server_from_args(args, host="127.0.0.1", port=18999):
+    """Create a StubLLMServer from parsed add_arguments() options"""
+    profile = PROFILES[args.profile]
+    return StubLLMServer(
+        host, port,
+        ttft=profile["ttft"] if args.ttft is None else args.ttft,
+        token_latency=profile["token_latency"] if args.token_latency is None else args.token_latency,
+        tokens=args.tokens,
+        script=load_script(args.script) if args.script else None,
+        jitter=args.jitter,
+        seed=args.seed,
+        max_concurrency=args.max_concurrency,
+        fail_every=args.fail_every,
+        fail_status=args.fail_status,
+        stall_after=args.stall_after,
+        stall=args.stall,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic stub OpenAI/Gemini server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18999)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = server_from_args(args, args.host, args.port)
+    print(f"Stub LLM server on {server.url} (OpenAI base URL: {server.url}/v1), "
+          f"ttft={server.ttft}s token_latency={server.token_latency}s")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
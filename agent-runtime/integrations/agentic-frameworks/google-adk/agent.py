@@ -0,0 +1,668 @@
+"""
+Google ADK agent: model, tools, session service and runner.
+
+app.py imports this module on first use (or in a background thread at
+startup), because importing google-adk takes a couple of seconds.
+"""
+
+from google.adk.agents import LlmAgent
+from google.adk.agents.run_config import RunConfig, StreamingMode
+from google.adk.models import Gemini
+from google.adk.runners import Runner
+from google.adk.events import Event
+from google.adk.sessions import InMemorySessionService
+from google.adk.tools import google_search
+from google.genai import types
+from dotenv import load_dotenv
+load_dotenv()
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+APP_NAME = "google_search_agent"
+USER_ID = "user1234"
+
+class ResponseCache:
+    """
+    In-memory LRU cache bounded by the estimated size of its values.
+
+    Entries expire `ttl` seconds after they are stored (a per-entry ttl
+    overrides it). Once the values add up to more than `max_bytes`, the
+    least recently used entries are evicted. None is not a cacheable value.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """Stable key from JSON-serialisable parts (dict keys are sorted)."""
+        data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached value, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None, ttl=None):
+        """Store `value`; `size` defaults to the length of its repr()."""
+        size = len(repr(value)) if size is None else size
+        ttl = self.ttl if ttl is None else ttl
+        if value is None or ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# Response cache for model calls, off by default. Only worth enabling for
+# deterministic traffic such as FAQs: an identical conversation (same model,
+# contents and config) gets the previous answer back. Streaming calls are not
+# cached, since a cached answer has no tokens to stream. There is no tool
+# cache: google_search runs on Google's side as part of the model call.
+LLM_CACHE = os.getenv("LLM_CACHE", "false").lower() in ("1", "true", "yes")
+llm_cache = ResponseCache(
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=int(os.getenv("LLM_CACHE_TTL", "3600")),
+) if LLM_CACHE else None
+
+
+class CachingGemini(Gemini):
+    """Gemini model that serves repeated non-streaming calls from llm_cache"""
+
+    async def generate_content_async(self, llm_request, stream=False):
+        if llm_cache is None or stream:
+            async for response in super().generate_content_async(llm_request, stream):
+                yield response
+            return
+
+        key = ResponseCache.make_key(
+            self.model,
+            [content.model_dump(mode="json", exclude_none=True) for content in llm_request.contents],
+            llm_request.config.model_dump(mode="json", exclude_none=True) if llm_request.config else None,
+        )
+        cached = llm_cache.get(key)
+        if cached is not None:
+            # ADK annotates the response it is given, so hand out a copy
+            yield cached.model_copy(deep=True)
+            return
+
+        responses = []
+        async for response in super().generate_content_async(llm_request, stream):
+            responses.append(response.model_copy(deep=True))
+            yield response
+        if len(responses) == 1 and not responses[0].partial and not responses[0].error_code:
+            llm_cache.put(key, responses[0], size=len(responses[0].model_dump_json()))
+
+
+# Agent Definition
+root_agent = LlmAgent(
+    model=CachingGemini(model=os.getenv("GEMINI_MODEL", "gemini-2.0-flash")), 
+    name=APP_NAME,
+    instruction="I can answer your questions by searching the internet. Just ask me anything!",
+    tools=[google_search]
+)
+
+class SQLiteStateStore:
+    """
+    Conversation state persisted to a SQLite database in WAL mode.
+
+    Every message is appended as its own row, so a turn writes only what it
+    added, not the whole conversation. `append()` just queues the row; a
+    background thread commits the queue every `flush_interval` seconds in
+    one transaction, so concurrent turns share a single fsync and request
+    handlers never wait on the disk. `load()` reads a session back (queued
+    rows included) the first time it is used after a restart; it waits while
+    a batch is being committed, so call it from a worker thread.
+
+    With a `retention` (seconds), the writer thread also deletes sessions
+    that have not been written to for that long, whenever it has nothing to
+    commit, so the database does not keep every conversation forever.
+    `load()` treats such a session as deleted even before the sweep gets to it.
+    """
+
+    SWEEP_BATCH = 200
+
+    def __init__(self, path, flush_interval=0.05, retention=None, sweep_interval=60):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        self.appended = 0
+        self.commits = 0
+        self.bytes_written = 0
+        self.loads = 0
+        self.restored_sessions = 0
+        self.load_ms_max = 0.0
+        self.swept_sessions = 0
+        self._pending = []  # (session_id, JSON text, or None to delete the session)
+        self._pending_lock = threading.Lock()
+        # Held while committing a batch, so load() never sees a row both in
+        # the database and in the queue
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            "id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id)")
+        new_sessions_table = not self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sessions'"
+        ).fetchone()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, updated REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+        if new_sessions_table:
+            # Databases written before the sessions table existed: start their clock now
+            self._db.execute(
+                "INSERT OR IGNORE INTO sessions SELECT DISTINCT session_id, ? FROM turns", (time.time(),)
+            )
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="state-store", daemon=True)
+        self._writer.start()
+
+    def append(self, session_id, record):
+        """Queue a JSON-serialisable record for `session_id`"""
+        data = json.dumps(record, ensure_ascii=False)
+        with self._pending_lock:
+            self._pending.append((session_id, data))
+            self.appended += 1
+
+    def delete(self, session_id):
+        """Queue the removal of every record of `session_id`"""
+        with self._pending_lock:
+            self._pending.append((session_id, None))
+
+    def load(self, session_id, limit=None):
+        """Return the session's records, oldest first (only the newest `limit`, if given)"""
+        start = time.perf_counter()
+        with self._db_lock:
+            if self._expire(session_id):
+                rows = []
+            elif limit is None:
+                rows = self._db.execute(
+                    "SELECT data FROM turns WHERE session_id = ? ORDER BY id", (session_id,)
+                ).fetchall()
+            else:
+                rows = self._db.execute(
+                    "SELECT data FROM (SELECT id, data FROM turns WHERE session_id = ? "
+                    "ORDER BY id DESC LIMIT ?) ORDER BY id",
+                    (session_id, limit),
+                ).fetchall()
+            with self._pending_lock:
+                pending = [data for queued_id, data in self._pending if queued_id == session_id]
+        records = [row[0] for row in rows]
+        for data in pending:
+            if data is None:
+                records = []
+            else:
+                records.append(data)
+        if limit is not None:
+            records = records[-limit:]
+        records = [json.loads(data) for data in records]
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._pending_lock:
+            self.loads += 1
+            self.restored_sessions += bool(records)
+            self.load_ms_max = max(self.load_ms_max, elapsed_ms)
+        return records
+
+    def _expire(self, session_id):
+        """
+        Queue the removal of `session_id` if it has not been written to for
+        `retention` seconds, ahead of its queued records; return whether it did.
+        Call with `_db_lock` held.
+        """
+        if self.retention is None:
+            return False
+        expired = self._db.execute(
+            "SELECT 1 FROM sessions WHERE session_id = ? AND updated < ?",
+            (session_id, time.time() - self.retention),
+        ).fetchone()
+        if expired:
+            with self._pending_lock:
+                self._pending.insert(0, (session_id, None))
+        return expired is not None
+
+    def flush(self):
+        """Commit everything queued so far"""
+        with self._db_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            written = set()
+            self._db.execute("BEGIN")
+            try:
+                for session_id, data in batch:
+                    if data is None:
+                        written.discard(session_id)
+                        self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                        self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                    else:
+                        written.add(session_id)
+                        self._db.execute(
+                            "INSERT INTO turns (session_id, data) VALUES (?, ?)", (session_id, data)
+                        )
+                now = time.time()
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO sessions (session_id, updated) VALUES (?, ?)",
+                    [(session_id, now) for session_id in written],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                with self._pending_lock:
+                    self._pending[:0] = batch
+                raise
+            with self._pending_lock:
+                self.commits += 1
+                self.bytes_written += sum(len(data) for _, data in batch if data is not None)
+
+    def sweep(self):
+        """Delete up to SWEEP_BATCH sessions not written to for `retention` seconds, return how many"""
+        if self.retention is None:
+            return 0
+        cutoff = time.time() - self.retention
+        with self._db_lock:
+            expired = [
+                row[0] for row in self._db.execute(
+                    "SELECT session_id FROM sessions WHERE updated < ? LIMIT ?", (cutoff, self.SWEEP_BATCH)
+                ).fetchall()
+            ]
+            with self._pending_lock:
+                # Their queued records will be committed, which makes them recent again
+                queued = {session_id for session_id, _ in self._pending}
+            expired = [session_id for session_id in expired if session_id not in queued]
+            if not expired:
+                return 0
+            self._db.execute("BEGIN")
+            try:
+                for session_id in expired:
+                    self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                    self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        with self._pending_lock:
+            self.swept_sessions += len(expired)
+        return len(expired)
+
+    def _run(self):
+        last_sweep = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                with self._pending_lock:
+                    idle = not self._pending
+                # Sweep only when nothing is queued, so it never delays a commit; a full
+                # batch means more may be expired, so sweep again on the next idle tick
+                if (self.retention is not None and idle
+                        and time.monotonic() - last_sweep >= self.sweep_interval):
+                    if self.sweep() < self.SWEEP_BATCH:
+                        last_sweep = time.monotonic()
+            except Exception as e:
+                print(f"⚠️  Failed to write conversation state, will retry: {e}")
+
+    def close(self):
+        """Stop the writer thread and commit what is left"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._writer.join()
+        self.flush()
+        self._db.close()
+
+    def stats(self):
+        with self._pending_lock:
+            return {
+                "backend": "sqlite",
+                "appended": self.appended,
+                "pending": len(self._pending),
+                "commits": self.commits,
+                "bytes_written": self.bytes_written,
+                "loads": self.loads,
+                "restored_sessions": self.restored_sessions,
+                "load_ms_max": round(self.load_ms_max, 2),
+                "swept_sessions": self.swept_sessions,
+            }
+
+
+def _create_state_store():
+    """
+    Create the session state backend selected by STATE_BACKEND.
+
+    "memory" (the default) keeps sessions in process memory only. "sqlite"
+    also writes their events to STATE_PATH, so a recycled sandbox picks a
+    conversation up where it left off. Another backend only needs the same
+    append/delete/load/flush/close/stats methods as SQLiteStateStore.
+    """
+    backend = os.getenv("STATE_BACKEND", "memory").lower()
+    if backend == "memory":
+        return None
+    if backend == "sqlite":
+        store = SQLiteStateStore(
+            os.getenv("STATE_PATH", "conversations.db"),
+            flush_interval=float(os.getenv("STATE_FLUSH_INTERVAL", "0.05")),
+            retention=int(os.getenv("SESSION_TTL", "3600")),
+        )
+        atexit.register(store.close)
+        print(f"💾 Persisting session state to {store.path}")
+        return store
+    raise ValueError(f"Unknown STATE_BACKEND: {backend!r} (expected 'memory' or 'sqlite')")
+
+
+state_store = _create_state_store()
+
+
+class BoundedSessionService(InMemorySessionService):
+    """
+    In-memory session service with a bounded number of resident sessions.
+
+    Sessions idle for longer than `ttl` seconds are evicted, and the least
+    recently used sessions are evicted once more than `max_sessions` exist.
+
+    With a `store`, every event appended to a session is also written to it.
+    A session that is not in memory (evicted, or from before a restart) is
+    rebuilt from its stored events the next time it is requested, unless the
+    store has expired it (see SQLiteStateStore's `retention`).
+    """
+
+    def __init__(self, max_sessions=1000, ttl=3600, store=None):
+        super().__init__()
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.store = store
+        self.hits = 0
+        self.creates = 0
+        self.evictions = 0
+        self._last_access = OrderedDict()  # (app_name, user_id, session_id) -> last access time
+
+    async def get_or_create_session(self, app_name, user_id, session_id):
+        """Return the session, creating it if it doesn't exist or has expired"""
+        await self._evict_expired()
+        session = await self.get_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        if session is not None:
+            self.hits += 1
+            return session
+
+        session = await self.create_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        self.creates += 1
+        await self._evict_overflow()
+        return session
+
+    async def get_session(self, *, app_name, user_id, session_id, **kwargs):
+        session = await super().get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, **kwargs
+        )
+        restored = False
+        if session is None and self.store is not None:
+            session = await self._restore(app_name, user_id, session_id, **kwargs)
+            restored = session is not None
+        if session is not None:
+            self._touch((app_name, user_id, session_id))
+        if restored:
+            # A restored session is resident again, so it counts against max_sessions
+            await self._evict_overflow()
+        return session
+
+    async def _restore(self, app_name, user_id, session_id, **kwargs):
+        """Rebuild a session from its stored events, or return None if it has none"""
+        # Off the event loop: load() may wait for the writer thread's commit
+        events = await asyncio.to_thread(self.store.load, self._store_key(app_name, user_id, session_id))
+        if not events:
+            return None
+        session = await super().get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, **kwargs
+        )
+        if session is not None:
+            # A concurrent request restored (or created) it while this one was loading
+            return session
+        session = await super().create_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        for event in events:
+            # The base class's append_event, so replayed events aren't stored again
+            await super().append_event(session, Event.model_validate(event))
+        return await super().get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, **kwargs
+        )
+
+    async def create_session(self, *, app_name, user_id, **kwargs):
+        session = await super().create_session(app_name=app_name, user_id=user_id, **kwargs)
+        self._touch((app_name, user_id, session.id))
+        return session
+
+    async def append_event(self, session, event):
+        event = await super().append_event(session, event)
+        if self.store is not None and not event.partial:
+            self.store.append(
+                self._store_key(session.app_name, session.user_id, session.id),
+                event.model_dump(mode="json", exclude_none=True),
+            )
+        return event
+
+    async def delete_session(self, *, app_name, user_id, session_id):
+        await self._drop((app_name, user_id, session_id))
+        if self.store is not None:
+            self.store.delete(self._store_key(app_name, user_id, session_id))
+
+    async def _drop(self, key):
+        """Remove a session from memory only"""
+        self._last_access.pop(key, None)
+        app_name, user_id, session_id = key
+        await super().delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+
+    @staticmethod
+    def _store_key(app_name, user_id, session_id):
+        return f"{app_name}/{user_id}/{session_id}"
+
+    def _touch(self, key):
+        self._last_access[key] = time.monotonic()
+        self._last_access.move_to_end(key)
+
+    async def _evict_expired(self):
+        # Oldest first, so stop at the first session that is still fresh
+        now = time.monotonic()
+        while self._last_access:
+            key, last_access = next(iter(self._last_access.items()))
+            if now - last_access <= self.ttl:
+                break
+            await self._evict(key)
+
+    async def _evict_overflow(self):
+        while len(self._last_access) > self.max_sessions:
+            await self._evict(next(iter(self._last_access)))
+
+    async def _evict(self, key):
+        # A stored session stays in the store and is restored on its next use,
+        # until the store's retention (SESSION_TTL as well) expires it
+        await self._drop(key)
+        self.evictions += 1
+
+    def stats(self):
+        return {
+            "resident": len(self._last_access),
+            "max_sessions": self.max_sessions,
+            "hits": self.hits,
+            "creates": self.creates,
+            "evictions": self.evictions,
+        }
+
+
+# Session and Runner
+session_service = BoundedSessionService(
+    max_sessions=int(os.getenv("SESSION_MAX_COUNT", "1000")),
+    ttl=int(os.getenv("SESSION_TTL", "3600")),
+    store=state_store,
+)
+runner = Runner(
+    agent=root_agent, 
+    app_name=APP_NAME, 
+    session_service=session_service
+)
+
+# Agent Interaction
+async def get_or_create_session(user_id, session_id):
+    """Get the session, creating it on first use"""
+    return await session_service.get_or_create_session(APP_NAME, user_id, session_id)
+
+
+async def call_agent_async(query, user_id, session_id):
+    """Call the agent with the given query"""
+    try:
+        # Get or create session
+        await get_or_create_session(user_id, session_id)
+        
+        # Create message
+        user_content = types.Content(role='user', parts=[types.Part(text=query)])
+        
+        # Run agent
+        final_response_content = "No response received."
+        async for event in runner.run_async(
+            user_id=user_id, 
+            session_id=session_id, 
+            new_message=user_content
+        ):
+            if event.is_final_response() and event.content and event.content.parts:
+                final_response_content = event.content.parts[0].text
+        
+        return final_response_content
+        
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+
+async def exercise_session_service():
+    """Create and delete a throwaway session, the same code path a first request takes"""
+    session = await session_service.create_session(app_name=APP_NAME, user_id=USER_ID)
+    await session_service.delete_session(app_name=APP_NAME, user_id=USER_ID, session_id=session.id)
+
+
+async def prime_model_connection(timeout):
+    """Open a connection to the Gemini API with a model metadata lookup (no tokens used)"""
+    model = root_agent.canonical_model
+    await asyncio.wait_for(model.api_client.aio.models.get(model=model.model), timeout)
+
+
+def _event_text(event):
+    """Concatenate the text parts of an event, skipping model thoughts"""
+    if not event.content or not event.content.parts:
+        return ""
+    return "".join(
+        part.text for part in event.content.parts
+        if part.text and not getattr(part, "thought", False)
+    )
+
+
+# Streaming runs abandoned by the client before completion
+run_stats = {"cancelled_runs": 0}
+
+
+async def stream_agent_async(query, user_id, session_id):
+    """
+    Call the agent and yield progress as it happens.
+
+    Yields {"chunk", "type"} events: "content" for partial response text,
+    "tool_call" when the agent calls a tool, "search" for each Google Search
+    query, then "end" (or "error").
+    """
+    try:
+        await get_or_create_session(user_id, session_id)
+        user_content = types.Content(role='user', parts=[types.Part(text=query)])
+        
+        streamed_text = False  # whether the current model turn already streamed its text
+        seen_queries = set()
+        events = runner.run_async(
+            user_id=user_id,
+            session_id=session_id,
+            new_message=user_content,
+            run_config=RunConfig(streaming_mode=StreamingMode.SSE)
+        )
+        try:
+            async for event in events:
+                for call in event.get_function_calls():
+                    yield {"chunk": call.name, "type": "tool_call"}
+            
+                grounding = getattr(event, "grounding_metadata", None)
+                for search_query in (grounding.web_search_queries or []) if grounding else []:
+                    if search_query not in seen_queries:
+                        seen_queries.add(search_query)
+                        yield {"chunk": search_query, "type": "search"}
+            
+                text = _event_text(event)
+                if event.partial:
+                    if text:
+                        streamed_text = True
+                        yield {"chunk": text, "type": "content"}
+                else:
+                    # The non-partial event repeats the full turn text; only send it
+                    # if the model did not stream this turn
+                    if text and not streamed_text and event.is_final_response():
+                        yield {"chunk": text, "type": "content"}
+                    streamed_text = False
+        finally:
+            # Stops the agent run, including its in-flight model call, when the
+            # loop exits early (e.g. the client disconnected)
+            await events.aclose()
+        
+        yield {"chunk": "", "type": "end"}
+    
+    except (asyncio.CancelledError, GeneratorExit):
+        # Client disconnected: the runtime cancels (or closes) this generator
+        run_stats["cancelled_runs"] += 1
+        raise
+        
+    except Exception as e:
+        yield {"error": str(e), "type": "error"}
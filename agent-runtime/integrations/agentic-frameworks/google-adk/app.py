@@ -1,106 +1,321 @@
-from google.adk.agents import LlmAgent
-from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
-from google.adk.tools import google_search
-from google.genai import types
 from dotenv import load_dotenv
 load_dotenv()
+import asyncio
+import math
 import os
+import threading
+import time
+import uuid
+import weakref
+from collections import deque
 
-APP_NAME = "google_search_agent"
-USER_ID = "user1234"
+from ppio_sandbox.agent_runtime import AgentRuntimeApp, PingResponse
+from pydantic import ConfigDict
+from starlette.responses import JSONResponse, StreamingResponse
 
-# Agent Definition
-root_agent = LlmAgent(
-    model=os.getenv("GEMINI_MODEL", "gemini-2.0-flash"), 
-    name=APP_NAME,
-    instruction="I can answer your questions by searching the internet. Just ask me anything!",
-    tools=[google_search]
-)
+app = AgentRuntimeApp()
 
-# Session and Runner
-session_service = InMemorySessionService()
-runner = Runner(
-    agent=root_agent, 
-    app_name=APP_NAME, 
-    session_service=session_service
-)
 
-# Agent Interaction
-async def call_agent_async(query, user_id, session_id):
-    """Call the agent with the given query"""
+class HealthStatus(PingResponse):
+    """
+    Ping response that keeps extra fields.
+
+    The runtime rebuilds a plain dict returned by @app.ping as PingResponse,
+    which silently drops everything except status/message/timestamp.
+    """
+
+    model_config = ConfigDict(extra="allow")
+
+
+# The ADK agent lives in agent.py. Importing it pulls in google-adk and
+# google-genai, which takes a couple of seconds, so it is loaded on first use
+# and a cold sandbox can answer /ping right away. Running `python app.py`
+# loads it in a background thread (warm_up) while the server starts.
+adk_agent = None
+_agent_lock = threading.Lock()
+startup_stats = {"framework_load_s": None, "warm_up_s": None, "steps": {}, "errors": []}
+
+
+def _load_agent():
+    """Import agent.py (once, thread-safe)"""
+    global adk_agent
+    if adk_agent is None:
+        with _agent_lock:
+            if adk_agent is None:
+                start = time.monotonic()
+                import agent
+                startup_stats["framework_load_s"] = round(time.monotonic() - start, 3)
+                adk_agent = agent
+    return adk_agent
+
+
+async def _ensure_agent():
+    """Load the agent in a thread so the first import doesn't block the event loop"""
+    if adk_agent is None:
+        await asyncio.to_thread(_load_agent)
+    return adk_agent
+
+
+# The warm-up also opens a connection to the Gemini API (a model metadata
+# lookup, no tokens used) so the first request doesn't pay for TCP/TLS setup
+WARM_UP_LLM = os.getenv("WARM_UP_LLM", "true").lower() in ("1", "true", "yes")
+WARM_UP_LLM_TIMEOUT = 10
+_warm_up_lock = threading.Lock()
+_warm_up_task = None
+
+
+def _warm_up_failed(name, e):
+    startup_stats["errors"].append(f"{name}: {e}")
+    print(f"⚠️  Warm-up step {name} failed: {e}")
+
+
+def _warm_up_step(name, func):
+    """Run one synchronous warm-up step, recording its duration or error"""
+    start = time.monotonic()
     try:
-        # Get or create session
-        try:
-            session = await session_service.get_session(
-                app_name=APP_NAME,
-                user_id=user_id,
-                session_id=session_id
-            )
-        except:
-            session = await session_service.create_session(
-                app_name=APP_NAME, 
-                user_id=user_id, 
-                session_id=session_id
-            )
-        
-        # Create message
-        user_content = types.Content(role='user', parts=[types.Part(text=query)])
-        
-        # Run agent
-        final_response_content = "No response received."
-        async for event in runner.run_async(
-            user_id=user_id, 
-            session_id=session_id, 
-            new_message=user_content
-        ):
-            if event.is_final_response() and event.content and event.content.parts:
-                final_response_content = event.content.parts[0].text
-        
-        return final_response_content
-        
+        func()
     except Exception as e:
-        # Fallback to direct Gemini API call
-        if "Session not found" in str(e) or "app name" in str(e).lower():
-            try:
-                from google.genai import Client
-                
-                gemini_client = Client(api_key=os.getenv("GEMINI_API_KEY"))
-                response = gemini_client.models.generate_content(
-                    model=os.getenv("GEMINI_MODEL", "gemini-2.0-flash"),
-                    contents=query
-                )
-                return response.text
-            except:
-                pass
-        
-        return f"Error: {str(e)}"
-
-
-from ppio_sandbox.agent_runtime import AgentRuntimeApp
-import asyncio
-import uuid
+        _warm_up_failed(name, e)
+        return
+    startup_stats["steps"][name] = round(time.monotonic() - start, 3)
 
-app = AgentRuntimeApp()
 
+async def _warm_up_step_async(name, func):
+    """Run one asynchronous warm-up step, recording its duration or error"""
+    start = time.monotonic()
+    try:
+        await func()
+    except Exception as e:
+        _warm_up_failed(name, e)
+        return
+    startup_stats["steps"][name] = round(time.monotonic() - start, 3)
+
+
+def warm_up():
+    """Load the agent ahead of the first request (once); errors are retried on first use"""
+    with _warm_up_lock:
+        if "framework" not in startup_stats["steps"]:
+            _warm_up_step("framework", _load_agent)
+
+
+async def _warm_up_async():
+    """
+    Full warm-up, run on the server's event loop.
+
+    The session service and the Gemini client's async connections belong to
+    the event loop, so these steps run here rather than in the background
+    thread. A failed step is recorded and retried lazily by the first request;
+    the sandbox reports ready once the warm-up has finished either way.
+    """
+    start = time.monotonic()
+    await asyncio.to_thread(warm_up)
+    if adk_agent is not None:
+        await _warm_up_step_async("sessions", adk_agent.exercise_session_service)
+        if WARM_UP_LLM:
+            await _warm_up_step_async(
+                "llm_connection", lambda: adk_agent.prime_model_connection(WARM_UP_LLM_TIMEOUT)
+            )
+    startup_stats["warm_up_s"] = round(time.monotonic() - start, 3)
+
+
+def start_warm_up():
+    """Start the warm-up task on the running event loop (once)"""
+    global _warm_up_task
+    if _warm_up_task is None:
+        _warm_up_task = asyncio.get_running_loop().create_task(_warm_up_async())
+
+
+def is_ready():
+    """Ready to take traffic: the warm-up has finished and the agent is loaded"""
+    return startup_stats["warm_up_s"] is not None and adk_agent is not None
+
+
+class AdmissionController:
+    """
+    Limits how many agent runs execute at once in this sandbox.
+
+    Up to `max_concurrent` runs execute; further requests wait in a FIFO
+    queue of at most `max_queue` entries for up to `queue_timeout` seconds.
+    Requests that find the queue full, or time out in it, are rejected so the
+    client can retry elsewhere or later. `max_concurrent=0` disables the limit.
+    """
+
+    # Recent queue waits kept for the percentiles reported by /ping
+    WAIT_SAMPLES = 1000
+
+    def __init__(self, max_concurrent=32, max_queue=64, queue_timeout=30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._avg_run_s = None  # moving average of run durations
+        self._waits = deque(maxlen=self.WAIT_SAMPLES)
+        # Created by the first acquire(), inside the serving loop: on Python 3.9 an
+        # asyncio.Semaphore binds to the loop current at construction, and the
+        # import-time loop is not the one uvicorn runs
+        self._semaphore = None
+
+    @property
+    def saturated(self):
+        """True when every run slot is taken, so new requests queue."""
+        return self.max_concurrent > 0 and (self.queued > 0 or self.in_flight >= self.max_concurrent)
+
+    async def acquire(self):
+        """Wait for a run slot. Returns a release callback, or None if rejected."""
+        start = time.monotonic()
+        if self.max_concurrent > 0:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            if not self._semaphore.locked():
+                await self._semaphore.acquire()
+            elif self.queued >= self.max_queue:
+                self.rejected += 1
+                return None
+            else:
+                self.queued += 1
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    return None
+                finally:
+                    self.queued -= 1
+        admitted_at = time.monotonic()
+        self._waits.append(admitted_at - start)
+        self.in_flight += 1
+        self.admitted += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.in_flight -= 1
+            duration = time.monotonic() - admitted_at
+            self._avg_run_s = duration if self._avg_run_s is None else 0.8 * self._avg_run_s + 0.2 * duration
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+        return release
+
+    def retry_after(self):
+        """Seconds a rejected client should wait: about the time to drain the queue."""
+        if not self._avg_run_s or self.max_concurrent <= 0:
+            return 1
+        return max(1, math.ceil(self._avg_run_s * (self.queued + 1) / self.max_concurrent))
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def wait_ms(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p / 100))] * 1000, 1) if waits else 0.0
+
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms": {"p50": wait_ms(50), "p95": wait_ms(95), "max": wait_ms(100)},
+        }
+
+
+admission = AdmissionController(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_RUNS", "32")),
+    max_queue=int(os.getenv("MAX_QUEUED_RUNS", "64")),
+    queue_timeout=float(os.getenv("QUEUE_TIMEOUT", "30")),
+)
+
+
+async def _release_after(body_iterator, release):
+    """Pass a streaming body through, releasing the run slot when it ends."""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        release()
+
+
+@app.middleware
+async def admission_control(request, call_next):
+    """
+    Admit /invocations requests through the admission controller.
+
+    Rejected requests get HTTP 429 with a Retry-After header. A streaming
+    response holds its slot until the stream ends, not just until the
+    entrypoint returns.
+    """
+    release = await admission.acquire()
+    if release is None:
+        retry_after = admission.retry_after()
+        print(f"⚠️  Rejected request: {admission.in_flight} runs in flight, {admission.queued} queued")
+        return JSONResponse(
+            {"error": "Too many requests in progress, retry later", "status": "error", "retry_after": retry_after},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)},
+        )
+    try:
+        response = await call_next(request)
+    except BaseException:
+        release()
+        raise
+    if isinstance(response, StreamingResponse):
+        # The finalizer covers a client that disconnects before the stream starts
+        weakref.finalize(response, release)
+        response.body_iterator = _release_after(response.body_iterator, release)
+    else:
+        release()
+    return response
+
+
+# Async entrypoint: runs on the server's event loop, so concurrent requests
+# interleave their LLM and search I/O instead of each spinning up a new loop
 @app.entrypoint
-def agent_invocation(payload, context):
+async def agent_invocation(payload, context):
     """PPIO Agent Runtime entrypoint"""
+    agent = await _ensure_agent()
     prompt = payload.get("prompt", "Tell me something about AI Agent?")
-    user_id = payload.get("user_id", USER_ID)
+    user_id = payload.get("user_id", agent.USER_ID)
     session_id = getattr(context, 'session_id', None) or str(uuid.uuid4())
     
-    result = asyncio.run(call_agent_async(prompt, user_id, session_id))
+    if payload.get("streaming", False):
+        # Return async generator - AgentRuntimeApp sends it as an SSE stream
+        return agent.stream_agent_async(prompt, user_id, session_id)
+    
+    result = await agent.call_agent_async(prompt, user_id, session_id)
     return result
 
 @app.ping
-def health_check() -> dict:
+async def health_check() -> HealthStatus:
     """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "service": "Google ADK Agent",
-        "features": ["google_search"]
-    }
+    # The first ping starts the warm-up; until it is done the sandbox reports
+    # HealthyBusy, so traffic is only routed to warm sandboxes
+    start_warm_up()
+    ready = is_ready()
+    loaded = adk_agent is not None
+    saturated = admission.saturated
+    return HealthStatus(
+        # Also HealthyBusy while every run slot is taken
+        status="healthy" if ready and not saturated else "healthybusy",
+        message="warming up" if not ready else "at capacity" if saturated else None,
+        service="Google ADK Agent",
+        alive=True,
+        ready=ready,
+        features=["google_search", "streaming"],
+        sessions=adk_agent.session_service.stats() if loaded else None,
+        state=(adk_agent.state_store.stats() if adk_agent.state_store is not None else {"backend": "memory"}) if loaded else None,
+        runs=dict(adk_agent.run_stats) if loaded else {"cancelled_runs": 0},
+        admission=admission.stats(),
+        cache={"llm": adk_agent.llm_cache.stats() if loaded and adk_agent.llm_cache is not None else None},
+        startup=dict(startup_stats),
+    )
 
 if __name__ == "__main__":
     print("\n" + "="*80)
@@ -110,4 +325,7 @@ if __name__ == "__main__":
     print(f"🛠️  Tools: Google Search")
     print(f"🔗 Port: 8080")
     print("="*80 + "\n")
+    # Load the agent while the server starts; the remaining warm-up steps run
+    # on the event loop when the first health check arrives
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
     app.run(port=8080)
\ No newline at end of file
@@ -0,0 +1,55 @@
+#!/bin/bash
+
+set -e
+
+BASE_URL="http://localhost:8080"
+ENDPOINT="${BASE_URL}/invocations"
+
+GREEN='\033[0;32m'
+YELLOW='\033[1;33m'
+BLUE='\033[0;34m'
+CYAN='\033[0;36m'
+NC='\033[0m'
+
+echo ""
+echo "========================================================================"
+echo -e "${GREEN}🚀 Google ADK Agent Streaming Test${NC}"
+echo "========================================================================"
+echo ""
+
+if ! curl -s -f "${BASE_URL}/ping" > /dev/null 2>&1; then
+    echo "❌ Service not running! Start with: python app.py"
+    exit 1
+fi
+
+echo "========================================================================"
+echo -e "${BLUE}Streaming Google Search${NC}"
+echo "========================================================================"
+echo -e "${YELLOW}📤 Search for Google Gemini 2.5 latest features${NC}"
+echo -e "${GREEN}📥 Streaming response:${NC}"
+
+curl -s -X POST "${ENDPOINT}" \
+    -H "Content-Type: application/json" \
+    -d '{"prompt": "Search for Google Gemini 2.5 latest features", "streaming": true}' | \
+    while IFS= read -r line; do
+        if [[ "$line" == data:* ]]; then
+            EVENT=$(echo "$line" | sed 's/^data: //')
+            TYPE=$(echo "$EVENT" | jq -r '.type // empty')
+            case "$TYPE" in
+                search|tool_call)
+                    echo -e "\n${CYAN}🔍 [${TYPE}] $(echo "$EVENT" | jq -r '.chunk')${NC}"
+                    ;;
+                *)
+                    echo "$EVENT" | jq -r '.chunk // .error // empty' | tr -d '\n'
+                    ;;
+            esac
+        fi
+    done
+
+echo ""
+echo ""
+
+echo "========================================================================"
+echo -e "${GREEN}✅ Streaming test completed${NC}"
+echo "========================================================================"
+echo ""
@@ -1,16 +1,25 @@
 
 from typing import Annotated
 
-from langchain_openai import ChatOpenAI
 from typing_extensions import TypedDict
 
-from langgraph.graph import StateGraph, START
-from langgraph.graph.message import add_messages
-from langgraph.prebuilt import ToolNode, tools_condition
-
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import math
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, nullcontext
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -42,15 +51,42 @@ console_handler = logging.StreamHandler()
 console_handler.setFormatter(log_formatter)
 console_handler.setLevel(logging.INFO)
 
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that hands records to the listener thread unformatted.
+
+    The stock QueueHandler.prepare() merges msg % args on the calling thread,
+    so the request path would still pay for formatting. Here formatting and
+    file/console I/O both happen on the listener thread. Objects passed as
+    log arguments must therefore not be mutated after the call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+# Records go through an unbounded queue; a background listener thread owns
+# the file and console handlers, so logging never blocks a request
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 # Configure root logger
+log_level = getattr(logging, os.getenv("LOG_LEVEL", "DEBUG").upper(), logging.DEBUG)
 root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-root_logger.addHandler(file_handler)
-root_logger.addHandler(console_handler)
+root_logger.setLevel(log_level)
+root_logger.addHandler(DeferredQueueHandler(log_queue))
 
 # Configure langchain logger
 langchain_logger = logging.getLogger("langchain")
-langchain_logger.setLevel(logging.DEBUG)
+langchain_logger.setLevel(log_level)
+
+# Payload logging (request bodies, messages, chunk contents) can be turned off
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "true").lower() in ("1", "true", "yes")
+# Log every Nth streamed chunk at DEBUG level (0 = none)
+LOG_CHUNK_EVERY = int(os.getenv("LOG_CHUNK_EVERY", "1"))
 
 # Create application logger
 logger = logging.getLogger(__name__)
@@ -68,7 +104,7 @@ os.environ["LANGSMITH_OTEL_ENABLED"] = "false"
 api_key = os.getenv('PPIO_API_KEY', 'NOT_SET')
 api_key_masked = api_key[:8] + "***" if len(api_key) > 8 else "***"
 print(f"🔑 PPIO_API_KEY: {api_key_masked}", flush=True)
-logger.info(f"PPIO_API_KEY (masked): {api_key_masked}")
+logger.info("PPIO_API_KEY (masked): %s", api_key_masked)
 
 print("🤖 Preparing LLM configuration...", flush=True)
 logger.info("Preparing LLM configuration")
@@ -76,135 +112,1267 @@ logger.info("Preparing LLM configuration")
 # LLM base configuration (streaming is not set here, decided dynamically at runtime)
 llm_config = {
     "model": "deepseek/deepseek-v3-0324",
-    "base_url": "https://api.ppinfra.com/v3/openai/",
+    "base_url": os.getenv("OPENAI_BASE_URL", "https://api.ppinfra.com/v3/openai/"),
     "api_key": api_key,
+    # Retries are done by llm_policy below, not by the OpenAI client
+    "max_retries": 0,
 }
 
+
+class LLMCallPolicy:
+    """
+    Retries, deadlines and optional hedging for upstream LLM calls.
+
+    A failed call is retried with full-jitter exponential backoff when the
+    error is worth retrying: HTTP 408/409/429/5xx or a connection error. A
+    Retry-After header from the server is honoured. Each call has a deadline
+    of `call_timeout` seconds, cut short by the request's own deadline (see
+    set_deadline), and no retry is started past it.
+
+    With `hedge` on, a non-streaming call still running after the p95 of
+    recent call latencies gets a second, identical request; the first answer
+    wins and the other request is cancelled. This trades extra tokens on
+    slow calls for a shorter latency tail.
+    """
+
+    RETRY_STATUSES = {408, 409, 429}
+    # Recent call latencies kept to derive the hedge delay
+    LATENCY_SAMPLES = 200
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=8.0, call_timeout=60.0, hedge=False):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.call_timeout = call_timeout
+        self.hedge = hedge
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedges_won": 0, "deadline_exceeded": 0, "failures": 0}
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        # Per request: each request is handled in its own task and context
+        self._request_deadline = contextvars.ContextVar("llm_request_deadline", default=None)
+
+    def set_deadline(self, deadline):
+        """Bound the LLM calls of the current request by `deadline` (time.monotonic())."""
+        self._request_deadline.set(deadline)
+
+    def hedge_after(self):
+        """p95 of recent call latencies, or None until there are enough samples."""
+        if len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    async def call(self, func, hedge=True, status_only=False):
+        """
+        Await `func()` under this policy; each call of `func` sends a new request.
+
+        Pass hedge=False for streaming calls. With `status_only`, only errors
+        carrying an HTTP status are retried: they are raised before any output,
+        while a connection error may interrupt a stream that was already sent on.
+        """
+        hedge = hedge and self.hedge
+        deadline = time.monotonic() + self.call_timeout
+        request_deadline = self._request_deadline.get()
+        if request_deadline is not None:
+            deadline = min(deadline, request_deadline)
+        self.stats["calls"] += 1
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = await self._attempt(func, hedge, deadline)
+            except asyncio.TimeoutError:
+                self.stats["deadline_exceeded"] += 1
+                raise
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, status_only)
+                if delay is None or time.monotonic() + delay >= deadline:
+                    self.stats["failures"] += 1
+                    raise
+                attempt += 1
+                self.stats["retries"] += 1
+                logger.warning("LLM call failed (%s: %s), retry %d in %.2fs", type(e).__name__, e, attempt, delay)
+                await asyncio.sleep(delay)
+                continue
+            if hedge:
+                self._latencies.append(time.monotonic() - start)
+            return result
+
+    async def _attempt(self, func, hedge, deadline):
+        hedge_after = self.hedge_after() if hedge else None
+        if hedge_after is None or time.monotonic() + hedge_after >= deadline:
+            return await asyncio.wait_for(func(), deadline - time.monotonic())
+
+        tasks = [asyncio.ensure_future(func())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                self.stats["hedges"] += 1
+                tasks.append(asyncio.ensure_future(func()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=deadline - time.monotonic(), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+                error = None
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.stats["hedges_won"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _retry_delay(self, error, attempt, status_only):
+        """Backoff before the next attempt, or None if the error isn't retried."""
+        if attempt >= self.max_retries:
+            return None
+        status = getattr(error, "status_code", None)
+        if status is None:
+            # openai.APIConnectionError and its subclass APITimeoutError
+            if status_only or not any(cls.__name__ == "APIConnectionError" for cls in type(error).__mro__):
+                return None
+        elif status not in self.RETRY_STATUSES and status < 500:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        try:
+            delay = max(delay, min(float(headers.get("retry-after", 0)), self.max_delay))
+        except ValueError:
+            pass  # HTTP-date form, use the computed backoff
+        return delay
+
+    def snapshot(self):
+        hedge_after = self.hedge_after()
+        return dict(self.stats, hedge_after_ms=round(hedge_after * 1000, 1) if hedge_after is not None else None)
+
+
+llm_policy = LLMCallPolicy(
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    call_timeout=float(os.getenv("LLM_CALL_TIMEOUT", "60")),
+    hedge=os.getenv("LLM_HEDGE", "false").lower() in ("1", "true", "yes"),
+)
+# Default time budget of one request; a request can pass its own "timeout" (seconds)
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "300"))
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache bounded by the estimated size of its values.
+
+    Entries expire `ttl` seconds after they are stored (a per-entry ttl
+    overrides it). Once the values add up to more than `max_bytes`, the
+    least recently used entries are evicted. None is not a cacheable value.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """Stable key from JSON-serialisable parts (dict keys are sorted)."""
+        data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached value, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None, ttl=None):
+        """Store `value`; `size` defaults to the length of its repr()."""
+        size = len(repr(value)) if size is None else size
+        ttl = self.ttl if ttl is None else ttl
+        if value is None or ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def normalize_args(args):
+    """Normalise tool arguments for a cache key: collapse whitespace and ignore case in strings."""
+    if isinstance(args, str):
+        return " ".join(args.split()).casefold()
+    if isinstance(args, dict):
+        return {name: normalize_args(value) for name, value in args.items()}
+    if isinstance(args, (list, tuple)):
+        return [normalize_args(value) for value in args]
+    return args
+
+
+# Two cache tiers. Tool results are cached for the TTL (seconds) listed per
+# tool; tools not listed are never cached. The LLM response cache is opt-in
+# (LLM_CACHE=true): it replays an answer for the same model, conversation and
+# tools, which only suits deterministic traffic such as FAQ-style prompts.
+# It serves non-streaming calls only, since a cached answer has no tokens to stream.
+TOOL_CACHE = os.getenv("TOOL_CACHE", "true").lower() in ("1", "true", "yes")
+TOOL_CACHE_TTLS = {"duckduckgo_search": 3600}
+tool_cache = ResponseCache(max_bytes=int(os.getenv("TOOL_CACHE_MAX_BYTES", str(16 * 1024 * 1024))))
+LLM_CACHE = os.getenv("LLM_CACHE", "false").lower() in ("1", "true", "yes")
+llm_cache = ResponseCache(
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=int(os.getenv("LLM_CACHE_TTL", "3600")),
+) if LLM_CACHE else None
+
 print("✅ LLM configuration ready", flush=True)
 logger.info("LLM configuration ready")
 
-## Define search tool
-print("🔧 Setting up tools...", flush=True)
-logger.info("Setting up DuckDuckGo search tool")
+# LangChain/LangGraph are imported and the search tool is created on first use
+# rather than at import time: together they take a couple of seconds, which
+# would otherwise delay the first /ping of a cold sandbox. Running
+# `python app.py` starts warm_up() in a background thread, so usually the work
+# is done before the first request arrives.
+ChatOpenAI = StateGraph = START = ToolNode = tools_condition = State = None
+tools = []
+_framework_loaded = False
+_framework_lock = threading.Lock()
+startup_stats = {"framework_load_s": None, "warm_up_s": None, "steps": {}, "errors": []}
+
+
+def _load_framework():
+    """Import the agent framework and create the tools (once, thread-safe)."""
+    global ChatOpenAI, StateGraph, START, ToolNode, tools_condition, State, _framework_loaded
+    if _framework_loaded:
+        return
+    with _framework_lock:
+        if _framework_loaded:
+            return
+        start = time.monotonic()
+        logger.info("Loading LangGraph and setting up DuckDuckGo search tool")
+
+        from langchain_community.tools import DuckDuckGoSearchRun
+        from langchain_openai import ChatOpenAI
+        from langgraph.graph import StateGraph, START
+        from langgraph.graph.message import add_messages
+        from langgraph.prebuilt import ToolNode, tools_condition
+
+        ## Define state
+        class State(TypedDict):
+            messages: Annotated[list, add_messages]
+
+        tools.append(_cached_tool(DuckDuckGoSearchRun()))
 
-from langchain_community.tools import DuckDuckGoSearchRun
-search = DuckDuckGoSearchRun()
-tools = [search]
+        startup_stats["framework_load_s"] = round(time.monotonic() - start, 3)
+        _framework_loaded = True
+        logger.info("Framework loaded in %.2fs", startup_stats["framework_load_s"])
 
-print("✅ Tools configured", flush=True)
-logger.info("Tools configured successfully")
 
-print("📊 Defining state...", flush=True)
-logger.info("Defining state...")
+def _cached_tool(tool):
+    """Wrap a LangChain tool so repeated calls are answered from tool_cache."""
+    from langchain_core.tools import StructuredTool
 
-## Define state
-class State(TypedDict):
-    messages: Annotated[list, add_messages]
+    ttl = TOOL_CACHE_TTLS.get(tool.name)
+    if not TOOL_CACHE or not ttl:
+        return tool
+
+    def cache_key(kwargs):
+        return ResponseCache.make_key(tool.name, normalize_args(kwargs))
+
+    def run(**kwargs):
+        key = cache_key(kwargs)
+        result = tool_cache.get(key)
+        if result is None:
+            result = tool.invoke(kwargs)
+            tool_cache.put(key, result, ttl=ttl)
+        return result
+
+    async def arun(**kwargs):
+        key = cache_key(kwargs)
+        result = tool_cache.get(key)
+        if result is None:
+            result = await tool.ainvoke(kwargs)
+            tool_cache.put(key, result, ttl=ttl)
+        return result
+
+    # Same name, description and schema, so the model sees the same tool
+    return StructuredTool.from_function(
+        func=run, coroutine=arun, name=tool.name, description=tool.description, args_schema=tool.args_schema
+    )
+
+
+def _llm_cache_key(messages):
+    """Key for the LLM response cache: model, conversation and tool names (message ids excluded)."""
+    conversation = [
+        (message.type, message.content, [(call["name"], call["args"]) for call in getattr(message, "tool_calls", None) or []])
+        for message in messages
+    ]
+    return ResponseCache.make_key(llm_config["model"], conversation, [tool.name for tool in tools])
+
+
+# The warm-up also opens a connection to the LLM endpoint (GET /models, no
+# tokens used) so the first request doesn't pay for TCP/TLS setup
+WARM_UP_LLM = os.getenv("WARM_UP_LLM", "true").lower() in ("1", "true", "yes")
+WARM_UP_LLM_TIMEOUT = 10
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+_warm_up_thread_lock = threading.Lock()
+_llm_warm_up_task = None
+
+
+def _warm_up_step(name, func):
+    """Run one warm-up step, recording its duration or error."""
+    start = time.monotonic()
+    try:
+        func()
+    except Exception as e:
+        startup_stats["errors"].append(f"{name}: {e}")
+        logger.warning("Warm-up step %s failed: %s", name, e, exc_info=True)
+        return False
+    startup_stats["steps"][name] = round(time.monotonic() - start, 3)
+    return True
+
+
+async def _warm_up_step_async(name, func):
+    """Run one async warm-up step, recording its duration or error."""
+    start = time.monotonic()
+    try:
+        await func()
+    except Exception as e:
+        startup_stats["errors"].append(f"{name}: {e}")
+        logger.warning("Warm-up step %s failed: %s", name, e, exc_info=True)
+        return False
+    startup_stats["steps"][name] = round(time.monotonic() - start, 3)
+    return True
+
+
+def _exercise_tools():
+    """Validate a placeholder input against each tool's schema; the tools are not run."""
+    for tool in tools:
+        schema = tool.get_input_schema()
+        schema.model_validate({
+            name: "warm-up" for name, field in schema.model_fields.items() if field.is_required()
+        })
+
+
+async def _prime_llm_connection():
+    """Open a pooled connection to the LLM endpoint without generating tokens."""
+    # ChatOpenAI instances with the same base_url share one async httpx
+    # client, the one the graphs' ainvoke()/astream() calls use, so the
+    # connection opened here is reused by requests
+    llm = ChatOpenAI(**llm_config)
+    await llm.root_async_client.with_options(timeout=WARM_UP_LLM_TIMEOUT).models.list()
+
+
+def warm_up():
+    """
+    Get the sandbox ready for its first request.
+
+    Loads the framework, builds both cached graphs and dry-runs the tools;
+    the LLM connection is primed afterwards on the serving loop (see
+    start_llm_warm_up). A failed step is logged and retried lazily by
+    the first request that needs it; the sandbox reports ready either way,
+    unless the framework itself could not be loaded.
+    """
+    with _warm_up_lock:
+        if startup_stats["warm_up_s"] is not None:
+            return
+        start = time.monotonic()
+        if _warm_up_step("framework", _load_framework):
+            _warm_up_step("graphs", lambda: (_get_graph(False), _get_graph(True)))
+            _warm_up_step("tools", _exercise_tools)
+        startup_stats["warm_up_s"] = round(time.monotonic() - start, 3)
+        logger.info("Warm-up finished in %.2fs (errors: %d)", startup_stats["warm_up_s"], len(startup_stats["errors"]))
+
+
+def start_warm_up():
+    """Run warm_up() in a background thread (once)."""
+    global _warm_up_thread
+    with _warm_up_thread_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+            _warm_up_thread.start()
+
+
+def start_llm_warm_up():
+    """
+    Prime the LLM connection on the running (serving) event loop, once
+    warm_up() has loaded the framework.
+
+    The async httpx pool belongs to the loop it is used on, so the warm-up
+    thread can't open its connections.
+    """
+    global _llm_warm_up_task
+    if _llm_warm_up_task is None and WARM_UP_LLM and startup_stats["warm_up_s"] is not None and _framework_loaded:
+        _llm_warm_up_task = asyncio.get_running_loop().create_task(
+            _warm_up_step_async("llm_connection", _prime_llm_connection)
+        )
+
+
+def is_ready():
+    """Ready to take traffic: warm-up (and LLM priming, if enabled) has finished and the framework is loaded."""
+    if startup_stats["warm_up_s"] is None or not _framework_loaded:
+        return False
+    return not WARM_UP_LLM or (_llm_warm_up_task is not None and _llm_warm_up_task.done())
 
-# Note: We don't pre-compile the graph, but create it at runtime based on the streaming parameter
-print("✅ State and tools ready", flush=True)
-logger.info("State and tools ready")
 
 print("🌐 Initializing PPIO AgentRuntimeApp...", flush=True)
 logger.info("Initializing PPIO AgentRuntimeApp")
 
-from ppio_sandbox.agent_runtime import AgentRuntimeApp as PPIOAgentRuntimeApp, RequestContext
+from ppio_sandbox.agent_runtime import AgentRuntimeApp as PPIOAgentRuntimeApp, PingResponse, RequestContext
+from pydantic import ConfigDict
+from starlette.responses import JSONResponse, StreamingResponse
 app = PPIOAgentRuntimeApp(debug=True)
 
+
+class HealthStatus(PingResponse):
+    """
+    Ping response that keeps extra fields.
+
+    The runtime rebuilds a plain dict returned by @app.ping as PingResponse,
+    which silently drops everything except status/message/timestamp.
+    """
+
+    model_config = ConfigDict(extra="allow")
+
 print("✅ AgentRuntimeApp initialized", flush=True)
 logger.info("AgentRuntimeApp initialized successfully")
 
-# Initialize global conversation history - persists throughout sandbox lifecycle
-# All requests to the same sandbox instance share this history
-conversation_history = []
-logger.info("Initialized conversation history (sandbox-scoped)")
+class SQLiteStateStore:
+    """
+    Conversation state persisted to a SQLite database in WAL mode.
+
+    Every message is appended as its own row, so a turn writes only what it
+    added, not the whole conversation. `append()` just queues the row; a
+    background thread commits the queue every `flush_interval` seconds in
+    one transaction, so concurrent turns share a single fsync and request
+    handlers never wait on the disk. `load()` reads a session back (queued
+    rows included) the first time it is used after a restart; it waits while
+    a batch is being committed, so call it from a worker thread.
+
+    With a `retention` (seconds), the writer thread also deletes sessions
+    that have not been written to for that long, whenever it has nothing to
+    commit, so the database does not keep every conversation forever.
+    `load()` treats such a session as deleted even before the sweep gets to it.
+    """
+
+    SWEEP_BATCH = 200
+
+    def __init__(self, path, flush_interval=0.05, retention=None, sweep_interval=60):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        self.appended = 0
+        self.commits = 0
+        self.bytes_written = 0
+        self.loads = 0
+        self.restored_sessions = 0
+        self.load_ms_max = 0.0
+        self.swept_sessions = 0
+        self._pending = []  # (session_id, JSON text, or None to delete the session)
+        self._pending_lock = threading.Lock()
+        # Held while committing a batch, so load() never sees a row both in
+        # the database and in the queue
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            "id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id)")
+        new_sessions_table = not self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sessions'"
+        ).fetchone()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, updated REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+        if new_sessions_table:
+            # Databases written before the sessions table existed: start their clock now
+            self._db.execute(
+                "INSERT OR IGNORE INTO sessions SELECT DISTINCT session_id, ? FROM turns", (time.time(),)
+            )
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="state-store", daemon=True)
+        self._writer.start()
+
+    def append(self, session_id, record):
+        """Queue a JSON-serialisable record for `session_id`"""
+        data = json.dumps(record, ensure_ascii=False)
+        with self._pending_lock:
+            self._pending.append((session_id, data))
+            self.appended += 1
+
+    def delete(self, session_id):
+        """Queue the removal of every record of `session_id`"""
+        with self._pending_lock:
+            self._pending.append((session_id, None))
+
+    def load(self, session_id, limit=None):
+        """Return the session's records, oldest first (only the newest `limit`, if given)"""
+        start = time.perf_counter()
+        with self._db_lock:
+            if self._expire(session_id):
+                rows = []
+            elif limit is None:
+                rows = self._db.execute(
+                    "SELECT data FROM turns WHERE session_id = ? ORDER BY id", (session_id,)
+                ).fetchall()
+            else:
+                rows = self._db.execute(
+                    "SELECT data FROM (SELECT id, data FROM turns WHERE session_id = ? "
+                    "ORDER BY id DESC LIMIT ?) ORDER BY id",
+                    (session_id, limit),
+                ).fetchall()
+            with self._pending_lock:
+                pending = [data for queued_id, data in self._pending if queued_id == session_id]
+        records = [row[0] for row in rows]
+        for data in pending:
+            if data is None:
+                records = []
+            else:
+                records.append(data)
+        if limit is not None:
+            records = records[-limit:]
+        records = [json.loads(data) for data in records]
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._pending_lock:
+            self.loads += 1
+            self.restored_sessions += bool(records)
+            self.load_ms_max = max(self.load_ms_max, elapsed_ms)
+        return records
+
+    def _expire(self, session_id):
+        """
+        Queue the removal of `session_id` if it has not been written to for
+        `retention` seconds, ahead of its queued records; return whether it did.
+        Call with `_db_lock` held.
+        """
+        if self.retention is None:
+            return False
+        expired = self._db.execute(
+            "SELECT 1 FROM sessions WHERE session_id = ? AND updated < ?",
+            (session_id, time.time() - self.retention),
+        ).fetchone()
+        if expired:
+            with self._pending_lock:
+                self._pending.insert(0, (session_id, None))
+        return expired is not None
+
+    def flush(self):
+        """Commit everything queued so far"""
+        with self._db_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            written = set()
+            self._db.execute("BEGIN")
+            try:
+                for session_id, data in batch:
+                    if data is None:
+                        written.discard(session_id)
+                        self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                        self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                    else:
+                        written.add(session_id)
+                        self._db.execute(
+                            "INSERT INTO turns (session_id, data) VALUES (?, ?)", (session_id, data)
+                        )
+                now = time.time()
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO sessions (session_id, updated) VALUES (?, ?)",
+                    [(session_id, now) for session_id in written],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                with self._pending_lock:
+                    self._pending[:0] = batch
+                raise
+            with self._pending_lock:
+                self.commits += 1
+                self.bytes_written += sum(len(data) for _, data in batch if data is not None)
+
+    def sweep(self):
+        """Delete up to SWEEP_BATCH sessions not written to for `retention` seconds, return how many"""
+        if self.retention is None:
+            return 0
+        cutoff = time.time() - self.retention
+        with self._db_lock:
+            expired = [
+                row[0] for row in self._db.execute(
+                    "SELECT session_id FROM sessions WHERE updated < ? LIMIT ?", (cutoff, self.SWEEP_BATCH)
+                ).fetchall()
+            ]
+            with self._pending_lock:
+                # Their queued records will be committed, which makes them recent again
+                queued = {session_id for session_id, _ in self._pending}
+            expired = [session_id for session_id in expired if session_id not in queued]
+            if not expired:
+                return 0
+            self._db.execute("BEGIN")
+            try:
+                for session_id in expired:
+                    self._db.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                    self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        with self._pending_lock:
+            self.swept_sessions += len(expired)
+        return len(expired)
+
+    def _run(self):
+        last_sweep = time.monotonic()
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                with self._pending_lock:
+                    idle = not self._pending
+                # Sweep only when nothing is queued, so it never delays a commit; a full
+                # batch means more may be expired, so sweep again on the next idle tick
+                if (self.retention is not None and idle
+                        and time.monotonic() - last_sweep >= self.sweep_interval):
+                    if self.sweep() < self.SWEEP_BATCH:
+                        last_sweep = time.monotonic()
+            except Exception as e:
+                logger.warning("Failed to write conversation state, will retry: %s", e)
+
+    def close(self):
+        """Stop the writer thread and commit what is left"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._writer.join()
+        self.flush()
+        self._db.close()
+
+    def stats(self):
+        with self._pending_lock:
+            return {
+                "backend": "sqlite",
+                "appended": self.appended,
+                "pending": len(self._pending),
+                "commits": self.commits,
+                "bytes_written": self.bytes_written,
+                "loads": self.loads,
+                "restored_sessions": self.restored_sessions,
+                "load_ms_max": round(self.load_ms_max, 2),
+                "swept_sessions": self.swept_sessions,
+            }
+
+
+def _create_state_store():
+    """
+    Create the conversation state backend selected by STATE_BACKEND.
+
+    "memory" (the default) keeps conversations in process memory only.
+    "sqlite" also writes them to STATE_PATH, so a recycled sandbox picks a
+    conversation up where it left off. Another backend only needs the same
+    append/delete/load/flush/close/stats methods as SQLiteStateStore.
+    """
+    backend = os.getenv("STATE_BACKEND", "memory").lower()
+    if backend == "memory":
+        return None
+    if backend == "sqlite":
+        store = SQLiteStateStore(
+            os.getenv("STATE_PATH", "conversations.db"),
+            flush_interval=float(os.getenv("STATE_FLUSH_INTERVAL", "0.05")),
+            retention=int(os.getenv("SESSION_IDLE_TIMEOUT", "3600")),
+        )
+        atexit.register(store.close)
+        logger.info("Persisting conversation state to %s", store.path)
+        return store
+    raise ValueError(f"Unknown STATE_BACKEND: {backend!r} (expected 'memory' or 'sqlite')")
+
+
+state_store = _create_state_store()
+
+
+class ConversationHistory:
+    """
+    Bounded conversation history with a sliding window.
+
+    Keeps at most `max_messages` messages and `max_tokens` estimated tokens.
+    The oldest messages are evicted first; if a `summarizer` is given it is
+    called with the evicted messages and the previous summary, and the returned
+    text is sent to the model as a system message ahead of the window.
+
+    `turn_lock` serialises the turns of one session: a turn holds it from
+    adding the user message until the reply is saved, so concurrent requests
+    for the same session run one after another, in arrival order.
+
+    With a `store`, every appended message is also written to it under
+    `session_id`.
+    """
+
+    # Rough heuristic, good enough for budgeting without loading a tokenizer
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, max_messages=50, max_tokens=8000, summarizer=None, store=None, session_id=None):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+        self.store = store
+        self.session_id = session_id
+        self.summary = None
+        self.evicted_count = 0
+        self._messages = deque()
+        self._total_tokens = 0
+        self._lock = threading.Lock()
+        self.turn_lock = asyncio.Lock()
+
+    @classmethod
+    def estimate_tokens(cls, content):
+        return len(content) // cls.CHARS_PER_TOKEN + 1
+
+    def append(self, role, content, persist=True):
+        """Add a message and evict the oldest ones if the window is over budget."""
+        tokens = self.estimate_tokens(content)
+        message = {"role": role, "content": content}
+        with self._lock:
+            self._messages.append((message, tokens))
+            self._total_tokens += tokens
+            evicted = self._evict()
+        if persist and self.store is not None:
+            self.store.append(self.session_id, message)
+        if evicted and self.summarizer is not None:
+            try:
+                self.summary = self.summarizer(evicted, self.summary)
+            except Exception as e:
+                logger.warning("History summarizer failed, dropping evicted turns: %s", e)
+
+    def _evict(self):
+        evicted = []
+
+        def over_budget():
+            # Always keep the newest message, even if it alone exceeds the budget
+            if len(self._messages) <= 1:
+                return False
+            return len(self._messages) > self.max_messages or self._total_tokens > self.max_tokens
+
+        while over_budget():
+            message, tokens = self._messages.popleft()
+            self._total_tokens -= tokens
+            evicted.append(message)
+        # Don't start the window with an orphaned assistant reply
+        while evicted and len(self._messages) > 1 and self._messages[0][0]["role"] != "user":
+            message, tokens = self._messages.popleft()
+            self._total_tokens -= tokens
+            evicted.append(message)
+
+        self.evicted_count += len(evicted)
+        return evicted
+
+    def messages(self):
+        """Return the messages to send to the model (summary first, if any)."""
+        with self._lock:
+            window = [message for message, _ in self._messages]
+        if self.summary:
+            window.insert(0, {"role": "system", "content": f"Summary of earlier conversation: {self.summary}"})
+        return window
+
+    def stats(self):
+        with self._lock:
+            return {
+                "messages": len(self._messages),
+                "tokens": self._total_tokens,
+                "evicted": self.evicted_count,
+                "max_messages": self.max_messages,
+                "max_tokens": self.max_tokens,
+            }
+
+    @property
+    def busy(self):
+        """True while a turn is running for this session."""
+        return self.turn_lock.locked()
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class SessionHistories:
+    """
+    Conversation histories keyed by runtime session id.
+
+    Sessions are kept in LRU order. A session is evicted when it has been idle
+    for longer than `idle_timeout` seconds, when more than `max_sessions` are
+    resident, or when the estimated tokens across all sessions exceed
+    `max_total_tokens`. The session being accessed and sessions with a turn
+    in progress are never evicted.
+    """
+
+    def __init__(self, max_sessions=100, idle_timeout=3600, max_total_tokens=1_000_000,
+                 history_factory=ConversationHistory):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_total_tokens = max_total_tokens
+        self.history_factory = history_factory
+        self.evicted_count = 0
+        self._sessions = OrderedDict()  # session_id -> (history, last_active)
+        self._lock = threading.Lock()
+
+    def get(self, session_id, create=True, history=None):
+        """
+        Return the history for `session_id`. A session that is not resident
+        gets `history`, or a new one from history_factory; with create=False
+        it is left alone and None is returned.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                history = entry[0]
+            elif not create:
+                return None
+            elif history is None:
+                history = self.history_factory(session_id=session_id)
+            self._sessions[session_id] = (history, now)
+            self._evict(now)
+            return history
+
+    async def aget(self, session_id):
+        """
+        get() for the event loop. A session that is not resident is created
+        in a worker thread, since history_factory may read it back from the
+        state store; if a concurrent request created it meanwhile, that
+        history is returned and this one is dropped.
+        """
+        history = self.get(session_id, create=False)
+        if history is None:
+            created = await asyncio.to_thread(self.history_factory, session_id=session_id)
+            history = self.get(session_id, history=created)
+        return history
+
+    def _evict(self, now):
+        # Oldest entries first; the last entry is the session being accessed
+        for session_id, (history, last_active) in list(self._sessions.items())[:-1]:
+            if (now - last_active <= self.idle_timeout
+                    and len(self._sessions) <= self.max_sessions
+                    and self._total_tokens() <= self.max_total_tokens):
+                break
+            if history.busy:
+                # Evicting it would let the next request start a fresh
+                # history (and turn lock) while this turn is still running
+                continue
+            del self._sessions[session_id]
+            self.evicted_count += 1
+            logger.info("Evicted conversation history for session %s", session_id)
+
+    def _total_tokens(self):
+        return sum(history.stats()["tokens"] for history, _ in self._sessions.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "tokens": self._total_tokens(),
+                "evicted_sessions": self.evicted_count,
+                "max_sessions": self.max_sessions,
+            }
+
+
+def _new_history(session_id=None):
+    history = ConversationHistory(
+        max_messages=int(os.getenv("HISTORY_MAX_MESSAGES", "50")),
+        max_tokens=int(os.getenv("HISTORY_MAX_TOKENS", "8000")),
+        store=state_store,
+        session_id=session_id,
+    )
+    if state_store is not None:
+        # First use of this session in this process (e.g. after a restart):
+        # reload the newest window; older messages would be evicted anyway
+        for message in state_store.load(session_id, limit=history.max_messages):
+            history.append(message["role"], message["content"], persist=False)
+    return history
+
+
+# Conversation histories - one per runtime session, so several sessions can
+# share a warm sandbox without their conversations bleeding into each other
+session_histories = SessionHistories(
+    max_sessions=int(os.getenv("SESSION_MAX_COUNT", "100")),
+    idle_timeout=int(os.getenv("SESSION_IDLE_TIMEOUT", "3600")),
+    max_total_tokens=int(os.getenv("SESSION_MAX_TOTAL_TOKENS", "1000000")),
+    history_factory=_new_history,
+)
+DEFAULT_SESSION_ID = "default"
+
+
+def _request_session_id(request, context):
+    """
+    Session a request belongs to: the "session_id" field of the request body,
+    else the runtime's sandbox_id, else the default session.
+
+    The PPIO client SDK sends only the body the caller passes, never a
+    sandbox_id, so clients that keep several conversations in one sandbox
+    send "session_id" themselves.
+    """
+    session_id = request.get("session_id") or getattr(context, "session_id", None)
+    return str(session_id) if session_id else DEFAULT_SESSION_ID
+
+logger.info("Initialized session histories: %s", session_histories.stats())
 
 print("="*80, flush=True)
 print("✅ APPLICATION READY - Waiting for requests", flush=True)
 print("="*80 + "\n", flush=True)
 logger.info("Application ready - waiting for requests")
 
-def _handle_streaming(graph, tmp_msg):
+# Compiled graph cache - one graph per streaming mode, shared by all requests.
+# Each entry stores the cache key it was built with; when llm_config or tools
+# change the key no longer matches and the graph is rebuilt on next use.
+_graph_cache = {}
+_graph_cache_lock = threading.Lock()
+graph_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _graph_cache_key(streaming):
+    """Build the cache key from the streaming flag, model config and tool set."""
+    return (
+        bool(streaming),
+        tuple(sorted((k, repr(v)) for k, v in llm_config.items())),
+        tuple((getattr(t, "name", type(t).__name__), id(t)) for t in tools),
+    )
+
+
+def _build_graph(streaming):
+    """Create the LLM, bind tools and compile the agent graph."""
+    logger.info("Building graph with streaming=%s", streaming)
+
+    llm = ChatOpenAI(
+        **llm_config,
+        streaming=streaming  # Set dynamically based on request
+    )
+    llm_with_tools = llm.bind_tools(tools)
+
+    graph_builder = StateGraph(State)
+
+    # Async node, so graph.ainvoke()/astream() wait for the LLM on the event
+    # loop instead of tying up a worker thread per request
+    async def chatbot(state: State):
+        key = _llm_cache_key(state["messages"]) if llm_cache is not None and not streaming else None
+        if key is not None:
+            cached = llm_cache.get(key)
+            if cached is not None:
+                # Without an id, add_messages gives the copy a fresh one
+                return {"messages": [cached.model_copy(update={"id": None})]}
+        # A streaming call sends tokens as they arrive, so it is not hedged
+        # and only retried on errors raised before the first token
+        message = await llm_policy.call(
+            lambda: llm_with_tools.ainvoke(state["messages"]),
+            hedge=not streaming,
+            status_only=streaming,
+        )
+        if key is not None:
+            llm_cache.put(key, message, size=len(message.model_dump_json()))
+        return {"messages": [message]}
+
+    graph_builder.add_node("chatbot", chatbot)
+    tool_node = ToolNode(tools=tools)
+    graph_builder.add_node("tools", tool_node)
+    graph_builder.add_conditional_edges("chatbot", tools_condition)
+    graph_builder.add_edge("tools", "chatbot")
+    graph_builder.add_edge(START, "chatbot")
+
+    return graph_builder.compile()
+
+
+def _get_graph(streaming):
+    """
+    Return the compiled graph for the given streaming mode.
+
+    The graph is built lazily on first use and reused by all later requests
+    until llm_config or tools change.
+    """
+    _load_framework()
+    key = _graph_cache_key(streaming)
+    with _graph_cache_lock:
+        entry = _graph_cache.get(bool(streaming))
+        if entry is not None and entry[0] == key:
+            graph_cache_stats["hits"] += 1
+            return entry[1]
+
+        graph_cache_stats["misses"] += 1
+        if entry is not None:
+            logger.info("Graph config changed, rebuilding graph (streaming=%s)", streaming)
+        graph = _build_graph(streaming)
+        _graph_cache[bool(streaming)] = (key, graph)
+        return graph
+
+
+class StreamAccumulator:
+    """
+    Collects streamed chunks of one response in O(n) time.
+
+    Chunks are kept in a list and joined in blocks of `BLOCK_PARTS`, so a
+    long answer costs one copy per block instead of a new string per chunk,
+    and memory stays close to the size of the text itself. Set `max_chars`
+    to cap how much is kept (e.g. for history); the stream sent to the client
+    is never truncated.
+    """
+
+    BLOCK_PARTS = 256
+
+    def __init__(self, max_chars=None):
+        self.max_chars = max_chars
+        self.chars = 0
+        self.truncated = False
+        self._blocks = []  # joined groups of BLOCK_PARTS chunks
+        self._pending = []
+
+    def append(self, text):
+        if not text:
+            return
+        if self.max_chars is not None:
+            room = self.max_chars - self.chars
+            if len(text) > room:
+                self.truncated = True
+                text = text[:max(room, 0)]
+                if not text:
+                    return
+        self._pending.append(text)
+        self.chars += len(text)
+        if len(self._pending) >= self.BLOCK_PARTS:
+            self._blocks.append("".join(self._pending))
+            self._pending.clear()
+
+    def text(self):
+        """Return the accumulated text (joined once, then cached)"""
+        if self._pending:
+            self._blocks.append("".join(self._pending))
+            self._pending.clear()
+        if len(self._blocks) > 1:
+            self._blocks = ["".join(self._blocks)]
+        return self._blocks[0] if self._blocks else ""
+
+    def __len__(self):
+        return self.chars
+
+
+def _new_accumulator():
+    max_chars = int(os.getenv("STREAM_MAX_CHARS", "0"))
+    return StreamAccumulator(max_chars=max_chars or None)
+
+
+# Run counters: runs abandoned by the client before completion, graph runs
+# in progress, and turns that waited for an earlier turn of the same session
+run_stats = {"cancelled_runs": 0, "active_runs": 0, "queued_turns": 0}
+
+
+@asynccontextmanager
+async def _session_turn(session_id, prompt):
+    """
+    Run one conversation turn for `session_id`.
+
+    Waits for the session's previous turns to finish, adds the user message
+    and yields (history, graph input). Different sessions don't wait for
+    each other, so one sandbox overlaps many sessions' LLM calls.
+
+    Requests that name no session share the default history but are not
+    ordered: they are unrelated clients, and queueing them all behind one
+    lock would run the sandbox one request at a time.
     """
-    Handle streaming requests - independent generator function.
+    conversation_history = await session_histories.aget(session_id)
+    if session_id == DEFAULT_SESSION_ID:
+        turn_lock = nullcontext()
+    else:
+        turn_lock = conversation_history.turn_lock
+        if conversation_history.busy:
+            run_stats["queued_turns"] += 1
+            logger.info("Session %s has a turn in progress, waiting", session_id)
+    async with turn_lock:
+        # Add new user message to session history
+        conversation_history.append("user", prompt)
+        logger.info("Added user message to history. Total messages: %d", len(conversation_history))
+
+        # Use the bounded history window (including new user message)
+        tmp_msg = {"messages": conversation_history.messages()}
+        logger.info("Using conversation history with %d messages", len(conversation_history))
+        if LOG_PAYLOADS:
+            logger.debug("Message structure: %s", tmp_msg)
+
+        run_stats["active_runs"] += 1
+        try:
+            yield conversation_history, tmp_msg
+        finally:
+            run_stats["active_runs"] -= 1
+
+
+# Marks the end of graph.astream() in the queue fed by _pump_graph_stream
+_STREAM_END = object()
+
+
+async def _pump_graph_stream(graph, graph_input, items):
+    """Put graph.astream() chunks on `items`, then _STREAM_END (or the exception raised)."""
+    try:
+        async for item in graph.astream(graph_input, stream_mode="messages"):
+            await items.put(item)
+    except Exception as e:
+        await items.put(e)
+    else:
+        await items.put(_STREAM_END)
+
+
+async def _handle_streaming(graph, session_id, prompt, deadline):
+    """
+    Handle streaming requests - independent async generator function.
     
     Streams LLM response chunks in real-time and accumulates the complete
-    response to save in conversation history.
+    response to save in conversation history. graph.astream() runs in its own
+    task, which is cancelled when the client disconnects: Starlette stops a
+    disconnected stream with an anyio cancel scope, and that does not reach
+    the LLM call awaited inside the graph, but cancelling the task does, so
+    the upstream LLM stream is closed as well.
     """
     logger.info("Using streaming mode")
+    llm_policy.set_deadline(deadline)
     
+    chunk_count = 0
     try:
-        chunk_count = 0
-        accumulated_content = ""  # Accumulate complete response
-        
-        # Use stream_mode="messages" to get LLM tokens
-        # Reference: https://docs.langchain.com/oss/python/langgraph/streaming
-        logger.debug("Starting graph.stream() iteration...")
-        
-        for chunk, metadata in graph.stream(tmp_msg, stream_mode="messages"):
-            chunk_count += 1
-            logger.debug(f"Received chunk #{chunk_count}, type: {type(chunk)}, metadata: {metadata}")
+        async with _session_turn(session_id, prompt) as (conversation_history, tmp_msg):
+            accumulated = _new_accumulator()  # Accumulate complete response
             
-            # chunk is the message block returned by LLM
-            if hasattr(chunk, 'content') and chunk.content:
-                content = chunk.content
-                accumulated_content += content  # Accumulate content
-                logger.debug(f"Streaming chunk content: {content[:100]}...")
-                # Yield directly, SDK will automatically handle SSE format
-                yield {"chunk": content, "type": "content"}
-            else:
-                logger.debug(f"Chunk has no content or empty content, chunk: {chunk}")
-        
-        # Add complete AI response to global history
-        if accumulated_content:
-            conversation_history.append({"role": "assistant", "content": accumulated_content})
-            logger.info(f"Added assistant message to history. Total messages: {len(conversation_history)}")
+            # Use stream_mode="messages" to get LLM tokens
+            # Reference: https://docs.langchain.com/oss/python/langgraph/streaming
+            logger.debug("Starting graph.astream() iteration...")
+            
+            items = asyncio.Queue(maxsize=64)
+            producer = asyncio.create_task(_pump_graph_stream(graph, tmp_msg, items))
+            try:
+                while True:
+                    item = await items.get()
+                    if item is _STREAM_END:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    chunk, metadata = item
+                    chunk_count += 1
+                    log_chunk = LOG_CHUNK_EVERY > 0 and chunk_count % LOG_CHUNK_EVERY == 0
+                    if log_chunk:
+                        logger.debug("Received chunk #%d, type: %s, metadata: %s", chunk_count, type(chunk).__name__, metadata)
+                
+                    # chunk is the message block returned by LLM
+                    if hasattr(chunk, 'content') and chunk.content:
+                        content = chunk.content
+                        accumulated.append(content)  # Accumulate content
+                        if log_chunk and LOG_PAYLOADS:
+                            logger.debug("Streaming chunk content: %.100s...", content)
+                        # Yield directly, SDK will automatically handle SSE format
+                        yield {"chunk": content, "type": "content"}
+                    else:
+                        if log_chunk and LOG_PAYLOADS:
+                            logger.debug("Chunk has no content or empty content, chunk: %s", chunk)
+            finally:
+                # No-op once the stream has ended; on a disconnect this cancels
+                # the graph run and its in-flight LLM request
+                producer.cancel()
+            
+            # Add complete AI response to session history
+            if accumulated:
+                conversation_history.append("assistant", accumulated.text())
+                if accumulated.truncated:
+                    logger.warning("Response exceeded STREAM_MAX_CHARS, kept the first %d chars in history", len(accumulated))
+                logger.info("Added assistant message to history. Total messages: %d", len(conversation_history))
         
         # Streaming end marker
-        logger.info(f"Streaming completed, total chunks: {chunk_count}")
+        logger.info("Streaming completed, total chunks: %d", chunk_count)
         yield {"chunk": "", "type": "end"}
+    
+    except (asyncio.CancelledError, GeneratorExit):
+        # Client disconnected: the runtime cancels (or closes) this generator,
+        # and the finally above cancels the graph run and the in-flight LLM
+        # call. The partial answer is not added to history.
+        run_stats["cancelled_runs"] += 1
+        logger.info("Client disconnected, cancelled graph run after %d chunks", chunk_count)
+        raise
         
     except Exception as e:
-        logger.error(f"Error during streaming: {str(e)}", exc_info=True)
+        logger.error("Error during streaming: %s", e, exc_info=True)
         yield {"error": str(e), "type": "error"}
 
 
-def _handle_non_streaming(graph, tmp_msg):
+async def _handle_non_streaming(graph, session_id, prompt, deadline):
     """
-    Handle non-streaming requests - regular function that returns a dict.
+    Handle non-streaming requests - coroutine that returns a dict.
     
-    Invokes the graph, extracts the response, and saves it to conversation history.
+    Invokes the graph with graph.ainvoke(), extracts the response, and saves
+    it to conversation history.
     """
     logger.info("Using non-streaming mode")
+    llm_policy.set_deadline(deadline)
     
     try:
-        logger.info("About to call graph.invoke()")
-        tmp_output = graph.invoke(tmp_msg)
-        
-        logger.info("graph.invoke() completed successfully")
-        logger.debug(f"Graph output: {tmp_output}")
+        async with _session_turn(session_id, prompt) as (conversation_history, tmp_msg):
+            logger.info("About to call graph.ainvoke()")
+            tmp_output = await graph.ainvoke(tmp_msg)
+            
+            logger.info("graph.ainvoke() completed successfully")
+            if LOG_PAYLOADS:
+                logger.debug("Graph output: %s", tmp_output)
 
-        # Get the last message
-        last_message = tmp_output['messages'][-1]
-        logger.info(f"Last message type: {type(last_message)}")
-        logger.info(f"Last message has 'content': {hasattr(last_message, 'content')}")
-        
-        # Check if message has content
-        if hasattr(last_message, 'content') and last_message.content:
-            result_content = last_message.content
-            logger.info("Successfully extracted content from last message")
-        else:
-            # If no content, try to get information from tool call results
-            # or return a default message
-            result_content = "I've completed the search and gathered information. The search was successful."
-            logger.warning("No content in last message, using default response")
-        
-        # Add AI response to global history
-        conversation_history.append({"role": "assistant", "content": result_content})
-        logger.info(f"Added assistant message to history. Total messages: {len(conversation_history)}")
+            # Get the last message
+            last_message = tmp_output['messages'][-1]
+            logger.info("Last message type: %s", type(last_message).__name__)
+            logger.info("Last message has 'content': %s", hasattr(last_message, 'content'))
+            
+            # Check if message has content
+            if hasattr(last_message, 'content') and last_message.content:
+                result_content = last_message.content
+                logger.info("Successfully extracted content from last message")
+            else:
+                # If no content, try to get information from tool call results
+                # or return a default message
+                result_content = "I've completed the search and gathered information. The search was successful."
+                logger.warning("No content in last message, using default response")
+            
+            # Add AI response to session history
+            conversation_history.append("assistant", result_content)
+            logger.info("Added assistant message to history. Total messages: %d", len(conversation_history))
         
-        logger.info(f"Returning result (length: {len(result_content)} chars)")
-        logger.debug(f"Result preview: {result_content[:200]}...")
+        logger.info("Returning result (length: %d chars)", len(result_content))
+        if LOG_PAYLOADS:
+            logger.debug("Result preview: %.200s...", result_content)
         
         response = {"result": result_content}
         logger.info("Returning response")
@@ -212,7 +1380,7 @@ def _handle_non_streaming(graph, tmp_msg):
         return response
         
     except Exception as graph_error:
-        logger.error(f"Error during graph.invoke(): {str(graph_error)}", exc_info=True)
+        logger.error("Error during graph.ainvoke(): %s", graph_error, exc_info=True)
         
         error_response = {
             "error": f"Graph invocation failed: {str(graph_error)}",
@@ -221,74 +1389,197 @@ def _handle_non_streaming(graph, tmp_msg):
         return error_response
 
 
+class AdmissionController:
+    """
+    Limits how many agent runs execute at once in this sandbox.
+
+    Up to `max_concurrent` runs execute; further requests wait in a FIFO
+    queue of at most `max_queue` entries for up to `queue_timeout` seconds.
+    Requests that find the queue full, or time out in it, are rejected so the
+    client can retry elsewhere or later. `max_concurrent=0` disables the limit.
+    """
+
+    # Recent queue waits kept for the percentiles reported by /ping
+    WAIT_SAMPLES = 1000
+
+    def __init__(self, max_concurrent=32, max_queue=64, queue_timeout=30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._avg_run_s = None  # moving average of run durations
+        self._waits = deque(maxlen=self.WAIT_SAMPLES)
+        self._semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent > 0 else None
+
+    @property
+    def saturated(self):
+        """True when every run slot is taken, so new requests queue."""
+        return self._semaphore is not None and (self.queued > 0 or self.in_flight >= self.max_concurrent)
+
+    async def acquire(self):
+        """Wait for a run slot. Returns a release callback, or None if rejected."""
+        start = time.monotonic()
+        if self._semaphore is not None:
+            if not self._semaphore.locked():
+                await self._semaphore.acquire()
+            elif self.queued >= self.max_queue:
+                self.rejected += 1
+                return None
+            else:
+                self.queued += 1
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    return None
+                finally:
+                    self.queued -= 1
+        admitted_at = time.monotonic()
+        self._waits.append(admitted_at - start)
+        self.in_flight += 1
+        self.admitted += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.in_flight -= 1
+            duration = time.monotonic() - admitted_at
+            self._avg_run_s = duration if self._avg_run_s is None else 0.8 * self._avg_run_s + 0.2 * duration
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+        return release
+
+    def retry_after(self):
+        """Seconds a rejected client should wait: about the time to drain the queue."""
+        if not self._avg_run_s or self._semaphore is None:
+            return 1
+        return max(1, math.ceil(self._avg_run_s * (self.queued + 1) / self.max_concurrent))
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def wait_ms(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p / 100))] * 1000, 1) if waits else 0.0
+
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms": {"p50": wait_ms(50), "p95": wait_ms(95), "max": wait_ms(100)},
+        }
+
+
+admission = AdmissionController(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_RUNS", "32")),
+    max_queue=int(os.getenv("MAX_QUEUED_RUNS", "64")),
+    queue_timeout=float(os.getenv("QUEUE_TIMEOUT", "30")),
+)
+
+
+async def _release_after(body_iterator, release):
+    """Pass a streaming body through, releasing the run slot when it ends."""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        release()
+
+
+@app.middleware
+async def admission_control(request, call_next):
+    """
+    Admit /invocations requests through the admission controller.
+
+    Rejected requests get HTTP 429 with a Retry-After header. A streaming
+    response holds its slot until the stream ends, not just until the
+    entrypoint returns.
+    """
+    release = await admission.acquire()
+    if release is None:
+        retry_after = admission.retry_after()
+        logger.warning("Rejected request: %d runs in flight, %d queued", admission.in_flight, admission.queued)
+        return JSONResponse(
+            {"error": "Too many requests in progress, retry later", "status": "error", "retry_after": retry_after},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)},
+        )
+    try:
+        response = await call_next(request)
+    except BaseException:
+        release()
+        raise
+    if isinstance(response, StreamingResponse):
+        # The finalizer covers a client that disconnects before the stream starts
+        weakref.finalize(response, release)
+        response.body_iterator = _release_after(response.body_iterator, release)
+    else:
+        release()
+    return response
+
+
+# Async entrypoint: the runtime awaits it on the event loop instead of running
+# it in a worker thread, so requests from many sessions wait on the LLM
+# concurrently while turns of the same session stay in order (_session_turn)
 @app.entrypoint
-def agent_invocation(request: dict, context: RequestContext):
+async def agent_invocation(request: dict, context: RequestContext):
     logger.info("="*80)
     logger.info("🚀 AGENT INVOCATION STARTED")
     logger.info("="*80)
-    logger.info(f"Request type: {type(request)}")
-    logger.info(f"Request keys: {list(request.keys())}")
-    logger.info(f"Request details: {request}")
+    logger.info("Request type: %s", type(request).__name__)
+    logger.info("Request keys: %s", list(request.keys()))
+    if LOG_PAYLOADS:
+        logger.info("Request details: %s", request)
     
     try:
         # Get prompt and streaming parameters from request
         prompt = request.get("prompt", "No prompt found in input, please guide customer as to what tools can be used")
         streaming = request.get("streaming", False)
+        deadline = time.monotonic() + float(request.get("timeout") or REQUEST_TIMEOUT)
         
         # Detailed debug information
-        logger.info(f"Raw 'streaming' value from request.get('streaming'): {request.get('streaming')}")
-        logger.info(f"Raw 'streaming' type: {type(request.get('streaming'))}")
-        logger.info(f"After default False, streaming value: {streaming}")
+        logger.debug("Raw 'streaming' value from request.get('streaming'): %r", request.get('streaming'))
         
-        logger.info(f"Processing prompt: {prompt}")
-        logger.info(f"Streaming mode: {streaming}, type: {type(streaming)}")
+        if LOG_PAYLOADS:
+            logger.info("Processing prompt: %s", prompt)
+        logger.info("Streaming mode: %s", streaming)
         
-        # Add new user message to global history
-        conversation_history.append({"role": "user", "content": prompt})
-        logger.info(f"Added user message to history. Total messages: {len(conversation_history)}")
+        # The session's history is looked up and updated by the handler,
+        # once the session's previous turn has finished
+        session_id = _request_session_id(request, context)
+        logger.info("Session: %s", session_id)
         
-        # Use complete conversation history (including new user message)
-        tmp_msg = {"messages": list(conversation_history)}
-        logger.info(f"Using conversation history with {len(conversation_history)} messages")
-        logger.debug(f"Message structure: {tmp_msg}")
-        
-        # Create LLM and graph based on streaming parameter
-        logger.info(f"Creating LLM with streaming={streaming}")
-        
-        llm = ChatOpenAI(
-            **llm_config,
-            streaming=streaming  # Set dynamically based on request
-        )
-        llm_with_tools = llm.bind_tools(tools)
-        
-        # Build graph
-        graph_builder = StateGraph(State)
-        
-        def chatbot(state: State):
-            return {"messages": [llm_with_tools.invoke(state["messages"])]}
-        
-        graph_builder.add_node("chatbot", chatbot)
-        tool_node = ToolNode(tools=tools)
-        graph_builder.add_node("tools", tool_node)
-        graph_builder.add_conditional_edges("chatbot", tools_condition)
-        graph_builder.add_edge("tools", "chatbot")
-        graph_builder.add_edge(START, "chatbot")
-        
-        graph = graph_builder.compile()
+        # Get cached graph for this streaming mode (built during warm-up;
+        # if warm-up is still loading the framework, wait for it off the loop)
+        if _framework_loaded:
+            graph = _get_graph(streaming)
+        else:
+            graph = await asyncio.to_thread(_get_graph, streaming)
         
-        logger.info("Graph created successfully")
+        logger.info("Graph ready (cache hits: %d, misses: %d)", graph_cache_stats['hits'], graph_cache_stats['misses'])
     
         # Choose handler function based on streaming parameter
         if streaming:
-            # Return generator - will be recognized as streaming response by AgentRuntimeApp
-            return _handle_streaming(graph, tmp_msg)
+            # Return async generator - will be recognized as streaming response by AgentRuntimeApp
+            return _handle_streaming(graph, session_id, prompt, deadline)
         else:
             # Return dict - will be recognized as regular response by AgentRuntimeApp
-            return _handle_non_streaming(graph, tmp_msg)
+            return await _handle_non_streaming(graph, session_id, prompt, deadline)
     
     except Exception as outer_error:
         # Top-level exception handling
-        logger.error(f"Unhandled error in agent_invocation: {str(outer_error)}", exc_info=True)
+        logger.error("Unhandled error in agent_invocation: %s", outer_error, exc_info=True)
         
         error_response = {
             "error": f"Agent error: {str(outer_error)}",
@@ -298,9 +1589,32 @@ def agent_invocation(request: dict, context: RequestContext):
         return error_response
 
 @app.ping
-def health_check() -> dict:
+def health_check() -> HealthStatus:
     logger.debug("Health check endpoint called")
-    return {"status": "healthy", "service": "My Agent"}
+    # Start warming up if the app wasn't launched through __main__; the ping
+    # handler runs on the serving loop, where the LLM connection is primed
+    start_warm_up()
+    start_llm_warm_up()
+    ready = is_ready()
+    saturated = admission.saturated
+    return HealthStatus(
+        # HealthyBusy until warm-up is done, so traffic is only routed to warm
+        # sandboxes, and while every run slot is taken
+        status="healthy" if ready and not saturated else "healthybusy",
+        message="warming up" if not ready else "at capacity" if saturated else None,
+        service="My Agent",
+        alive=True,
+        ready=ready,
+        graph_cache=dict(graph_cache_stats),
+        history=session_histories.stats(),
+        state=state_store.stats() if state_store is not None else {"backend": "memory"},
+        runs=dict(run_stats),
+        admission=admission.stats(),
+        llm=llm_policy.snapshot(),
+        cache={"tools": tool_cache.stats(), "llm": llm_cache.stats() if llm_cache is not None else None},
+        startup=dict(startup_stats),
+    )
 
 if __name__ == "__main__":
+    start_warm_up()
     app.run(port=8080)
@@ -10,22 +10,47 @@ OpenAI Agents SDK 示例项目
 - 完整集成 PPIO Agent Runtime
 """
 
+import ast
 import asyncio
+import contextvars
+import functools
+import hashlib
+import json
 import logging
+import math
+import operator
 import os
-from typing import Dict, Any
+import random
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # 加载环境变量
 from dotenv import load_dotenv
 
 # 导入 PPIO Agent Runtime
-from ppio_sandbox.agent_runtime import AgentRuntimeApp
+from ppio_sandbox.agent_runtime import AgentRuntimeApp, PingResponse
+from pydantic import ConfigDict
+from starlette.responses import JSONResponse, StreamingResponse
 
 # 加载 .env 文件
 load_dotenv()
 
 app = AgentRuntimeApp()
 
+
+class HealthStatus(PingResponse):
+    """
+    保留额外字段的健康检查响应
+    
+    @app.ping 返回普通 dict 时，Runtime 会用它重新构建 PingResponse，
+    status/message/timestamp 之外的字段会被丢弃。
+    """
+    
+    model_config = ConfigDict(extra="allow")
+
 # 设置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -36,12 +61,312 @@ logger = logging.getLogger("openai_agents")
 # 注意：由于 OpenAI Agents SDK 还在早期开发阶段，这里使用简化版本
 # 实际使用时，请根据 OpenAI 官方文档进行调整
 
-try:
-    from openai import AsyncOpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OPENAI_AVAILABLE = False
-    logger.warning("OpenAI SDK 未安装，将使用模拟模式")
+# openai SDK 导入耗时约 1 秒，放到首次使用时再导入，冷启动的沙箱可以更快
+# 响应 /ping。以 `python app.py` 启动时会在后台线程中执行 warm_up()，
+# 通常在第一个请求到达前就已完成导入并创建好客户端。
+OPENAI_AVAILABLE = None  # 首次加载前未知
+httpx = AsyncOpenAI = DefaultAsyncHttpxClient = None
+_framework_lock = threading.Lock()
+startup_stats = {"framework_load_s": None, "warm_up_s": None, "steps": {}, "errors": []}
+
+
+def _load_framework():
+    """导入 openai SDK（只执行一次，线程安全），返回是否可用"""
+    global OPENAI_AVAILABLE, httpx, AsyncOpenAI, DefaultAsyncHttpxClient
+    if OPENAI_AVAILABLE is not None:
+        return OPENAI_AVAILABLE
+    with _framework_lock:
+        if OPENAI_AVAILABLE is not None:
+            return OPENAI_AVAILABLE
+        start = time.monotonic()
+        try:
+            import httpx
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+            OPENAI_AVAILABLE = True
+        except ImportError:
+            OPENAI_AVAILABLE = False
+            logger.warning("OpenAI SDK 未安装，将使用模拟模式")
+        startup_stats["framework_load_s"] = round(time.monotonic() - start, 3)
+        logger.info(f"框架加载耗时 {startup_stats['framework_load_s']} 秒")
+    return OPENAI_AVAILABLE
+
+
+async def _ensure_framework():
+    """在线程中加载 openai SDK，避免首次导入阻塞事件循环"""
+    if OPENAI_AVAILABLE is None:
+        await asyncio.to_thread(_load_framework)
+    return OPENAI_AVAILABLE
+
+
+# 预热时请求一次 GET /models（不消耗 token），提前建立到 LLM 服务的连接，
+# 第一个请求无需再等待 TCP/TLS 握手
+WARM_UP_LLM = os.getenv("WARM_UP_LLM", "true").lower() in ("1", "true", "yes")
+WARM_UP_LLM_TIMEOUT = 10
+_warm_up_lock = threading.Lock()
+_warm_up_task = None
+
+
+def _warm_up_failed(name, e):
+    startup_stats["errors"].append(f"{name}: {e}")
+    logger.warning(f"预热步骤 {name} 失败：{e}", exc_info=True)
+
+
+def _warm_up_step(name, func):
+    """执行一个同步预热步骤，记录耗时或错误"""
+    start = time.monotonic()
+    try:
+        func()
+    except Exception as e:
+        _warm_up_failed(name, e)
+        return
+    startup_stats["steps"][name] = round(time.monotonic() - start, 3)
+
+
+async def _warm_up_step_async(name, func):
+    """执行一个异步预热步骤，记录耗时或错误"""
+    start = time.monotonic()
+    try:
+        await func()
+    except Exception as e:
+        _warm_up_failed(name, e)
+        return
+    startup_stats["steps"][name] = round(time.monotonic() - start, 3)
+
+
+def warm_up():
+    """在第一个请求之前导入 SDK 并创建共享客户端（只执行一次）"""
+    with _warm_up_lock:
+        if "framework" in startup_stats["steps"]:
+            return
+        _warm_up_step("framework", _load_framework)
+        if OPENAI_AVAILABLE:
+            _warm_up_step("client", get_client)
+
+
+# 连接池配置（可通过环境变量调整）
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "false").lower() in ("1", "true", "yes")
+
+
+class LLMCallPolicy:
+    """
+    上游 LLM 调用的重试、截止时间和可选的对冲请求
+
+    出错时如果值得重试（HTTP 408/409/429/5xx 或连接错误），按带完全抖动的指数退避
+    重试，并遵循服务端返回的 Retry-After。每次调用的截止时间为 `call_timeout` 秒，
+    且不晚于请求自身的截止时间（见 set_deadline），超过截止时间不再重试。
+
+    开启 `hedge` 后，非流式调用在超过近期调用耗时的 p95 后仍未返回时，会再发出一个
+    相同的请求，先返回的结果胜出，另一个请求被取消。以慢调用多消耗的 token
+    换取更短的长尾延迟。
+    """
+
+    RETRY_STATUSES = {408, 409, 429}
+    # 保留最近的调用耗时，用于计算对冲延迟
+    LATENCY_SAMPLES = 200
+    HEDGE_MIN_SAMPLES = 20
+
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=8.0, call_timeout=60.0, hedge=False):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.call_timeout = call_timeout
+        self.hedge = hedge
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedges_won": 0, "deadline_exceeded": 0, "failures": 0}
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        # 按请求区分：每个请求在各自的 task 和 context 中处理
+        self._request_deadline = contextvars.ContextVar("llm_request_deadline", default=None)
+
+    def set_deadline(self, deadline):
+        """为当前请求的 LLM 调用设置截止时间（time.monotonic() 时间）"""
+        self._request_deadline.set(deadline)
+
+    def hedge_after(self):
+        """近期调用耗时的 p95；样本不足时返回 None"""
+        if len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def _deadline(self):
+        deadline = time.monotonic() + self.call_timeout
+        request_deadline = self._request_deadline.get()
+        return deadline if request_deadline is None else min(deadline, request_deadline)
+
+    async def call(self, func, hedge=True):
+        """
+        按本策略等待 `func()` 的结果，每次调用 `func` 都会发出一个新请求
+
+        流式调用传入 hedge=False。
+        """
+        hedge = hedge and self.hedge
+        deadline = self._deadline()
+        self.stats["calls"] += 1
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = await self._attempt(func, hedge, deadline)
+            except asyncio.TimeoutError:
+                self.stats["deadline_exceeded"] += 1
+                raise
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None or time.monotonic() + delay >= deadline:
+                    self.stats["failures"] += 1
+                    raise
+                attempt += 1
+                self.stats["retries"] += 1
+                logger.warning(f"LLM 调用失败（{type(e).__name__}: {e}），{delay:.2f} 秒后第 {attempt} 次重试")
+                await asyncio.sleep(delay)
+                continue
+            if hedge:
+                self._latencies.append(time.monotonic() - start)
+            return result
+
+    async def stream_chunks(self, stream):
+        """
+        逐个返回流式响应 `stream` 的片段，读取过程同样受截止时间约束
+
+        call() 只约束打开流式响应；上游中途停止输出时，这里在截止时间到达后抛出
+        asyncio.TimeoutError（计入 deadline_exceeded），而不是一直等到 HTTP 读超时。
+        """
+        deadline = self._deadline()
+        chunks = stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), deadline - time.monotonic())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                self.stats["deadline_exceeded"] += 1
+                raise asyncio.TimeoutError("LLM 流式响应超过截止时间") from None
+            yield chunk
+
+    async def _attempt(self, func, hedge, deadline):
+        hedge_after = self.hedge_after() if hedge else None
+        if hedge_after is None or time.monotonic() + hedge_after >= deadline:
+            return await asyncio.wait_for(func(), deadline - time.monotonic())
+
+        tasks = [asyncio.ensure_future(func())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                self.stats["hedges"] += 1
+                tasks.append(asyncio.ensure_future(func()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=deadline - time.monotonic(), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+                error = None
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.stats["hedges_won"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _retry_delay(self, error, attempt):
+        """下一次重试前的退避时间；不重试时返回 None"""
+        if attempt >= self.max_retries:
+            return None
+        status = getattr(error, "status_code", None)
+        if status is None:
+            # openai.APIConnectionError 及其子类 APITimeoutError
+            if not any(cls.__name__ == "APIConnectionError" for cls in type(error).__mro__):
+                return None
+        elif status not in self.RETRY_STATUSES and status < 500:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        try:
+            delay = max(delay, min(float(headers.get("retry-after", 0)), self.max_delay))
+        except ValueError:
+            pass  # HTTP 日期格式，使用计算出的退避时间
+        return delay
+
+    def snapshot(self):
+        hedge_after = self.hedge_after()
+        return dict(self.stats, hedge_after_ms=round(hedge_after * 1000, 1) if hedge_after is not None else None)
+
+
+llm_policy = LLMCallPolicy(
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    call_timeout=float(os.getenv("LLM_CALL_TIMEOUT", "60")),
+    hedge=os.getenv("LLM_HEDGE", "false").lower() in ("1", "true", "yes"),
+)
+# 单个请求的默认时间预算；请求可以通过 "timeout" 字段（秒）自行指定
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "300"))
+
+
+# 进程级共享的 OpenAI 客户端，所有请求复用同一个连接池
+_client = None
+
+
+def create_client():
+    """
+    创建带 keep-alive 连接池的 OpenAI 客户端
+    
+    Returns:
+        AsyncOpenAI 客户端
+    """
+    http2 = OPENAI_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("未安装 h2，HTTP/2 不可用，回退到 HTTP/1.1（pip install 'httpx[http2]'）")
+            http2 = False
+    
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        http2=http2,
+    )
+    logger.info(
+        f"创建 OpenAI 客户端：max_connections={OPENAI_MAX_CONNECTIONS}，"
+        f"max_keepalive={OPENAI_MAX_KEEPALIVE_CONNECTIONS}，"
+        f"keepalive_expiry={OPENAI_KEEPALIVE_EXPIRY}s，http2={http2}"
+    )
+    return AsyncOpenAI(
+        base_url=os.getenv("OPENAI_API_BASE"),
+        api_key=os.getenv("PPIO_API_KEY"),
+        timeout=float(os.getenv("OPENAI_TIMEOUT", "60")),
+        # 重试由 llm_policy 负责，客户端自身不再重试
+        max_retries=0,
+        http_client=http_client,
+    )
+
+
+def get_client():
+    """获取共享的 OpenAI 客户端（首次调用时创建）"""
+    global _client
+    if _client is None:
+        _load_framework()
+        with _framework_lock:
+            if _client is None:
+                _client = create_client()
+    return _client
+
+
+async def close_client():
+    """关闭共享的 OpenAI 客户端，释放连接池"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.close()
 
 
 # 定义工具函数
@@ -60,6 +385,72 @@ def get_current_time(timezone: str = "UTC") -> str:
     return f"当前时间（UTC）：{now.strftime('%Y-%m-%d %H:%M:%S')}"
 
 
+# 安全的算术表达式求值：只允许数字和算术运算符，不执行任意代码
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+MAX_EXPRESSION_LENGTH = 200
+MAX_EXPONENT = 1000
+# 整数结果最多的二进制位数（约 1233 位十进制数），嵌套的乘方和乘法也受此限制
+MAX_RESULT_BITS = 4096
+
+
+def _check_result_size(op, left, right):
+    """在计算之前估算整数乘方/乘法结果的位数，超过 MAX_RESULT_BITS 时拒绝"""
+    if type(left) is not int or type(right) is not int:
+        return
+    if isinstance(op, ast.Pow) and right > 0:
+        bits = left.bit_length() * right
+    elif isinstance(op, ast.Mult):
+        bits = left.bit_length() + right.bit_length()
+    else:
+        return
+    if bits > MAX_RESULT_BITS:
+        raise ValueError(f"结果过大（超过 {MAX_RESULT_BITS} 个二进制位）")
+
+
+def _eval_node(node):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        left = _eval_node(node.left)
+        right = _eval_node(node.right)
+        if isinstance(node.op, ast.Pow) and abs(right) > MAX_EXPONENT:
+            raise ValueError(f"指数过大（最大 {MAX_EXPONENT}）")
+        _check_result_size(node.op, left, right)
+        return _BINARY_OPERATORS[type(node.op)](left, right)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](_eval_node(node.operand))
+    raise ValueError(f"不支持的表达式：{type(node).__name__}")
+
+
+@functools.lru_cache(maxsize=1024)
+def evaluate_expression(expression: str):
+    """
+    计算算术表达式（结果按表达式缓存；整数结果不超过 MAX_RESULT_BITS 位，缓存占用有上限）
+    
+    Args:
+        expression: 只包含数字、+ - * / // % ** 和括号的表达式
+        
+    Returns:
+        计算结果
+    """
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"表达式过长（最大 {MAX_EXPRESSION_LENGTH} 个字符）")
+    tree = ast.parse(expression.strip(), mode="eval")
+    return _eval_node(tree.body)
+
+
 def calculate(expression: str) -> str:
     """
     计算数学表达式
@@ -71,8 +462,7 @@ def calculate(expression: str) -> str:
         计算结果
     """
     try:
-        # 安全地计算表达式
-        result = eval(expression, {"__builtins__": {}}, {})
+        result = evaluate_expression(expression)
         return f"计算结果：{expression} = {result}"
     except Exception as e:
         return f"计算错误：{str(e)}"
@@ -158,105 +548,689 @@ TOOL_FUNCTIONS = {
     "get_weather": get_weather,
 }
 
+# JSON Schema 类型到 Python 类型的映射（覆盖 TOOLS 中用到的子集）
+_JSON_SCHEMA_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "object": dict,
+    "array": list,
+}
+
+
+def compile_validator(schema: dict):
+    """
+    根据工具的 parameters schema 预先生成参数校验函数
+    
+    Args:
+        schema: JSON Schema（type 为 object）
+        
+    Returns:
+        校验函数，参数不合法时抛出 ValueError
+    """
+    properties = schema.get("properties", {})
+    required = tuple(schema.get("required", ()))
+    expected_types = {
+        name: prop["type"] for name, prop in properties.items() if prop.get("type") in _JSON_SCHEMA_TYPES
+    }
+    
+    def validate(args):
+        if not isinstance(args, dict):
+            raise ValueError("参数必须是 JSON 对象")
+        missing = [name for name in required if name not in args]
+        if missing:
+            raise ValueError(f"缺少必需参数：{', '.join(missing)}")
+        for name, value in args.items():
+            if name not in properties:
+                raise ValueError(f"未知参数：{name}")
+            expected = expected_types.get(name)
+            if expected is None:
+                continue
+            # bool 是 int 的子类，需要单独排除
+            if not isinstance(value, _JSON_SCHEMA_TYPES[expected]) or (
+                isinstance(value, bool) and expected != "boolean"
+            ):
+                raise ValueError(f"参数 {name} 应为 {expected} 类型")
+        return args
+    
+    return validate
+
+
+# 启动时为每个工具生成一次校验函数
+TOOL_VALIDATORS = {
+    tool["function"]["name"]: compile_validator(tool["function"].get("parameters", {}))
+    for tool in TOOLS
+}
+
+
+def parse_tool_arguments(function_name: str, arguments: str) -> dict:
+    """
+    解析并校验模型生成的工具参数
+    
+    Args:
+        function_name: 工具名称
+        arguments: JSON 字符串（无参数时可能为空）
+        
+    Returns:
+        参数字典，不合法时抛出 ValueError
+    """
+    args = json.loads(arguments) if arguments and arguments.strip() else {}
+    return TOOL_VALIDATORS[function_name](args)
+
+
+class ResponseCache:
+    """
+    按值的估算大小限制容量的内存 LRU 缓存
+
+    条目在写入 `ttl` 秒后过期（单个条目可以指定自己的 ttl）。所有值的大小之和
+    超过 `max_bytes` 时，淘汰最久未使用的条目。None 不会被缓存。
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """由可 JSON 序列化的各部分生成稳定的键（dict 的键会排序）"""
+        data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        """返回缓存的值，未命中时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None, ttl=None):
+        """写入 `value`；`size` 默认为其 repr() 的长度"""
+        size = len(repr(value)) if size is None else size
+        ttl = self.ttl if ttl is None else ttl
+        if value is None or ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def normalize_args(args):
+    """规范化工具参数用于缓存键：字符串合并空白并忽略大小写"""
+    if isinstance(args, str):
+        return " ".join(args.split()).casefold()
+    if isinstance(args, dict):
+        return {name: normalize_args(value) for name, value in args.items()}
+    if isinstance(args, (list, tuple)):
+        return [normalize_args(value) for value in args]
+    return args
+
+
+# 两级缓存。工具结果按下面为每个工具配置的 TTL（秒）缓存，未列出的工具
+# （例如依赖当前时间的 get_current_time）不缓存。LLM 响应缓存需要显式开启
+# （LLM_CACHE=true）：相同模型、对话和工具直接返回之前的回答，只适合 FAQ 这类
+# 确定性的流量。只用于非流式调用，缓存的回答没有可以流式输出的 token。
+TOOL_CACHE = os.getenv("TOOL_CACHE", "true").lower() in ("1", "true", "yes")
+TOOL_CACHE_TTLS = {
+    "calculate": 86400,
+    "get_weather": 600,
+}
+tool_cache = ResponseCache(max_bytes=int(os.getenv("TOOL_CACHE_MAX_BYTES", str(16 * 1024 * 1024))))
+LLM_CACHE = os.getenv("LLM_CACHE", "false").lower() in ("1", "true", "yes")
+llm_cache = ResponseCache(
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=int(os.getenv("LLM_CACHE_TTL", "3600")),
+) if LLM_CACHE else None
+
+
+# 工具执行配置：同步工具在有界线程池中执行，避免阻塞事件循环
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "30"))
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "8"))
+
+# 单个工具的超时时间（秒），未配置的工具使用 TOOL_TIMEOUT
+TOOL_TIMEOUTS = {
+    "get_current_time": 5,
+    "calculate": 5,
+    "get_weather": 10,
+}
+
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
 
-async def run_agent(query: str) -> str:
+async def execute_tool_call(tool_call_id: str, function_name: str, arguments: str, use_cache: bool = True) -> dict:
+    """
+    执行单个工具调用
+    
+    异步工具直接 await，同步工具提交到线程池执行；超时或出错时
+    把错误信息作为工具结果返回给模型，不会中断其他工具调用。
+    
+    Args:
+        tool_call_id: 工具调用 ID
+        function_name: 工具名称
+        arguments: 模型生成的参数（JSON 字符串）
+        use_cache: 是否读写工具结果缓存（预热时关闭）
+        
+    Returns:
+        tool 角色的消息
+    """
+    func = TOOL_FUNCTIONS.get(function_name)
+    timeout = TOOL_TIMEOUTS.get(function_name, TOOL_TIMEOUT)
+    
+    if func is None:
+        logger.warning(f"未知工具：{function_name}")
+        return _tool_message(tool_call_id, function_name, f"未知工具：{function_name}")
+    
+    try:
+        function_args = parse_tool_arguments(function_name, arguments)
+    except ValueError as e:
+        logger.warning(f"工具 {function_name} 参数不合法：{e}")
+        return _tool_message(tool_call_id, function_name, f"参数错误：{str(e)}")
+    
+    cache_ttl = TOOL_CACHE_TTLS.get(function_name) if TOOL_CACHE and use_cache else None
+    if cache_ttl:
+        cache_key = ResponseCache.make_key(function_name, normalize_args(function_args))
+        cached = tool_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"工具 {function_name} 命中缓存，参数：{function_args}")
+            return _tool_message(tool_call_id, function_name, cached)
+    
+    try:
+        logger.info(f"调用工具：{function_name}，参数：{function_args}")
+        
+        if asyncio.iscoroutinefunction(func):
+            pending = func(**function_args)
+        else:
+            loop = asyncio.get_running_loop()
+            pending = loop.run_in_executor(_tool_executor, functools.partial(func, **function_args))
+        function_response = await asyncio.wait_for(pending, timeout)
+        if cache_ttl:
+            # 只缓存成功的结果
+            tool_cache.put(cache_key, function_response, ttl=cache_ttl)
+    except asyncio.TimeoutError:
+        logger.warning(f"工具 {function_name} 执行超时（{timeout}s）")
+        function_response = f"工具执行超时：{function_name} 超过 {timeout} 秒未返回"
+    except Exception as e:
+        logger.error(f"工具 {function_name} 执行错误：{e}", exc_info=True)
+        function_response = f"工具执行错误：{str(e)}"
+    
+    return _tool_message(tool_call_id, function_name, function_response)
+
+
+def _tool_message(tool_call_id: str, function_name: str, content: str) -> dict:
+    return {
+        "tool_call_id": tool_call_id,
+        "role": "tool",
+        "name": function_name,
+        "content": content
+    }
+
+
+
+# 最多执行的工具调用轮数，超过后要求模型直接给出最终回答
+MAX_TOOL_ROUNDS = int(os.getenv("MAX_TOOL_ROUNDS", "5"))
+
+SYSTEM_PROMPT = "你是一个有用的 AI 助手，可以获取时间、计算数学表达式和查询天气。"
+
+
+def _initial_messages(query: str) -> list:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": query}
+    ]
+
+
+def _completion_kwargs(messages: list, round_index: int) -> dict:
+    """构造 chat.completions.create 参数；最后一轮不再提供工具"""
+    kwargs = {
+        "model": os.getenv("MODEL_NAME", "deepseek/deepseek-v3.1-terminus"),
+        "messages": messages,
+    }
+    if round_index < MAX_TOOL_ROUNDS:
+        kwargs["tools"] = TOOLS
+        kwargs["tool_choice"] = "auto"
+    return kwargs
+
+
+def _llm_cache_key(kwargs: dict) -> str:
+    """LLM 响应缓存的键：模型、对话和工具名称"""
+    messages = [
+        message.model_dump(exclude_none=True) if hasattr(message, "model_dump") else message
+        for message in kwargs["messages"]
+    ]
+    tools = [tool["function"]["name"] for tool in kwargs.get("tools", [])]
+    return ResponseCache.make_key(kwargs["model"], messages, tools)
+
+
+async def _create_completion(client, kwargs: dict):
+    """非流式调用模型；开启 LLM_CACHE 时先查缓存"""
+    key = _llm_cache_key(kwargs) if llm_cache is not None else None
+    if key is not None:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return cached
+    response = await llm_policy.call(lambda: client.chat.completions.create(**kwargs))
+    if key is not None:
+        llm_cache.put(key, response, size=len(response.model_dump_json()))
+    return response
+
+
+async def _run_tool_calls(tool_calls: list) -> list:
+    """并发执行所有工具调用，gather 按 tool_call 的原始顺序返回结果"""
+    return await asyncio.gather(
+        *(
+            execute_tool_call(call["id"], call["function"]["name"], call["function"]["arguments"])
+            for call in tool_calls
+        )
+    )
+
+
+async def run_agent(query: str, deadline: float = None) -> str:
     """
     运行 OpenAI Agent
     
+    循环调用模型并执行其请求的工具，直到模型给出最终回答，
+    最多执行 MAX_TOOL_ROUNDS 轮工具调用。
+    
     Args:
         query: 用户查询
+        deadline: 请求的截止时间（time.monotonic() 时间，可选）
         
     Returns:
         Agent 响应
     """
-    if not OPENAI_AVAILABLE:
+    if not await _ensure_framework():
         # 模拟模式
         return f"（模拟响应）收到查询：{query}。OpenAI SDK 未安装，请安装后使用完整功能。"
     
     try:
         logger.info(f"运行 Agent，查询：{query}")
+        llm_policy.set_deadline(deadline)
         
-        # 初始化 OpenAI 客户端
-        client = AsyncOpenAI(
-          base_url=os.getenv("OPENAI_API_BASE"),
-          api_key=os.getenv("PPIO_API_KEY"),
-        )
+        # 复用共享的 OpenAI 客户端（连接池中的连接保持 keep-alive）
+        client = get_client()
+        messages = _initial_messages(query)
         
-        # 第一次调用：发送用户消息和工具定义
-        messages = [
-            {"role": "system", "content": "你是一个有用的 AI 助手，可以获取时间、计算数学表达式和查询天气。"},
-            {"role": "user", "content": query}
-        ]
+        for round_index in range(MAX_TOOL_ROUNDS + 1):
+            response = await _create_completion(client, _completion_kwargs(messages, round_index))
+            response_message = response.choices[0].message
+            
+            # 没有工具调用，得到最终回答
+            if not response_message.tool_calls:
+                logger.info(f"Agent 执行完成，工具调用轮数：{round_index}")
+                return response_message.content
+            
+            # 将助手的响应添加到消息历史，然后执行工具
+            messages.append(response_message)
+            tool_calls = [
+                {
+                    "id": call.id,
+                    "function": {"name": call.function.name, "arguments": call.function.arguments},
+                }
+                for call in response_message.tool_calls
+            ]
+            messages.extend(await _run_tool_calls(tool_calls))
         
-        response = await client.chat.completions.create(
-            model=os.getenv("MODEL_NAME", "deepseek/deepseek-v3.1-terminus"),
-            messages=messages,
-            tools=TOOLS,
-            tool_choice="auto"
-        )
+        # 最后一轮不提供工具，正常情况下不会走到这里
+        return response_message.content or ""
         
-        response_message = response.choices[0].message
+    except Exception as e:
+        logger.error(f"Agent 执行错误：{e}", exc_info=True)
+        raise
+
+
+class StreamAccumulator:
+    """
+    以 O(n) 开销累积一次流式响应的所有片段
+    
+    片段先放入列表，每 BLOCK_PARTS 个拼接成一块，长回复只需每块复制一次，
+    而不是每个片段都生成新字符串，内存占用也接近文本本身大小。
+    max_chars 限制保留的字符数，发送给客户端的流不受影响。
+    """
+    
+    BLOCK_PARTS = 256
+    
+    def __init__(self, max_chars=None):
+        self.max_chars = max_chars
+        self.chars = 0
+        self.truncated = False
+        self._blocks = []  # 每 BLOCK_PARTS 个片段拼接成的块
+        self._pending = []
+    
+    def append(self, text):
+        if not text:
+            return
+        if self.max_chars is not None:
+            room = self.max_chars - self.chars
+            if len(text) > room:
+                self.truncated = True
+                text = text[:max(room, 0)]
+                if not text:
+                    return
+        self._pending.append(text)
+        self.chars += len(text)
+        if len(self._pending) >= self.BLOCK_PARTS:
+            self._blocks.append("".join(self._pending))
+            self._pending.clear()
+    
+    def text(self):
+        """返回累积的完整文本（只拼接一次，之后复用）"""
+        if self._pending:
+            self._blocks.append("".join(self._pending))
+            self._pending.clear()
+        if len(self._blocks) > 1:
+            self._blocks = ["".join(self._blocks)]
+        return self._blocks[0] if self._blocks else ""
+    
+    def __len__(self):
+        return self.chars
+
+
+# 客户端在完成前断开的运行次数
+run_stats = {"cancelled_runs": 0}
+
+
+async def run_agent_stream(query: str, deadline: float = None):
+    """
+    流式运行 OpenAI Agent
+    
+    与 run_agent 使用相同的多轮工具调用循环，但以 stream=True 调用模型，
+    收到文本增量后立即输出；工具调用参数从增量中逐步拼接完整后再执行。
+    
+    Args:
+        query: 用户查询
+        deadline: 请求的截止时间（time.monotonic() 时间，可选）
         
-        # 检查是否需要调用工具
-        if response_message.tool_calls:
-            # 将助手的响应添加到消息历史
-            messages.append(response_message)
+    Yields:
+        {"chunk": ..., "type": "content"} 文本片段，最后是 {"chunk": "", "type": "end"}
+    """
+    if not await _ensure_framework():
+        yield {"chunk": f"（模拟响应）收到查询：{query}。OpenAI SDK 未安装，请安装后使用完整功能。", "type": "content"}
+        yield {"chunk": "", "type": "end"}
+        return
+    
+    try:
+        logger.info(f"流式运行 Agent，查询：{query}")
+        llm_policy.set_deadline(deadline)
+        
+        client = get_client()
+        messages = _initial_messages(query)
+        
+        for round_index in range(MAX_TOOL_ROUNDS + 1):
+            # 出错时尚未输出任何内容，可以安全重试；流式调用不做对冲
+            kwargs = _completion_kwargs(messages, round_index)
+            stream = await llm_policy.call(
+                lambda: client.chat.completions.create(**kwargs, stream=True),
+                hedge=False,
+            )
             
-            # 处理每个工具调用
-            for tool_call in response_message.tool_calls:
-                function_name = tool_call.function.name
-                function_args = eval(tool_call.function.arguments)
-                
-                logger.info(f"调用工具：{function_name}，参数：{function_args}")
-                
-                # 执行工具函数
-                function_response = TOOL_FUNCTIONS[function_name](**function_args)
-                
-                # 将工具响应添加到消息历史
-                messages.append({
-                    "tool_call_id": tool_call.id,
-                    "role": "tool",
-                    "name": function_name,
-                    "content": function_response
-                })
+            # 本轮的文本和工具调用参数（会发回给模型，不截断）
+            content = StreamAccumulator()
+            tool_calls = {}  # index -> 正在拼接的工具调用
+            # 退出时关闭模型的流式响应（包括客户端断开导致的取消）
+            async with stream:
+                async for chunk in llm_policy.stream_chunks(stream):
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    
+                    if delta.content:
+                        content.append(delta.content)
+                        yield {"chunk": delta.content, "type": "content"}
+                    
+                    # 工具调用的 id、名称和参数按 index 分片到达，逐步拼接
+                    for call_delta in delta.tool_calls or []:
+                        call = tool_calls.setdefault(
+                            call_delta.index,
+                            {"id": "", "name": "", "arguments": StreamAccumulator()},
+                        )
+                        if call_delta.id:
+                            call["id"] = call_delta.id
+                        if call_delta.function:
+                            if call_delta.function.name:
+                                call["name"] += call_delta.function.name
+                            call["arguments"].append(call_delta.function.arguments)
             
-            # 第二次调用：获取最终响应
-            final_response = await client.chat.completions.create(
-                model=os.getenv("MODEL_NAME", "deepseek/deepseek-v3.1-terminus"),
-                messages=messages
-            )
+            # 没有工具调用，得到最终回答
+            if not tool_calls:
+                logger.info(f"Agent 流式执行完成，工具调用轮数：{round_index}")
+                break
             
-            result = final_response.choices[0].message.content
-        else:
-            result = response_message.content
+            ordered_calls = [
+                {
+                    "id": call["id"],
+                    "type": "function",
+                    "function": {"name": call["name"], "arguments": call["arguments"].text()},
+                }
+                for _, call in sorted(tool_calls.items())
+            ]
+            messages.append({
+                "role": "assistant",
+                "content": content.text() or None,
+                "tool_calls": ordered_calls,
+            })
+            messages.extend(await _run_tool_calls(ordered_calls))
         
-        logger.info("Agent 执行完成")
-        return result
+        yield {"chunk": "", "type": "end"}
+    
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端断开连接：Runtime 会取消（或关闭）本生成器，正在进行的模型
+        # 流式响应随之关闭，等待中的工具调用被取消（线程池中已开始执行的
+        # 同步工具会运行完毕，结果被丢弃）
+        run_stats["cancelled_runs"] += 1
+        logger.info("客户端已断开，已取消 Agent 运行")
+        raise
         
     except Exception as e:
-        logger.error(f"Agent 执行错误：{e}", exc_info=True)
+        logger.error(f"Agent 流式执行错误：{e}", exc_info=True)
+        yield {"error": str(e), "type": "error"}
+
+
+class AdmissionController:
+    """
+    限制沙箱内同时执行的 Agent 运行数
+
+    最多 `max_concurrent` 个运行同时执行；其余请求进入最多 `max_queue` 个位置的
+    先进先出队列，最长等待 `queue_timeout` 秒。队列已满或等待超时的请求会被拒绝，
+    客户端可以稍后重试或换一个沙箱。`max_concurrent=0` 表示不限制。
+    """
+
+    # 保留最近的排队耗时，用于 /ping 中的分位数
+    WAIT_SAMPLES = 1000
+
+    def __init__(self, max_concurrent=32, max_queue=64, queue_timeout=30.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._avg_run_s = None  # 运行耗时的滑动平均
+        self._waits = deque(maxlen=self.WAIT_SAMPLES)
+        # 在第一次 acquire() 时于服务的事件循环中创建：Python 3.9 的 asyncio.Semaphore
+        # 会绑定创建时的事件循环，而导入时的循环并不是 uvicorn 运行的循环
+        self._semaphore = None
+
+    @property
+    def saturated(self):
+        """运行名额已用满、新请求需要排队时为 True"""
+        return self.max_concurrent > 0 and (self.queued > 0 or self.in_flight >= self.max_concurrent)
+
+    async def acquire(self):
+        """等待运行名额，返回释放回调；被拒绝时返回 None"""
+        start = time.monotonic()
+        if self.max_concurrent > 0:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            if not self._semaphore.locked():
+                await self._semaphore.acquire()
+            elif self.queued >= self.max_queue:
+                self.rejected += 1
+                return None
+            else:
+                self.queued += 1
+                try:
+                    await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    return None
+                finally:
+                    self.queued -= 1
+        admitted_at = time.monotonic()
+        self._waits.append(admitted_at - start)
+        self.in_flight += 1
+        self.admitted += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.in_flight -= 1
+            duration = time.monotonic() - admitted_at
+            self._avg_run_s = duration if self._avg_run_s is None else 0.8 * self._avg_run_s + 0.2 * duration
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+        return release
+
+    def retry_after(self):
+        """被拒绝的客户端建议等待的秒数：约为排空队列所需的时间"""
+        if not self._avg_run_s or self.max_concurrent <= 0:
+            return 1
+        return max(1, math.ceil(self._avg_run_s * (self.queued + 1) / self.max_concurrent))
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def wait_ms(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p / 100))] * 1000, 1) if waits else 0.0
+
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms": {"p50": wait_ms(50), "p95": wait_ms(95), "max": wait_ms(100)},
+        }
+
+
+admission = AdmissionController(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_RUNS", "32")),
+    max_queue=int(os.getenv("MAX_QUEUED_RUNS", "64")),
+    queue_timeout=float(os.getenv("QUEUE_TIMEOUT", "30")),
+)
+
+
+async def _release_after(body_iterator, release):
+    """透传流式响应体，流结束时释放运行名额"""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        release()
+
+
+@app.middleware
+async def admission_control(request, call_next):
+    """
+    /invocations 请求的准入控制
+
+    被拒绝的请求返回 HTTP 429 和 Retry-After 头。流式响应在流结束时才释放名额，
+    而不是入口函数返回时。
+    """
+    release = await admission.acquire()
+    if release is None:
+        retry_after = admission.retry_after()
+        logger.warning(f"拒绝请求：{admission.in_flight} 个运行中，{admission.queued} 个排队")
+        return JSONResponse(
+            {"error": "当前请求过多，请稍后重试", "status": "error", "retry_after": retry_after},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)},
+        )
+    try:
+        response = await call_next(request)
+    except BaseException:
+        release()
         raise
+    if isinstance(response, StreamingResponse):
+        # 客户端在流开始前断开时，由 finalizer 释放名额
+        weakref.finalize(response, release)
+        response.body_iterator = _release_after(response.body_iterator, release)
+    else:
+        release()
+    return response
 
 
 # 定义 PPIO Agent Runtime 入口点（支持异步）
 @app.entrypoint
-async def agent_invocation(request: dict) -> dict:
+async def agent_invocation(request: dict):
     """
     OpenAI Agents SDK 入口点
     
     Args:
         request: 请求数据，包含以下字段：
             - prompt: 用户输入的查询
+            - streaming: 是否使用流式输出（可选，默认 False）
             
     Returns:
-        响应数据字典，包含 result 字段
+        响应数据字典（非流式，包含 result 字段）或异步生成器（流式）
     """
     prompt = request.get("prompt", "你好！")
+    streaming = request.get("streaming", False)
+    deadline = time.monotonic() + float(request.get("timeout") or REQUEST_TIMEOUT)
     
     print(f"📨 收到请求：{prompt}")
     
+    if streaming:
+        # 返回异步生成器 - AgentRuntimeApp 会将其作为 SSE 流式响应
+        return run_agent_stream(prompt, deadline)
+    
     try:
-        result = await run_agent(prompt)
+        result = await run_agent(prompt, deadline)
         
         print(f"✅ 返回响应：{result[:100]}...")
         
@@ -274,9 +1248,93 @@ async def agent_invocation(request: dict) -> dict:
         }
 
 
+# 预热时用于演练工具调用路径的参数（工具均为本地函数，执行无副作用）
+WARM_UP_TOOL_ARGS = {
+    "get_current_time": {},
+    "calculate": {"expression": "1 + 1"},
+    "get_weather": {"city": "北京"},
+}
+
+
+async def _exercise_tools():
+    """按真实请求的路径执行一遍每个工具（参数校验、线程池、工具函数），不经过结果缓存"""
+    for name, args in WARM_UP_TOOL_ARGS.items():
+        message = await execute_tool_call("warm-up", name, json.dumps(args), use_cache=False)
+        if message["content"].startswith(("未知工具", "参数错误", "工具执行")):
+            raise RuntimeError(message["content"])
+
+
+async def _prime_llm_connection():
+    """在共享连接池中建立到 LLM 服务的连接，不生成 token"""
+    await get_client().with_options(timeout=WARM_UP_LLM_TIMEOUT).models.list()
+
+
+async def _warm_up_async():
+    """
+    完整的预热流程，在服务的事件循环上运行
+    
+    异步客户端的连接池绑定在事件循环上，因此建立 LLM 连接和演练工具
+    必须在这里完成，而不是在后台线程中。某个步骤失败只会记录下来，
+    第一个请求会按需重试；无论成功与否，预热结束后都报告就绪。
+    """
+    start = time.monotonic()
+    await asyncio.to_thread(warm_up)
+    await _warm_up_step_async("tools", _exercise_tools)
+    if WARM_UP_LLM and OPENAI_AVAILABLE:
+        await _warm_up_step_async("llm_connection", _prime_llm_connection)
+    startup_stats["warm_up_s"] = round(time.monotonic() - start, 3)
+    logger.info(f"预热完成，耗时 {startup_stats['warm_up_s']} 秒，失败步骤 {len(startup_stats['errors'])} 个")
+
+
+def start_warm_up():
+    """在当前事件循环上启动预热任务（只启动一次）"""
+    global _warm_up_task
+    if _warm_up_task is None:
+        _warm_up_task = asyncio.get_running_loop().create_task(_warm_up_async())
+
+
+def is_ready():
+    """预热已完成，可以接收流量"""
+    return startup_stats["warm_up_s"] is not None
+
+
+@app.ping
+async def health_check() -> HealthStatus:
+    """健康检查端点"""
+    # 第一次健康检查时启动预热；预热完成前返回 HealthyBusy，
+    # 编排系统只会把流量路由到已预热的沙箱
+    start_warm_up()
+    ready = is_ready()
+    saturated = admission.saturated
+    return HealthStatus(
+        # 运行名额用满时同样返回 HealthyBusy，编排系统据此扩容
+        status="healthy" if ready and not saturated else "healthybusy",
+        message="预热中" if not ready else "已满载" if saturated else None,
+        service="OpenAI Agents SDK Runtime",
+        alive=True,
+        ready=ready,
+        runs=dict(run_stats),
+        admission=admission.stats(),
+        llm=llm_policy.snapshot(),
+        cache={"tools": tool_cache.stats(), "llm": llm_cache.stats() if llm_cache is not None else None},
+        startup=dict(startup_stats),
+    )
+
+
 if __name__ == "__main__":
     print("🚀 启动 OpenAI Agents SDK Runtime...")
     print("🛠️  可用工具：get_current_time, calculate, get_weather")
     print("🔗 监听端口：8080")
-    app.run()
+    
+    # 服务启动的同时在后台导入 SDK 并创建客户端（其余预热步骤在第一次
+    # 健康检查时于事件循环上完成），退出时关闭连接池
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    try:
+        app.run()
+    finally:
+        if OPENAI_AVAILABLE:
+            try:
+                asyncio.run(close_client())
+            except Exception as e:
+                logger.warning(f"关闭 OpenAI 客户端失败：{e}")
 
@@ -0,0 +1,154 @@
+"""
+OpenAI 客户端连接池基准测试
+
+对比两种方式在本地 OpenAI 兼容桩服务器上的延迟：
+- fresh：每个请求新建 AsyncOpenAI 客户端（旧实现）
+- pooled：所有请求复用 app.py 中的共享客户端（keep-alive 连接池）
+
+每个"请求"包含两次 chat completion 调用，与带工具调用的 Agent 请求一致。
+
+用法：
+    python tests/bench_client_pool.py --requests 200 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHAT_COMPLETION = {
+    "id": "chatcmpl-bench",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "bench-model",
+    "choices": [
+        {
+            "index": 0,
+            "message": {"role": "assistant", "content": "ok"},
+            "finish_reason": "stop",
+        }
+    ],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """最小的 OpenAI 兼容 /chat/completions 桩实现（支持 keep-alive）"""
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.latency:
+            time.sleep(self.latency)
+        body = json.dumps(CHAT_COMPLETION).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency):
+    StubHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def one_request(client):
+    for _ in range(2):
+        await client.chat.completions.create(
+            model="bench-model",
+            messages=[{"role": "user", "content": "hi"}],
+        )
+
+
+async def run_mode(mode, app, requests, concurrency):
+    from openai import AsyncOpenAI
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def worker():
+        async with semaphore:
+            start = time.perf_counter()
+            if mode == "fresh":
+                client = AsyncOpenAI(
+                    base_url=os.environ["OPENAI_API_BASE"],
+                    api_key=os.environ["PPIO_API_KEY"],
+                )
+                try:
+                    await one_request(client)
+                finally:
+                    await client.close()
+            else:
+                await one_request(app.get_client())
+            latencies.append(time.perf_counter() - start)
+
+    StubHandler.connections = 0
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(requests)))
+    wall = time.perf_counter() - wall_start
+    if mode == "pooled":
+        await app.close_client()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests": requests,
+        "rps": requests / wall,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "connections": StubHandler.connections,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI client pooling benchmark")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="stub server latency per call")
+    args = parser.parse_args()
+
+    server = start_stub_server(args.latency_ms / 1000)
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.setdefault("PPIO_API_KEY", "bench")
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    print("\n" + "=" * 80)
+    print(f"🚀 Client pool benchmark: {args.requests} requests, concurrency {args.concurrency}")
+    print("=" * 80)
+    for mode in ("fresh", "pooled"):
+        # 预热一次，排除导入开销
+        asyncio.run(run_mode(mode, app, 1, 1))
+        result = asyncio.run(run_mode(mode, app, args.requests, args.concurrency))
+        print(
+            f"{result['mode']:>7}: {result['rps']:8.1f} req/s  "
+            f"mean {result['mean_ms']:7.2f} ms  p50 {result['p50_ms']:7.2f} ms  "
+            f"p95 {result['p95_ms']:7.2f} ms  connections {result['connections']}"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+工具参数解析与表达式计算微基准测试
+
+对比每次调用的开销：
+- 参数解析：eval(arguments)（旧实现） vs json.loads + 预编译 schema 校验
+- 表达式计算：eval(expression)（旧实现） vs AST 白名单求值（未命中缓存 / 命中缓存）
+
+用法：
+    python tests/bench_tool_args.py --number 100000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+ARGUMENTS = '{"expression": "(12.5 + 7) * 3 - 42 / 6"}'
+EXPRESSION = "(12.5 + 7) * 3 - 42 / 6"
+
+
+def report(name, seconds, number):
+    print(f"{name:<40} {seconds / number * 1e6:8.2f} µs/call")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tool argument decoding microbenchmark")
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+    number = args.number
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    print("\n" + "=" * 80)
+    print(f"🚀 Tool argument microbenchmark ({number} calls each)")
+    print("=" * 80)
+
+    report("arguments: eval", timeit.timeit(lambda: eval(ARGUMENTS), number=number), number)
+    report(
+        "arguments: json + validator",
+        timeit.timeit(lambda: app.parse_tool_arguments("calculate", ARGUMENTS), number=number),
+        number,
+    )
+
+    report(
+        "expression: eval",
+        timeit.timeit(lambda: eval(EXPRESSION, {"__builtins__": {}}, {}), number=number),
+        number,
+    )
+
+    def uncached():
+        app.evaluate_expression.cache_clear()
+        app.evaluate_expression(EXPRESSION)
+
+    report("expression: AST evaluator (cache miss)", timeit.timeit(uncached, number=number), number)
+    app.evaluate_expression(EXPRESSION)
+    report(
+        "expression: AST evaluator (cache hit)",
+        timeit.timeit(lambda: app.evaluate_expression(EXPRESSION), number=number),
+        number,
+    )
+
+
+if __name__ == "__main__":
+    main()